@@ -0,0 +1,1142 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import time
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+BENCHMARKS = {}
+_base = None
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def time_ms(func, repeat=20):
+    func()
+    times = []
+    for _ in range(repeat):
+        stime = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - stime)
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+
+def headless_base():
+    global _base
+    if _base is None:
+        import panda3d.core as p3d
+        from direct.showbase.ShowBase import ShowBase
+        p3d.load_prc_file_data('', 'window-type none\naudio-library-name null')
+        _base = ShowBase()
+    return _base
+
+
+def make_ground(physics_system):
+    from panda3d import bullet
+    import panda3d.core as p3d
+    from lithium import components
+
+    node = bullet.BulletRigidBodyNode('Ground')
+    node.add_shape(bullet.BulletPlaneShape(p3d.LVector3(0, 0, 1), 0))
+    headless_base().render.attach_new_node(node)
+    static_mesh = components.PhysicsStaticMeshComponent(node)
+    physics_system.init_components(0, {'PHY_STATICMESH': [static_mesh]})
+
+
+def make_characters(physics_system, count, kinematic=False, spacing=2.0):
+    import panda3d.core as p3d
+    from bamboo.ecs import Entity
+    from lithium import components
+
+    render = headless_base().render
+    side = int(count ** 0.5) + 1
+    chars = []
+    phys_chars = []
+    for i in range(count):
+        entity = Entity(None)
+        np_component = components.NodePathComponent(None, render)
+        np_component.nodepath.set_pos((i % side) * spacing, (i // side) * spacing, 0.9)
+        entity.add_component(np_component)
+        char = components.CharacterComponent()
+        entity.add_component(char)
+        if kinematic:
+            phys = components.KinematicCharacterComponent()
+        else:
+            phys = components.PhysicsCharacterComponent()
+        entity.add_component(phys)
+        chars.append(char)
+        phys_chars.append(phys)
+
+    physics_system.init_components(0, {'PHY_CHARACTER': phys_chars})
+    return chars, phys_chars
+
+
+@benchmark('controller')
+def bench_controller(args):
+    import math
+    import panda3d.core as p3d
+    from lithium import components
+
+    headless_base()
+    for count in (100, 500):
+        for kinematic in (False, True):
+            character_system = components.CharacterSystem()
+            physics_system = components.PhysicsSystem()
+            make_ground(physics_system)
+            chars, phys_chars = make_characters(physics_system, count, kinematic)
+            for i, char in enumerate(chars):
+                angle = i * 2.4
+                char.movement = p3d.LVector3(math.cos(angle), math.sin(angle), 0)
+
+            def step():
+                character_system.update(1 / 60, {'CHARACTER': chars})
+                physics_system.update(1 / 60, {'PHY_CHARACTER': phys_chars})
+
+            # Let everything settle onto the ground before timing
+            for _ in range(30):
+                step()
+            ms = time_ms(step, args.repeat)
+            print('controller {:>4} {:<9} characters: {:7.3f} ms/tick, {:6.1f} us/character'.format(
+                count, 'kinematic' if kinematic else 'dynamic', ms, ms * 1000 / count))
+
+
+@benchmark('sleep')
+def bench_sleep(args):
+    import math
+    import panda3d.core as p3d
+    from lithium import components
+
+    headless_base()
+    count = 500
+    for sleep in (False, True):
+        character_system = components.CharacterSystem()
+        physics_system = components.PhysicsSystem()
+        if not sleep:
+            physics_system.sleep_delay = float('inf')
+        make_ground(physics_system)
+        chars, phys_chars = make_characters(physics_system, count)
+
+        # One character in ten keeps walking, the rest stand around
+        for i, char in enumerate(chars[::10]):
+            char.movement = p3d.LVector3(math.cos(i), math.sin(i), 0)
+
+        def step():
+            character_system.update(1 / 60, {'CHARACTER': chars})
+            physics_system.update(1 / 60, {'PHY_CHARACTER': phys_chars})
+
+        for _ in range(120):
+            step()
+        world = physics_system.physics_world
+        ms = time_ms(step, args.repeat)
+        solver_ms = time_ms(lambda: world.do_physics(1 / 60, 10, 1.0 / 180.0), args.repeat)
+        print('sleep {:<8} {} characters, 10% moving: {:7.3f} ms/tick, do_physics {:7.3f} ms, {} asleep'.format(
+            'enabled' if sleep else 'disabled', count, ms, solver_ms, sum(phys.sleeping for phys in phys_chars)))
+
+
+@benchmark('islands')
+def bench_islands(args):
+    import math
+    import panda3d.core as p3d
+    from lithium import components
+    from lithium import islands
+
+    headless_base()
+    count = 800
+    spacing = 2.0
+    side = int(count ** 0.5) + 1
+    for split in (1, 2):
+        character_system = components.CharacterSystem()
+        physics_system = islands.IslandPhysicsSystem()
+        physics_system.sleep_delay = float('inf')
+        lower = p3d.LPoint3(-spacing, -spacing, -10)
+        upper = p3d.LPoint3(side * spacing, side * spacing, 10)
+        physics_system.set_regions(islands.grid_regions(lower, upper, split, split))
+        make_ground(physics_system)
+        chars, phys_chars = make_characters(physics_system, count, spacing=spacing)
+        for i, char in enumerate(chars):
+            char.movement = p3d.LVector3(math.cos(i), math.sin(i), 0)
+
+        def step():
+            character_system.update(1 / 60, {'CHARACTER': chars})
+            physics_system.update(1 / 60, {'PHY_CHARACTER': phys_chars})
+
+        for _ in range(30):
+            step()
+        ms = time_ms(step, args.repeat)
+        step_ms = time_ms(lambda: physics_system.step(1 / 60), args.repeat)
+        print('islands {} world(s), {} characters: {:7.3f} ms/tick, step {:7.3f} ms'.format(
+            len(physics_system.worlds), count, ms, step_ms))
+
+
+@benchmark('crowd')
+def bench_crowd(args):
+    import numpy as np
+    from lithium import crowd
+
+    rng = np.random.default_rng(0)
+    for count in (1000, 5000, 10000):
+        # Keep density roughly constant at one agent per 4 square meters
+        extent = np.sqrt(count * 4.0) / 2
+        positions = rng.uniform(-extent, extent, (count, 2))
+        velocities = np.zeros((count, 2))
+        goals = -positions
+        max_speeds = np.full(count, 4.0)
+
+        def step():
+            crowd.steer(positions, velocities, goals, max_speeds, 1 / 60)
+
+        ms = time_ms(step, args.repeat)
+        print('crowd steer {:>6} agents: {:7.3f} ms/tick, {:8.0f} agents/ms'.format(count, ms, count / ms))
+
+
+@benchmark('spatial')
+def bench_spatial(args):
+    import numpy as np
+    from lithium import spatial
+
+    rng = np.random.default_rng(0)
+    for count in (1000, 10000):
+        extent = np.sqrt(count * 4.0) / 2
+        positions = rng.uniform(-extent, extent, (count, 3))
+        positions[:, 2] = 0
+        queries = rng.uniform(-extent, extent, (100, 3))
+        queries[:, 2] = 0
+        grid = spatial.UniformGrid(4.0)
+        grid.rebuild(positions)
+
+        def brute_radius():
+            for point in queries:
+                delta = positions - point
+                np.nonzero(np.einsum('ij,ij->i', delta, delta) <= 100)
+
+        def brute_knn():
+            for point in queries:
+                delta = positions - point
+                np.argsort(np.einsum('ij,ij->i', delta, delta))[:8]
+
+        def brute_box():
+            for point in queries:
+                np.nonzero(np.all((positions >= point - 10) & (positions <= point + 10), axis=1))
+
+        results = [
+            ('rebuild', time_ms(lambda: grid.rebuild(positions), args.repeat), None),
+            ('radius 10m', time_ms(lambda: [grid.query_radius(point, 10) for point in queries], args.repeat),
+             time_ms(brute_radius, args.repeat)),
+            ('knn k=8', time_ms(lambda: [grid.query_knn(point, 8) for point in queries], args.repeat),
+             time_ms(brute_knn, args.repeat)),
+            ('box 20m', time_ms(lambda: [grid.query_box(point - 10, point + 10) for point in queries], args.repeat),
+             time_ms(brute_box, args.repeat)),
+        ]
+        for name, grid_ms, brute_ms in results:
+            if brute_ms is None:
+                print('spatial {:>6} chars {:<10}: {:7.3f} ms'.format(count, name, grid_ms))
+            else:
+                print('spatial {:>6} chars {:<10}: {:7.3f} ms per 100 queries (brute force {:7.3f} ms)'.format(
+                    count, name, grid_ms, brute_ms))
+
+
+@benchmark('rewind')
+def bench_rewind(args):
+    import numpy as np
+    from lithium import rewind
+    from lithium import snapshot
+
+    rng = np.random.default_rng(0)
+    seconds = 5
+    rate = 60
+    for count in (50, 500):
+        # Characters wander around at walking speed and occasionally turn sharply
+        positions = rng.uniform(-50, 50, (count, 3)).astype(np.float32)
+        headings = rng.uniform(-180, 180, count)
+        states = []
+        for tick in range(seconds * rate * 2):
+            headings += rng.normal(0, 2, count)
+            velocities = np.zeros((count, 3), np.float32)
+            velocities[:, 0] = np.cos(np.radians(headings)) * 4
+            velocities[:, 1] = np.sin(np.radians(headings)) * 4
+            positions += velocities / rate
+            chars = np.zeros(count, snapshot.CHARACTER_DTYPE)
+            chars['position'] = positions
+            chars['velocity'] = velocities
+            chars['movement'] = velocities / 4
+            chars['rotation'] = headings
+            chars['move_speed'] = 4
+            chars['airborne'] = rng.random(count) < 0.05
+            cams = np.zeros(1, snapshot.CAMERA_DTYPE)
+            cams[0] = (tick * 0.5, 90, 6)
+            states.append(snapshot.Snapshot(chars, np.zeros(0, snapshot.AGENT_DTYPE), cams))
+
+        buf = rewind.RewindBuffer(count, 1, seconds * rate)
+        stime = time.perf_counter()
+        for state in states:
+            buf.record(state)
+        record_ms = (time.perf_counter() - stime) * 1000 / len(states)
+
+        ticks = rng.integers(buf.first_tick, buf.last_tick + 1, 100)
+        seek_ms = time_ms(lambda: [buf.seek(tick) for tick in ticks], args.repeat) / len(ticks)
+        error = max(
+            np.abs(buf.seek(tick).characters['position'] - states[tick].characters['position']).max()
+            for tick in ticks
+        )
+        raw = snapshot.CHARACTER_DTYPE.itemsize * count * len(buf)
+        print('rewind {:>4} characters, {} ticks: record {:6.3f} ms, seek {:6.3f} ms, {:6.0f} bytes/character-second '
+              '(raw {:.0f}), max position error {:.4f} m'.format(
+                  count, len(buf), record_ms, seek_ms, buf.nbytes / (count * seconds), raw / (count * seconds), error))
+
+
+@benchmark('net')
+def bench_net(args):
+    import math
+    import panda3d.core as p3d
+    from bamboo.ecs import ECSManager
+    from lithium import components
+    from lithium import net
+
+    render = headless_base().render
+    rate = 60
+    seconds = 10
+    num_clients = 4
+    conditions = [
+        ('lan', 0.0, 0.0, 0.0),
+        ('50ms', 0.05, 0.0, 0.0),
+        ('100ms+jitter, 5% loss', 0.1, 0.02, 0.05),
+    ]
+    for name, latency, jitter, loss in conditions:
+        # Everything runs in one process on a simulated clock, so the links
+        # behave the same no matter how fast the machine is
+        now = [0.0]
+        clock = lambda: now[0]
+
+        server_ecs = ECSManager()
+        server_physics = components.PhysicsSystem()
+        make_ground(server_physics)
+
+        def spawn():
+            entity = server_ecs.create_entity()
+            entity.add_component(components.NodePathComponent(None, render))
+            entity.get_component('NODEPATH').nodepath.set_pos(0, 0, 0.9)
+            entity.add_component(components.CharacterComponent())
+            entity.add_component(components.PhysicsCharacterComponent())
+            return entity
+
+        server_channel = net.Channel(latency=latency, jitter=jitter, loss=loss, clock=clock, seed=1)
+        server = net.NetServerSystem(server_channel, spawn)
+        server_ecs.add_system(server)
+        server_ecs.add_system(components.CharacterSystem())
+        server_ecs.add_system(server_physics)
+
+        clients = []
+        character_systems = []
+        for idx in range(num_clients):
+            physics_system = components.PhysicsSystem()
+            make_ground(physics_system)
+            chars, _ = make_characters(physics_system, 1)
+            channel = net.Channel(latency=latency, jitter=jitter, loss=loss, clock=clock, seed=idx + 2)
+            character_systems.append(components.CharacterSystem())
+            clients.append(net.NetClient(
+                channel,
+                server_channel.address,
+                chars[0].entity,
+                physics_system,
+                lambda: render.attach_new_node('proxy'),
+                1 / rate
+            ))
+
+        stime = time.perf_counter()
+        rtts = []
+        for tick in range(seconds * rate):
+            now[0] = tick / rate
+            for idx, client in enumerate(clients):
+                # Walk in a new direction every second and jump now and then
+                char = client.player.get_component('CHARACTER')
+                angle = (tick // rate) * 2.4 + idx
+                char.movement = p3d.LVector3(math.cos(angle), math.sin(angle), 0)
+                char.jump = (tick + idx * 17) % 90 == 0
+                client.tick()
+                character_systems[idx].update(1 / rate, {'CHARACTER': [char]})
+                client.physics_system.update(1 / rate, {'PHY_CHARACTER': [client.player.get_component('PHY_CHARACTER')]})
+                if client.rtt is not None:
+                    rtts.append(client.rtt)
+            server_ecs.update(1 / rate)
+        elapsed = time.perf_counter() - stime
+
+        client = clients[0]
+        rtts.sort()
+        print('net {:<22} {} clients: down {:5.2f} KB/s, up {:5.2f} KB/s per client, rtt p50 {:5.0f} ms, '
+              '{:4.1f} corrections/s, last error {:.3f} m, {:.2f} ms/tick'.format(
+                  name,
+                  num_clients,
+                  server_channel.bytes_sent / num_clients / seconds / 1024,
+                  client.channel.bytes_sent / seconds / 1024,
+                  rtts[len(rtts) // 2] * 1000 if rtts else float('nan'),
+                  client.corrections / seconds,
+                  client.prediction_error,
+                  elapsed * 1000 / (seconds * rate)))
+
+        server_channel.close()
+        for client in clients:
+            client.channel.close()
+
+
+@benchmark('cells')
+def bench_cells(args):
+    import panda3d.core as p3d
+    from lithium import cells
+    from lithium import levelbuild
+
+    level = make_level()
+    draw_calls = sum(geomnp.node().get_num_geoms() for geomnp in level.find_all_matches('**/+GeomNode'))
+    vertices = sum(
+        geom.get_vertex_data().get_num_rows()
+        for geomnp in level.find_all_matches('**/+GeomNode')
+        for geom in geomnp.node().get_geoms()
+    )
+    print('cells unbatched level: {} draw calls, {} vertices'.format(draw_calls, vertices))
+
+    stime = time.perf_counter()
+    levelbuild.build_cells(level)
+    print('cells build: {:.2f}s'.format(time.perf_counter() - stime))
+
+    level_cells = cells.LevelCells(level)
+    camera = level.attach_new_node('camera')
+    lens = p3d.PerspectiveLens()
+    lens.set_fov(75)
+    views = [
+        ('overview', (80, -60, 60), (80, 80, 0)),
+        ('inside room', (80, 20, 2), (80, 30, 2)),
+        ('along hall', (2, 2, 2), (150, 150, 2)),
+    ]
+    for name, pos, target in views:
+        camera.set_pos(*pos)
+        camera.look_at(*target)
+        stats = level_cells.stats(camera, lens)
+        ms = time_ms(lambda: level_cells.stats(camera, lens), args.repeat)
+        print('cells {:<12} {:>3}/{} cells visible, {:>2} occluded: {:>4} draw calls, {:>7} vertices ({:.2f} ms to count)'.format(
+            name, stats.visible_cells, stats.cells, stats.occluded_cells, stats.draw_calls, stats.vertices, ms))
+
+
+@benchmark('actions')
+def bench_actions(args):
+    import panda3d.core as p3d
+    from direct.showbase.DirectObject import DirectObject
+    from direct.showbase.MessengerGlobal import messenger
+    from lithium import actions
+
+    headless_base()
+    events = ['move-forward', 'move-left', 'jump', 'move-left-up', 'jump-up', 'move-forward-up'] * 100
+
+    # The hand-written handlers GameState used before the action map
+    legacy = DirectObject()
+    movement = p3d.LVector3(0, 0, 0)
+    def update_movement(direction, activate):
+        move_delta = p3d.LVector3(0, 0, 0)
+        if direction == 'forward':
+            move_delta.set_y(1)
+        elif direction == 'backward':
+            move_delta.set_y(-1)
+        elif direction == 'left':
+            move_delta.set_x(-1)
+        elif direction == 'right':
+            move_delta.set_x(1)
+        if not activate:
+            move_delta *= -1
+        movement.set(*(movement + move_delta))
+    for direction in ('forward', 'backward', 'left', 'right'):
+        legacy.accept('move-' + direction, update_movement, [direction, True])
+        legacy.accept('move-' + direction + '-up', update_movement, [direction, False])
+    legacy.accept('jump', lambda: None)
+
+    def send_events():
+        for event in events:
+            messenger.send(event)
+
+    legacy_ms = time_ms(send_events, args.repeat)
+    legacy.ignore_all()
+
+    action_map = actions.ActionMap.from_file('config/actions.conf')
+    action_ms = time_ms(send_events, args.repeat)
+    table = [(action_map.release if event.endswith('-up') else action_map.press, action_map.table[event.replace('-up', '')])
+             for event in events]
+    def dispatch():
+        for handler, entry in table:
+            handler(entry)
+    dispatch_ms = time_ms(dispatch, args.repeat)
+    sample_ms = time_ms(lambda: [action_map.sample() for _ in range(len(events))], args.repeat)
+    action_map.ignore_all()
+
+    print('actions legacy handlers via messenger: {:6.2f} us/event'.format(legacy_ms * 1000 / len(events)))
+    print('actions action map via messenger:      {:6.2f} us/event'.format(action_ms * 1000 / len(events)))
+    print('actions action map table dispatch:     {:6.2f} us/event'.format(dispatch_ms * 1000 / len(events)))
+    print('actions sample:                        {:6.2f} us/tick'.format(sample_ms * 1000 / len(events)))
+
+
+@benchmark('config')
+def bench_config(args):
+    import contextlib
+    import shutil
+    import tempfile
+    from blenderpanda import pman
+
+    projectdir = tempfile.mkdtemp()
+    startdir = os.path.join(projectdir, *['dir{}'.format(i) for i in range(24)])
+    os.makedirs(startdir)
+    shutil.copy('../.pman', projectdir)
+
+    # The lookup pman did before the cache: list every directory up to the config
+    def legacy_get_config():
+        dirs = os.path.abspath(startdir).split(os.sep)
+        while dirs:
+            cdir = os.sep.join(dirs)
+            if cdir.strip() and '.pman' in os.listdir(cdir):
+                config = pman.configparser.ConfigParser()
+                config.read_dict(pman._config_defaults)
+                config.read(os.path.join(cdir, '.pman'))
+                return config
+            dirs.pop()
+
+    def cold_get_config():
+        pman.clear_config_cache()
+        return pman.get_config(startdir)
+
+    # Network mounted home directories pay a round trip for every metadata call
+    @contextlib.contextmanager
+    def slow_metadata(delay):
+        stat, listdir = os.stat, os.listdir
+        def slow_stat(*args, **kwargs):
+            time.sleep(delay)
+            return stat(*args, **kwargs)
+        def slow_listdir(*args, **kwargs):
+            time.sleep(delay)
+            return listdir(*args, **kwargs)
+        os.stat, os.listdir = slow_stat, slow_listdir
+        try:
+            yield
+        finally:
+            os.stat, os.listdir = stat, listdir
+
+    try:
+        for label, delay in (('local', None), ('0.5 ms/stat', 0.0005)):
+            with slow_metadata(delay) if delay else contextlib.suppress():
+                legacy_ms = time_ms(legacy_get_config, args.repeat)
+                cold_ms = time_ms(cold_get_config, args.repeat)
+                warm_ms = time_ms(lambda: pman.get_config(startdir), args.repeat)
+                # Cached lookups still look for a newer config in every directory in between
+                root_ms = time_ms(lambda: pman.get_config(projectdir), args.repeat)
+            print('config {:<12} 24 levels deep: legacy {:7.3f} ms  cold {:7.3f} ms  cached {:7.3f} ms  cached from project {:7.3f} ms'.format(
+                label,
+                legacy_ms,
+                cold_ms,
+                warm_ms,
+                root_ms
+            ))
+    finally:
+        pman.clear_config_cache()
+        shutil.rmtree(projectdir)
+
+
+@benchmark('textures')
+def bench_textures(args):
+    import glob
+    import shutil
+    import tempfile
+    import panda3d.core as p3d
+    from blenderpanda import textures
+
+    images = []
+    for path in sorted(glob.glob('../assets/*')):
+        tex = p3d.Texture()
+        if path.lower().endswith(('.png', '.jpg', '.tga')) and tex.read(p3d.Filename.from_os_specific(path)):
+            images.append(path)
+    if not images:
+        print('textures no readable images in ../assets')
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        jobs = [(path, os.path.join(tmpdir, os.path.splitext(os.path.basename(path))[0] + textures.TXO_SUFFIX)) for path in images]
+        cachedir = os.path.join(tmpdir, 'cache')
+        os.makedirs(cachedir)
+        stime = time.perf_counter()
+        textures.build_textures(jobs, cachedir)
+        build_ms = (time.perf_counter() - stime) * 1000
+        stime = time.perf_counter()
+        textures.build_textures(jobs, cachedir)
+        cached_ms = (time.perf_counter() - stime) * 1000
+
+        # Raw images are decoded and mipmapped on every load, .txo files only read
+        def load_raw():
+            for path in images:
+                tex = p3d.Texture()
+                tex.read(p3d.Filename.from_os_specific(path))
+                tex.generate_ram_mipmap_images()
+        def load_txo():
+            for _, txo in jobs:
+                tex = p3d.Texture()
+                tex.read(p3d.Filename.from_os_specific(txo))
+
+        raw_ms = time_ms(load_raw, args.repeat)
+        txo_ms = time_ms(load_txo, args.repeat)
+        print('textures build {} images:     {:8.2f} ms  (cached {:.2f} ms)'.format(len(images), build_ms, cached_ms))
+        print('textures load raw + mipmaps:  {:8.2f} ms'.format(raw_ms))
+        print('textures load .txo:           {:8.2f} ms'.format(txo_ms))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@benchmark('pack')
+def bench_pack(args):
+    import random
+    import shutil
+    import tempfile
+    import panda3d.core as p3d
+    from blenderpanda import pack
+
+    # A few hundred small exported files, like a shipped game's asset directory
+    tmpdir = tempfile.mkdtemp(dir='.')
+    exportdir = os.path.join(tmpdir, 'assets')
+    os.makedirs(exportdir)
+    rng = random.Random(1)
+    models = []
+    for idx in range(200):
+        pillar = make_pillar(segments=8 + idx % 24)
+        pillar.set_pos(rng.random(), rng.random(), 0)
+        name = 'prop{}.bam'.format(idx)
+        pillar.write_bam_file(p3d.Filename.from_os_specific(os.path.join(exportdir, name)))
+        models.append(name)
+    textures = []
+    for idx in range(40):
+        image = p3d.PNMImage(256, 256, 3)
+        image.perlin_noise_fill(0.1, 0.1, 256, idx)
+        tex = p3d.Texture()
+        tex.load(image)
+        tex.generate_ram_mipmap_images()
+        name = 'tex{}.txo'.format(idx)
+        tex.write(p3d.Filename.from_os_specific(os.path.join(exportdir, name)))
+        textures.append(name)
+
+    pack_path = pack.get_pack_path(exportdir)
+    stime = time.perf_counter()
+    pack.build_pack(exportdir, pack_path)
+    pack_ms = (time.perf_counter() - stime) * 1000
+    # What a build with nothing changed pays instead of packing again
+    stime = time.perf_counter()
+    assert pack.pack_is_current(pack_path, pack.pack_entries(exportdir))
+    check_ms = (time.perf_counter() - stime) * 1000
+
+    # Best effort at a cold start: drop the files from the page cache first
+    def evict(paths):
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(fd)
+
+    loader = p3d.Loader.get_global_ptr()
+    options = p3d.LoaderOptions(p3d.LoaderOptions.LF_no_cache | p3d.LoaderOptions.LF_report_errors)
+    def load_all(rootdir):
+        root = p3d.Filename.from_os_specific(rootdir)
+        for name in models:
+            loader.load_sync(p3d.Filename(root, name), options)
+        for name in textures:
+            p3d.Texture().read(p3d.Filename(root, name))
+
+    loose_files = [os.path.join(exportdir, i) for i in models + textures]
+    results = []
+    for cold in (True, False):
+        def run_loose():
+            if cold:
+                evict(loose_files)
+            load_all(exportdir)
+        results.append(('loose', cold, time_ms(run_loose, args.repeat)))
+
+        for prefetch in (False, True):
+            def run_pack():
+                if cold:
+                    evict([pack_path])
+                mounted = pack.MountedPack(pack_path, os.path.join(tmpdir, 'mounted'))
+                if prefetch:
+                    mounted.prefetch(models + textures)
+                load_all(os.path.join(tmpdir, 'mounted'))
+                mounted.close()
+            label = 'pack + prefetch' if prefetch else 'pack'
+            results.append((label, cold, time_ms(run_pack, args.repeat)))
+
+    shutil.rmtree(tmpdir)
+    print('pack build {} files: {:8.2f} ms, up to date check {:6.2f} ms'.format(len(loose_files), pack_ms, check_ms))
+    for label, cold, ms in results:
+        print('pack load {:<16} {:<5} {:8.2f} ms'.format(label, 'cold' if cold else 'warm', ms))
+
+
+@benchmark('archetypes')
+def bench_archetypes(args):
+    import panda3d.core as p3d
+    from bamboo.ecs import Entity
+    from lithium import archetypes
+    from lithium import components
+
+    render = headless_base().render
+    typeids = ('CHARACTER', 'NODEPATH', 'PHY_CHARACTER')
+    def make_entities(count):
+        added = {typeid: [] for typeid in typeids}
+        for _ in range(count):
+            entity = Entity(None)
+            for component in (components.NodePathComponent(None, render), components.CharacterComponent(), components.PhysicsCharacterComponent()):
+                entity.add_component(component)
+                added[component.typeid].append(component)
+        return added
+
+    for count in (100, 1000):
+        world = make_entities(count)
+        join = archetypes.Join(typeids)
+        index = archetypes.ArchetypeIndex()
+        query = index.query(*typeids)
+        index.init_components(0, world)
+
+        # What a system does with the rows: touch every component once
+        def run_join():
+            for char, npcomp, phys in join.select(world):
+                pass
+        def run_query():
+            index.update(0, world)
+            for char, npcomp, phys in query.select(world):
+                pass
+        print('archetypes {:>4} entities join:   {:8.3f} ms/frame'.format(count, time_ms(run_join, args.repeat)))
+        print('archetypes {:>4} entities cached: {:8.3f} ms/frame'.format(count, time_ms(run_query, args.repeat)))
+
+        # Adding extends the tables, removing rebuilds the ones over the removed type
+        added = make_entities(10)
+        stime = time.perf_counter()
+        index.init_components(0, added)
+        for typeid in typeids:
+            world[typeid].extend(added[typeid])
+        add_ms = (time.perf_counter() - stime) * 1000
+        world['PHY_CHARACTER'].pop()
+        stime = time.perf_counter()
+        index.update(0, world)
+        remove_ms = (time.perf_counter() - stime) * 1000
+        print('archetypes {:>4} entities add 10: {:8.3f} ms, remove 1: {:.3f} ms, {} rows'.format(count, add_ms, remove_ms, len(query)))
+
+
+@benchmark('nav')
+def bench_nav(args):
+    import numpy as np
+    import panda3d.core as p3d
+    from bamboo.ecs import Entity
+    from lithium import components
+    from lithium import navigation
+
+    rooms, room_size = 6, 12.0
+    extent = rooms * room_size
+    stime = time.perf_counter()
+    navmesh = make_navmesh(rooms, room_size)
+    print('nav build: {:.2f}s, {} cells, {} regions'.format(time.perf_counter() - stime, len(navmesh.heights), len(navmesh)))
+
+    rng = np.random.RandomState(1)
+    def random_point():
+        return p3d.LPoint3(rng.uniform(1, extent - 1), rng.uniform(1, extent - 1), 0)
+    requests = [(random_point(), random_point()) for _ in range(200)]
+
+    def run_uncached():
+        for start, goal in requests:
+            navmesh.find_path(start, goal)
+    system = navigation.NavigationSystem(navmesh)
+    def run_cached():
+        for start, goal in requests:
+            system.find_path(start, goal)
+    print('nav 200 paths uncached: {:8.2f} ms'.format(time_ms(run_uncached, args.repeat)))
+    print('nav 200 paths cached:   {:8.2f} ms ({:.0%} hits)'.format(
+        time_ms(run_cached, args.repeat),
+        system.cache_hits / (system.cache_hits + system.cache_misses)
+    ))
+
+    # Batched requests from agents, spread over frames by the time budget
+    render = headless_base().render
+    system = navigation.NavigationSystem(navmesh, budget=0.001, cache_size=0)
+    for start, goal in requests:
+        entity = Entity(None)
+        np_component = components.NodePathComponent(None, render)
+        np_component.nodepath.set_pos(start)
+        entity.add_component(np_component)
+        agent = components.NavAgentComponent(goal)
+        entity.add_component(agent)
+        system.request_path(agent)
+    frames = []
+    while len(frames) < len(requests):
+        stime = time.perf_counter()
+        if not system.process_requests():
+            break
+        frames.append((time.perf_counter() - stime) * 1000)
+    print('nav 200 requests, 1 ms budget: {} frames, worst frame {:.2f} ms'.format(
+        len(frames), max(frames)))
+
+
+@benchmark('hpa')
+def bench_hpa(args):
+    import numpy as np
+    import panda3d.core as p3d
+    from bamboo.ecs import Entity
+    from lithium import components
+    from lithium import navigation
+
+    rooms, room_size = 12, 12.0
+    extent = rooms * room_size
+    stime = time.perf_counter()
+    navmesh = make_navmesh(rooms, room_size)
+    print('hpa build: {:.2f}s, {} regions in {} clusters'.format(
+        time.perf_counter() - stime, len(navmesh), len(set(navmesh.region_clusters))))
+
+    # Every agent repaths at once, to a goal anywhere on the map
+    render = headless_base().render
+    rng = np.random.RandomState(1)
+    def random_point():
+        return p3d.LPoint3(rng.uniform(1, extent - 1), rng.uniform(1, extent - 1), 0)
+    for count in (100, 1000):
+        agents = []
+        for _ in range(count):
+            entity = Entity(None)
+            np_component = components.NodePathComponent(None, render)
+            np_component.nodepath.set_pos(random_point())
+            entity.add_component(np_component)
+            entity.add_component(components.CharacterComponent())
+            agent = components.NavAgentComponent(random_point())
+            entity.add_component(agent)
+            agents.append(agent)
+
+        for hierarchical in (False, True):
+            system = navigation.NavigationSystem(navmesh, budget=None, cache_size=0, hierarchical=hierarchical)
+            for agent in agents:
+                system.request_path(agent)
+            stime = time.perf_counter()
+            system.process_requests()
+            elapsed = time.perf_counter() - stime
+            follow_ms = time_ms(lambda: system.update(1 / 60, {'NAV_AGENT': agents}), args.repeat)
+            print('hpa {:>4} agents {:<12} {:8.0f} paths/s, {:6.2f} ms following'.format(
+                count, 'hierarchical' if hierarchical else 'flat', count / elapsed, follow_ms))
+
+    # A chunk of the map going away only recomputes the clusters around it
+    middle = rooms // 2 * room_size
+    chunk = navmesh.regions_within((middle, middle), (middle + room_size, middle + room_size))
+    stime = time.perf_counter()
+    navmesh.set_blocked(chunk)
+    navmesh.find_corridor(0, len(navmesh) - 1)
+    print('hpa block chunk of {} regions: {:.2f} ms'.format(len(chunk), (time.perf_counter() - stime) * 1000))
+    stime = time.perf_counter()
+    navmesh.set_blocked(range(len(navmesh)), False)
+    navmesh.find_corridor(0, len(navmesh) - 1)
+    print('hpa recompute all clusters: {:.2f} ms'.format((time.perf_counter() - stime) * 1000))
+
+
+
+@benchmark('scheduler')
+def bench_scheduler(args):
+    import math
+    import panda3d.core as p3d
+    from lithium import archetypes
+    from lithium import components
+    from lithium import crowd
+    from lithium import scheduler
+    from lithium import spatial
+
+    base = headless_base()
+    count = 500
+    index = archetypes.ArchetypeIndex()
+    spatial_index = spatial.SpatialIndexSystem(index=index)
+    physics_system = components.PhysicsSystem(spatial_index, index)
+    physics_system.sleep_delay = float('inf')
+    crowd_system = crowd.CrowdSystem(physics_system, index=index)
+    # The camera following after physics only reads transforms, so it can
+    # overlap the spatial index rebuild
+    systems = [
+        crowd_system,
+        components.CharacterSystem(index),
+        physics_system,
+        components.Camera3PSystem(),
+        spatial_index,
+    ]
+
+    make_ground(physics_system)
+    chars, phys_chars = make_characters(physics_system, count)
+    agents = []
+    for i, char in enumerate(chars):
+        agent = components.CrowdAgentComponent(p3d.LVector3(math.cos(i), math.sin(i), 0) * 30)
+        char.entity.add_component(agent)
+        agents.append(agent)
+    world = {
+        'CHARACTER': chars,
+        'NODEPATH': [char.entity.get_component('NODEPATH') for char in chars],
+        'PHY_CHARACTER': phys_chars,
+        'CROWD_AGENT': agents,
+        'CAMERA3P': [components.Camera3PComponent(base.render.attach_new_node('Camera'), chars[0].entity.get_component('NODEPATH').nodepath)],
+    }
+    index.init_components(0, world)
+    crowd_system.init_components(0, world)
+
+    for parallel in (False, True):
+        system_scheduler = scheduler.SystemScheduler(systems, parallel)
+        if not parallel:
+            print(system_scheduler.describe())
+        def step():
+            index.update(1 / 60, world)
+            system_scheduler.update(1 / 60, world)
+        for _ in range(30):
+            step()
+        print('scheduler {} characters {:<8} {:7.3f} ms/tick'.format(
+            count, 'parallel' if parallel else 'serial', time_ms(step, args.repeat)))
+        print(system_scheduler.summary())
+
+
+
+@benchmark('spawn')
+def bench_spawn(args):
+    import math
+    import os
+    import tempfile
+    import panda3d.core as p3d
+    from bamboo.ecs import ECSManager
+    from lithium import components
+
+    base = headless_base()
+    modeldir = tempfile.mkdtemp()
+    modelpath = p3d.Filename.from_os_specific(os.path.join(modeldir, 'character.bam'))
+    model = p3d.NodePath('character')
+    make_pillar(height=1.75).reparent_to(model.attach_new_node('Character'))
+    model.write_bam_file(modelpath)
+
+    count = 500
+    goals = [p3d.LPoint3(math.cos(i) * 30, math.sin(i) * 30, 0) for i in range(count)]
+    # Spread out characters cost about what they will every frame, packed ones
+    # start out overlapping and make the first steps after attaching expensive
+    layouts = {
+        'spread': [p3d.LPoint3((i % 23) * 2, (i // 23) * 2, 0.9) for i in range(count)],
+        'packed': [p3d.LPoint3((i % 23) * 0.5, (i // 23) * 0.5, 0.9) for i in range(count)],
+    }
+    for layout, positions in layouts.items():
+        for bulk in (False, True):
+            ecsmanager = ECSManager()
+            ecsmanager.space = base.render.attach_new_node('space')
+            physics_system = components.PhysicsSystem()
+            if bulk:
+                physics_system.spawn_budget = 0.002
+            ecsmanager.add_system(physics_system)
+            make_ground(physics_system)
+            factory = components.TemplateFactory(ecsmanager)
+            for _ in range(10):
+                ecsmanager.update(1 / 60)
+
+            # A wave spawned in the middle of play, then the frames until it
+            # is all in the world and a few more while it settles
+            stime = time.perf_counter()
+            if bulk:
+                factory.make_crowd_agents(modelpath, goals, ecsmanager.space, positions)
+            else:
+                for goal, position in zip(goals, positions):
+                    factory.make_crowd_agent(modelpath, goal, ecsmanager.space, position)
+            create_ms = (time.perf_counter() - stime) * 1000
+            frames = []
+            while not frames or physics_system._spawning:
+                stime = time.perf_counter()
+                ecsmanager.update(1 / 60)
+                frames.append((time.perf_counter() - stime) * 1000)
+            settle = []
+            for _ in range(10):
+                stime = time.perf_counter()
+                ecsmanager.update(1 / 60)
+                settle.append((time.perf_counter() - stime) * 1000)
+            print('spawn {} {} {:<6} create {:6.2f} ms, {:3} frame(s), worst {:6.2f} ms, settling worst {:6.2f} last {:6.2f} ms'.format(
+                count, layout, 'bulk' if bulk else 'single', create_ms, len(frames), max(frames), max(settle), settle[-1]))
+            ecsmanager.space.remove_node()
+
+
+
+@benchmark('gc')
+def bench_gc(args):
+    import gc
+    from lithium import gcmanager
+    from lithium import replay
+
+    # A loaded level's worth of long-lived objects, then frames that churn
+    # through short-lived rows with a few reference cycles among them
+    level = [{'id': i, 'children': [[] for _ in range(3)]} for i in range(200000)]
+    def frame():
+        rows = [(i, [i], {'id': i}) for i in range(2000)]
+        for _ in range(50):
+            node = {}
+            node['self'] = node
+        return len(rows)
+
+    frame_time = 1 / 60
+    for managed in (False, True):
+        gc.collect()
+        manager = gcmanager.GCManager(history_frames=args.repeat * 30)
+        if managed:
+            manager.freeze()
+        manager.enable(defer=managed)
+        for _ in range(args.repeat * 30):
+            stime = time.perf_counter()
+            frame()
+            manager.end_frame(frame_time - (time.perf_counter() - stime))
+        manager.disable()
+        gc.unfreeze()
+        print(replay.summarize('gc {}'.format('managed' if managed else 'default'), manager.pauses))
+        print('gc {:<8} {} full collections ({} forced), worst pause {:.2f} ms'.format(
+            'managed' if managed else 'default', manager.full_collections, manager.forced_collections, max(manager.pauses) * 1000))
+    return level
+
+
+
+@benchmark('jobs')
+def bench_jobs(args):
+    import os
+    import tempfile
+    import numpy as np
+    from lithium import jobs
+
+    # Jobs that each take 20 ms in slices of about 0.2 ms, plus snapshot
+    # sized writes handed to the thread pool
+    def busy(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    def chunked(slices):
+        for _ in range(slices):
+            busy(0.0002)
+            yield
+
+    outdir = tempfile.mkdtemp()
+    data = np.zeros(4 << 20, dtype=np.uint8)
+    def write(index):
+        path = os.path.join(outdir, '{}.bin'.format(index))
+        yield queue.offload(data.tofile, path)
+
+    stime = time.perf_counter()
+    for job in [chunked(100) for _ in range(10)]:
+        for _ in job:
+            pass
+    for index in range(4):
+        data.tofile(os.path.join(outdir, '{}.bin'.format(index)))
+    print('jobs inline: {:8.2f} ms in one frame'.format((time.perf_counter() - stime) * 1000))
+
+    for budget in (0.001, 0.002, 0.004):
+        queue = jobs.JobQueue(budget)
+        for index in range(10):
+            queue.add(chunked(100), priority=index % 3)
+        for index in range(4):
+            queue.add(write(index), priority=5)
+        frames = []
+        while len(queue):
+            stime = time.perf_counter()
+            queue.run()
+            frames.append((time.perf_counter() - stime) * 1000)
+        queue.close()
+        print('jobs {:.0f} ms budget: {:4d} frames, worst frame {:6.2f} ms'.format(budget * 1000, len(frames), max(frames)))
+        print(queue.summary())
+
+
+def make_navmesh(rooms, room_size):
+    import io
+    import numpy as np
+    from panda3d import bullet
+    import panda3d.core as p3d
+    from lithium import navbuild
+    from lithium import navigation
+
+    # Rooms on a grid with a door in every wall, like the walls of make_level with collision
+    extent = rooms * room_size
+    level = p3d.NodePath('level')
+    level.attach_new_node('PlayerStart')
+    def add_box(center, half):
+        node = bullet.BulletRigidBodyNode('Box')
+        node.add_shape(bullet.BulletBoxShape(p3d.LVector3(*half)))
+        level.attach_new_node(node).set_pos(*center)
+    add_box((extent / 2, extent / 2, -0.5), (extent / 2, extent / 2, 0.5))
+    for idx in range(1, rooms):
+        for span in range(rooms):
+            # Each wall segment leaves a 2m door in its middle
+            start = span * room_size
+            for lo, hi in ((start, start + room_size / 2 - 1), (start + room_size / 2 + 1, start + room_size)):
+                add_box(((lo + hi) / 2, idx * room_size, 1.5), ((hi - lo) / 2, 0.1, 1.5))
+                add_box((idx * room_size, (lo + hi) / 2, 1.5), (0.1, (hi - lo) / 2, 1.5))
+
+    # Round trip through the file format the game loads
+    stream = io.BytesIO()
+    np.savez(stream, **navbuild.build_navmesh(level))
+    stream.seek(0)
+    with np.load(stream) as arrays:
+        return navigation.NavMesh({key: arrays[key] for key in arrays.files})
+
+
+def make_pillar(segments=24, rings=12, radius=0.5, height=8.0):
+    import math
+    import panda3d.core as p3d
+
+    vdata = p3d.GeomVertexData('pillar', p3d.GeomVertexFormat.get_v3n3(), p3d.Geom.UH_static)
+    vdata.set_num_rows(segments * (rings + 1))
+    vertex = p3d.GeomVertexWriter(vdata, 'vertex')
+    normal = p3d.GeomVertexWriter(vdata, 'normal')
+    for ring in range(rings + 1):
+        for segment in range(segments):
+            angle = 2 * math.pi * segment / segments
+            vertex.add_data3(math.cos(angle) * radius, math.sin(angle) * radius, height * ring / rings)
+            normal.add_data3(math.cos(angle), math.sin(angle), 0)
+
+    tris = p3d.GeomTriangles(p3d.Geom.UH_static)
+    for ring in range(rings):
+        for segment in range(segments):
+            a = ring * segments + segment
+            b = ring * segments + (segment + 1) % segments
+            tris.add_vertices(a, b, b + segments)
+            tris.add_vertices(a, b + segments, a + segments)
+
+    geom = p3d.Geom(vdata)
+    geom.add_primitive(tris)
+    node = p3d.GeomNode('pillar')
+    node.add_geom(geom)
+    return p3d.NodePath(node)
+
+
+def make_level(side=40, spacing=4.0, walls=4):
+    import panda3d.core as p3d
+
+    # A hall of pillars, each its own node like an unbatched export
+    level = p3d.NodePath('level')
+    level.attach_new_node('PlayerStart')
+    pillar = make_pillar()
+    for row in range(side):
+        for column in range(side):
+            pillar.copy_to(level).set_pos(column * spacing, row * spacing, 0)
+
+    # Solid walls splitting the hall into rooms
+    card = p3d.CardMaker('Occluder')
+    extent = side * spacing
+    card.set_frame(0, extent, 0, 10)
+    for idx in range(1, walls + 1):
+        wall = level.attach_new_node(card.generate())
+        wall.set_name('Occluder{}'.format(idx))
+        wall.set_pos(0, extent * idx / (walls + 1), 0)
+    return level
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run headless Lithium benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=20, help='timed iterations per measurement')
+    args = parser.parse_args()
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {} (choose from {})'.format(', '.join(sorted(unknown)), ', '.join(sorted(BENCHMARKS))))
+
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print('== {} =='.format(name))
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import os
+
 from .rendermanager import create_render_manager
 from . import pman
 import panda3d.core as p3d
@@ -13,8 +15,17 @@ def init(base):
     if not pman.is_frozen() and base.appRunner is None and config.getboolean('run', 'auto_build'):
         pman.build(config)
 
-    # Add export directory to model path
     exportdir = pman.get_abs_path(config, config.get('build', 'export_dir'))
+
+    # A pack is mounted over the export directory, so the same paths work either way
+    if pman.is_frozen() or config.getboolean('build', 'pack'):
+        from . import pack
+        packpath = pack.get_pack_path(exportdir)
+        if os.path.exists(packpath):
+            base._bppack = pack.MountedPack(packpath, exportdir)
+            base._bppack.prefetch_recorded()
+
+    # Add export directory to model path
     exportdir = p3d.Filename.from_os_specific(exportdir)
     p3d.get_model_path().prepend_directory(exportdir)
 
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# Packs the export directory into one Multifile for shipped builds. Run as a
+# script with the source and export directories and the pack to write; the
+# rest is used at runtime to mount the pack and prefetch from it.
+import mmap
+import os
+import sys
+
+import panda3d.core as p3d
+
+
+PACK_SUFFIX = '.mf'
+PREFETCH_NAME = 'prefetch.txt'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.tga', '.dds')
+
+
+def get_pack_path(exportdir):
+    return os.path.normpath(exportdir) + PACK_SUFFIX
+
+
+def pack_entries(dstdir):
+    entries = []
+    for root, dirs, files in os.walk(dstdir):
+        for asset in sorted(files):
+            path = os.path.join(root, asset)
+            name, ext = os.path.splitext(asset)
+            # Models point at the .txo built from an image, not the image itself
+            if ext.lower() in IMAGE_EXTENSIONS and os.path.exists(os.path.join(root, name + '.txo')):
+                continue
+            entries.append((os.path.relpath(path, dstdir).replace(os.sep, '/'), path))
+    return entries
+
+
+def pack_is_current(pack_path, entries):
+    # Up to date when it holds exactly these files and none of them changed
+    # after it was written
+    try:
+        pack_mtime = os.stat(pack_path).st_mtime
+    except OSError:
+        return False
+    if any(os.stat(path).st_mtime >= pack_mtime for _, path in entries):
+        return False
+
+    multifile = p3d.Multifile()
+    if not multifile.open_read(p3d.Filename.from_os_specific(pack_path)):
+        return False
+    names = {multifile.get_subfile_name(i) for i in range(multifile.get_num_subfiles())}
+    multifile.close()
+    return names == {subfile for subfile, _ in entries}
+
+
+def build_pack(dstdir, pack_path, entries=None):
+    # Entries are stored uncompressed and start on page boundaries, so reading
+    # one maps straight onto whole pages of the file
+    if entries is None:
+        entries = pack_entries(dstdir)
+    multifile = p3d.Multifile()
+    if not multifile.open_write(p3d.Filename.from_os_specific(pack_path + '.tmp')):
+        raise IOError('Could not write {}'.format(pack_path))
+    multifile.set_scale_factor(mmap.PAGESIZE)
+    multifile.set_record_timestamp(False)
+
+    for subfile, path in entries:
+        filename = p3d.Filename.binary_filename(p3d.Filename.from_os_specific(path))
+        multifile.add_subfile(subfile, filename, 0)
+
+    multifile.flush()
+    multifile.close()
+    os.replace(pack_path + '.tmp', pack_path)
+    return len(entries)
+
+
+class MountedPack:
+    __slots__ = [
+        'path',
+        'mount_point',
+        'multifile',
+        '_file',
+        '_map',
+    ]
+
+    def __init__(self, path, mount_point):
+        # Mounted over the export directory, so asset paths are the same
+        # whether they come from loose files or the pack
+        self.path = path
+        self.mount_point = p3d.Filename.from_os_specific(mount_point)
+        self.multifile = p3d.Multifile()
+        if not self.multifile.open_read(p3d.Filename.from_os_specific(path)):
+            raise IOError('Could not read {}'.format(path))
+        vfs = p3d.VirtualFileSystem.get_global_ptr()
+        vfs.mount(self.multifile, self.mount_point, p3d.VirtualFileSystem.MF_read_only)
+
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def prefetch(self, names):
+        # Ask the OS to start reading the pages behind these entries, so they
+        # are in the page cache by the time the loader gets to them
+        num_bytes = 0
+        for name in names:
+            idx = self.multifile.find_subfile(name)
+            if idx < 0:
+                continue
+            start = self.multifile.get_subfile_internal_start(idx)
+            length = self.multifile.get_subfile_internal_length(idx)
+            if length > 0 and hasattr(self._map, 'madvise'):
+                self._map.madvise(mmap.MADV_WILLNEED, start, length)
+            num_bytes += length
+        return num_bytes
+
+    def prefetch_recorded(self):
+        vfs = p3d.VirtualFileSystem.get_global_ptr()
+        listing = p3d.Filename(self.mount_point, PREFETCH_NAME)
+        if not vfs.exists(listing):
+            return 0
+        return self.prefetch(vfs.read_file(listing, True).decode('utf8').splitlines())
+
+    def close(self):
+        p3d.VirtualFileSystem.get_global_ptr().unmount(self.multifile)
+        self._map.close()
+        self._file.close()
+
+
+def loaded_assets(exportdir):
+    # Everything the model and texture pools loaded from the export directory,
+    # in a form that can be written out as a prefetch list
+    exportdir = p3d.Filename.from_os_specific(exportdir).get_fullpath().rstrip('/') + '/'
+
+    stream = p3d.StringStream()
+    p3d.ModelPool.write(stream)
+    paths = [
+        line for line in stream.data.decode('utf8').splitlines()
+        if line.startswith('/')
+    ]
+    paths.extend(tex.get_fullpath().get_fullpath() for tex in p3d.TexturePool.find_all_textures())
+
+    return sorted({
+        path[len(exportdir):]
+        for path in paths
+        if path.startswith(exportdir)
+    })
+
+
+def write_prefetch_list(exportdir):
+    names = loaded_assets(exportdir)
+    with open(os.path.join(exportdir, PREFETCH_NAME), 'w') as f:
+        f.write('\n'.join(names) + '\n')
+    return names
+
+
+def main(args):
+    srcdir, dstdir, pack_path = args[-3:]
+    entries = pack_entries(dstdir)
+    if pack_is_current(pack_path, entries):
+        print('Pack {} is up to date'.format(pack_path))
+        return
+    num_files = build_pack(dstdir, pack_path, entries)
+    print('Packed {} files into {} ({:.1f} MB)'.format(
+        num_files,
+        pack_path,
+        os.path.getsize(pack_path) / 1024 / 1024
+    ))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,7 +1,6 @@
-import fnmatch
+# Build tooling (fnmatch, shutil, subprocess) is imported where it is used,
+# so games that only read the config don't pay for it at startup
 import os
-import shutil
-import subprocess
 import sys
 import time
 from collections import OrderedDict
@@ -43,11 +42,17 @@ _config_defaults = OrderedDict([
     ('general', OrderedDict([
         ('name', 'Game'),
         ('render_plugin', ''),
+        ('render_manager', 'auto'),
     ])),
     ('build', OrderedDict([
         ('asset_dir', 'assets/'),
         ('export_dir', 'game/assets/'),
         ('ignore_patterns', '*.blend1, *.blend2'),
+        ('hooks', ''),
+        ('texture_preset', 'desktop'),
+        ('texture_extensions', '.png, .jpg, .tga, .dds'),
+        ('cache_dir', '.pman-cache/'),
+        ('pack', False),
     ])),
     ('run', OrderedDict([
         ('main_file', 'game/main.py'),
@@ -71,6 +76,53 @@ def __py2_read_dict(config, d):
         for option, value in options.items():
             config.set(section, option, value)
 
+
+# Configs are cached per file for the whole process and re-read once the file
+# changes on disk, so everything asking for the project config shares one object
+_config_cache = {}
+# Start directories already searched, mapped to the config file that was found
+_config_paths = {}
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+def _find_config(startdir, conf_name):
+    # One stat per directory on the way up instead of listing each of them
+    cdir = startdir
+    while True:
+        configpath = os.path.join(cdir, conf_name)
+        if os.path.isfile(configpath):
+            return configpath
+
+        parent = os.path.dirname(cdir)
+        if parent == cdir:
+            # No config found
+            raise NoConfigError("Could not find config file")
+        cdir = parent
+
+
+def _nearer_config(startdir, configpath, conf_name):
+    # A config created since the lookup, between the start directory and the
+    # one found, takes over from it. Starting in the project directory this
+    # costs nothing, deeper down one stat per directory in between
+    configdir = os.path.dirname(configpath)
+    cdir = startdir
+    while cdir != configdir:
+        if os.path.isfile(os.path.join(cdir, conf_name)):
+            return True
+        parent = os.path.dirname(cdir)
+        if parent == cdir:
+            return True
+        cdir = parent
+    return False
+
+
 def _get_config(startdir, conf_name, defaults):
     try:
         if startdir is None:
@@ -79,27 +131,34 @@ def _get_config(startdir, conf_name, defaults):
         # The project folder was deleted on us
         raise NoConfigError("Could not find config file")
 
-    dirs = os.path.abspath(startdir).split(os.sep)
-
-    while dirs:
-        cdir = os.sep.join(dirs)
-        if cdir.strip() and conf_name in os.listdir(cdir):
-            configpath = os.path.join(cdir, conf_name)
-            config = configparser.ConfigParser()
-            if hasattr(config, 'read_dict'):
-                config.read_dict(defaults)
-            else:
-                __py2_read_dict(config, defaults)
-            config.read(configpath)
+    startdir = os.path.abspath(startdir)
+    configpath = _config_paths.get((startdir, conf_name))
+    stat_key = _stat_key(configpath) if configpath is not None else None
+    if stat_key is None or _nearer_config(startdir, configpath, conf_name):
+        configpath = _find_config(startdir, conf_name)
+        stat_key = _stat_key(configpath)
+        _config_paths[(startdir, conf_name)] = configpath
+
+    cached = _config_cache.get(configpath)
+    if cached is not None and cached[0] == stat_key:
+        return cached[1]
+
+    config = configparser.ConfigParser()
+    if hasattr(config, 'read_dict'):
+        config.read_dict(defaults)
+    else:
+        __py2_read_dict(config, defaults)
+    config.read(configpath)
 
-            config.add_section('internal')
-            config.set('internal', 'projectdir', os.path.dirname(configpath))
-            return config
+    config.add_section('internal')
+    config.set('internal', 'projectdir', os.path.dirname(configpath))
+    _config_cache[configpath] = (stat_key, config)
+    return config
 
-        dirs.pop()
 
-    # No config found
-    raise NoConfigError("Could not find config file")
+def clear_config_cache():
+    _config_cache.clear()
+    _config_paths.clear()
 
 
 def get_config(startdir=None):
@@ -125,8 +184,11 @@ def _write_config(config, conf_name):
     writecfg.read_dict(config)
     writecfg.remove_section('internal')
 
-    with open(os.path.join(config.get('internal', 'projectdir'), conf_name), 'w') as f:
+    configpath = os.path.join(config.get('internal', 'projectdir'), conf_name)
+    with open(configpath, 'w') as f:
         writecfg.write(f)
+    # What was written is what is in memory, so callers keep sharing this object
+    _config_cache[configpath] = (_stat_key(configpath), config)
 
 
 def write_config(config):
@@ -142,6 +204,8 @@ def is_frozen():
 
 
 def get_python_program(config):
+    import subprocess
+
     python_programs = [
         'ppython',
         'python3',
@@ -170,6 +234,8 @@ def get_python_program(config):
 
 
 def create_project(projectdir):
+    import shutil
+
     if is_frozen():
         raise FrozenEnvironmentError()
 
@@ -241,6 +307,72 @@ def create_project(projectdir):
         print("\t\t{} created at {}".format(bname, cfdst))
 
 
+class DependencyGraph:
+    # Records what each exported asset was built from (its source plus linked
+    # libraries and images), so a change to any of them rebuilds it
+    def __init__(self, path):
+        self.path = path
+        self.outputs = {}
+        if os.path.exists(path):
+            import json
+            with open(path) as f:
+                self.outputs = json.load(f).get('outputs', {})
+        self._by_source = {entry['source']: entry for entry in self.outputs.values()}
+
+    def record(self, dst, src, deps, build_time):
+        entry = {
+            'source': src,
+            'stamp': _stat_key(src),
+            'deps': {dep: _stat_key(dep) for dep in deps if dep != src},
+            'time': build_time,
+        }
+        self.outputs[dst] = entry
+        self._by_source[src] = entry
+
+    def dependencies(self, dst):
+        # Libraries that were exported on their own add their dependencies too
+        deps = {}
+        pending = [self.outputs[dst]]
+        seen = set()
+        while pending:
+            entry = pending.pop()
+            for dep, stamp in entry['deps'].items():
+                if dep in seen:
+                    continue
+                seen.add(dep)
+                deps[dep] = stamp
+                if dep in self._by_source:
+                    pending.append(self._by_source[dep])
+                    deps[dep] = self._by_source[dep]['stamp']
+        return deps
+
+    def dirty_reason(self, src, dst):
+        if not os.path.exists(dst):
+            return "output is missing"
+        if dst not in self.outputs:
+            return "no recorded dependencies"
+
+        entry = self.outputs[dst]
+        if _stat_key(src) != _as_stamp(entry['stamp']):
+            return "source changed"
+        for dep, stamp in sorted(self.dependencies(dst).items()):
+            if _stat_key(dep) != _as_stamp(stamp):
+                return "dependency changed: {}".format(dep)
+        return None
+
+    def save(self):
+        import json
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            json.dump({'outputs': self.outputs}, f, indent=1, sort_keys=True)
+
+
+def _as_stamp(stamp):
+    # JSON turns the (mtime, size) tuples into lists
+    return tuple(stamp) if stamp is not None else None
+
+
 def get_abs_path(config, path):
     return os.path.join(
         config.get('internal', 'projectdir'),
@@ -252,7 +384,12 @@ def get_rel_path(config, path):
     return os.path.relpath(path, config.get('internal', 'projectdir'))
 
 
-def build(config=None):
+def build(config=None, explain=False):
+    import fnmatch
+    import json
+    import shutil
+    import subprocess
+
     if is_frozen():
         raise FrozenEnvironmentError()
 
@@ -282,7 +419,18 @@ def build(config=None):
     ignore_patterns = [i.strip() for i in config.get('build', 'ignore_patterns').split(',')]
     print("Ignoring file patterns: {}".format(ignore_patterns))
 
-    num_blends = 0
+    # Images also get a .txo with mipmaps next to their copy, see textures.py
+    texture_preset = config.get('build', 'texture_preset')
+    texture_extensions = tuple(i.strip() for i in config.get('build', 'texture_extensions').split(',') if i.strip())
+    texture_jobs = []
+
+    clock = time.perf_counter if hasattr(time, 'perf_counter') else time.time
+    cachedir = get_abs_path(config, config.get('build', 'cache_dir'))
+    graph = DependencyGraph(os.path.join(cachedir, 'deps.json'))
+    # (asset, why it was rebuilt, seconds) for every asset this build touched
+    report = []
+
+    blend_jobs = {}
     for root, dirs, files in os.walk(srcdir):
         for asset in files:
             src = os.path.join(root, asset)
@@ -300,20 +448,43 @@ def build(config=None):
             if asset.endswith('.blend'):
                 dst = dst.replace('.blend', '.bam')
 
-            if os.path.exists(dst) and os.stat(src).st_mtime <= os.stat(dst).st_mtime:
+            if texture_preset and asset.lower().endswith(texture_extensions):
+                txo = os.path.splitext(dst)[0] + '.txo'
+                if not os.path.exists(txo) or os.stat(src).st_mtime > os.stat(txo).st_mtime:
+                    texture_jobs.append(src)
+
+            if asset.endswith('.blend'):
+                reason = graph.dirty_reason(src, dst)
+            elif not os.path.exists(dst):
+                reason = "output is missing"
+            elif os.stat(src).st_mtime > os.stat(dst).st_mtime:
+                reason = "source changed"
+            else:
+                reason = None
+
+            if reason is None:
                 print('Skip building up-to-date file: {}'.format(dst))
                 continue
 
             if asset.endswith('.blend'):
                 # Handle with Blender
-                num_blends += 1
+                blend_jobs[src] = (dst, reason)
             else:
                 print('Copying non-blend file from "{}" to "{}"'.format(src, dst))
+                copy_stime = clock()
                 if not os.path.exists(os.path.dirname(dst)):
                     os.makedirs(os.path.dirname(dst))
                 shutil.copyfile(src, dst)
+                report.append((src, reason, clock() - copy_stime))
+
+    if blend_jobs:
+        # Blender exports exactly these files and writes back what each depended on
+        jobfile = os.path.join(cachedir, 'blender_jobs.json')
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        with open(jobfile, 'w') as f:
+            json.dump({'assets': {src: dst for src, (dst, _) in blend_jobs.items()}}, f)
 
-    if num_blends > 0:
         blender_path = user_config.get('blender', 'last_path') if user_config.getboolean('blender', 'use_last_path') else 'blender'
         args = [
             blender_path,
@@ -323,20 +494,79 @@ def build(config=None):
             '--',
             srcdir,
             dstdir,
+            jobfile,
         ]
 
         #print("Calling blender: {}".format(' '.join(args)))
 
         subprocess.call(args, env=os.environ.copy())
 
+        with open(jobfile) as f:
+            results = json.load(f).get('results', {})
+        for src, (dst, reason) in sorted(blend_jobs.items()):
+            if src not in results:
+                print("Blender did not export {}".format(src))
+                continue
+            graph.record(dst, src, results[src]['deps'], results[src]['time'])
+            report.append((src, reason, results[src]['time']))
+        graph.save()
+
+    pyprog = None
+    if texture_preset and (texture_jobs or blend_jobs):
+        pyprog = get_python_program(config)
+        args = [
+            pyprog,
+            os.path.join(os.path.dirname(__file__), 'textures.py'),
+            srcdir,
+            dstdir,
+            os.path.join(get_abs_path(config, config.get('build', 'cache_dir')), 'textures'),
+            texture_preset,
+        ] + texture_jobs
+        if subprocess.call(args, env=os.environ.copy()) != 0:
+            raise BuildError("Texture stage failed")
+
+    # Post-build hooks are scripts that get the same source and export directories
+    hooks = [i.strip() for i in config.get('build', 'hooks').split(',') if i.strip()]
+    if hooks:
+        pyprog = pyprog or get_python_program(config)
+        for hook in hooks:
+            print("Running build hook: {}".format(hook))
+            args = [
+                pyprog,
+                get_abs_path(config, hook),
+                srcdir,
+                dstdir,
+            ]
+            if subprocess.call(args, env=os.environ.copy()) != 0:
+                raise BuildError("Build hook failed: {}".format(hook))
+
+    # Shipped builds read everything from one pack next to the export directory
+    if config.getboolean('build', 'pack'):
+        args = [
+            pyprog or get_python_program(config),
+            os.path.join(os.path.dirname(__file__), 'pack.py'),
+            srcdir,
+            dstdir,
+            os.path.normpath(dstdir) + '.mf',
+        ]
+        if subprocess.call(args, env=os.environ.copy()) != 0:
+            raise BuildError("Packing assets failed")
+
     if hasattr(time, 'perf_counter'):
         etime = time.perf_counter()
     else:
         etime = time.time()
+
+    if explain:
+        print("Rebuilt {} assets:".format(len(report)))
+        for src, reason, build_time in sorted(report, key=lambda i: -i[2]):
+            print("\t{:8.3f}s  {}  ({})".format(build_time, get_rel_path(config, src), reason))
     print("Build took {:.4f}s".format(etime - stime))
 
 
 def run(config=None):
+    import subprocess
+
     if is_frozen():
         raise FrozenEnvironmentError()
 
@@ -351,3 +581,17 @@ def run(config=None):
     args = [get_python_program(config), mainfile]
     #print("Args: {}".format(args))
     subprocess.Popen(args, cwd=config.get('internal', 'projectdir'))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build or run the project in the current directory')
+    parser.add_argument('command', choices=['build', 'run'])
+    parser.add_argument('--explain', action='store_true', help='report why each asset was rebuilt and how long it took')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(explain=args.explain)
+    else:
+        run()
@@ -1,6 +1,7 @@
 import sys
 import os
-import shutil
+import json
+import time
 
 import bpy
 import addon_utils
@@ -9,29 +10,42 @@ import addon_utils
 addon_utils.enable("BlenderPanda", persistent=True)
 
 #print(sys.argv)
-srcdir, dstdir = sys.argv[-2:]
+srcdir, dstdir, jobfile = sys.argv[-3:]
 
 #print('Exporting:', srcdir)
 #print('Export to:', dstdir)
 
-for root, dirs, files in os.walk(srcdir):
-    for asset in files:
-        src = os.path.join(root, asset)
-        dst = src.replace(srcdir, dstdir).replace('.blend', '.bam')
-
-        if not asset.endswith('.blend'):
-            # Only convert blend files with pman_build stub
-            continue
-
-        if os.path.exists(dst) and os.stat(src).st_mtime <= os.stat(dst).st_mtime:
-            # Don't convert up-to-date-files
-            continue
-
-        if asset.endswith('.blend'):
-            print('Converting .blend file ({}) to .bam ({})'.format(src, dst))
-            try:
-                os.makedirs(os.path.dirname(dst))
-            except FileExistsError:
-                pass
-            bpy.ops.wm.open_mainfile(filepath=src)
-            bpy.ops.panda_engine.export_bam(filepath=dst, copy_images=False, skip_up_to_date=True)
+
+def collect_dependencies():
+    # Linked libraries (including indirect ones) and every image read from disk
+    deps = set()
+    for lib in bpy.data.libraries:
+        deps.add(os.path.normpath(bpy.path.abspath(lib.filepath, library=lib.library)))
+    for image in bpy.data.images:
+        if image.source in {'FILE', 'SEQUENCE', 'MOVIE'} and image.packed_file is None:
+            deps.add(os.path.normpath(bpy.path.abspath(image.filepath, library=image.library)))
+    return sorted(deps)
+
+
+# pman has already decided what is out of date, see DependencyGraph
+with open(jobfile) as f:
+    jobs = json.load(f)
+
+results = {}
+for src, dst in sorted(jobs['assets'].items()):
+    print('Converting .blend file ({}) to .bam ({})'.format(src, dst))
+    stime = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(dst))
+    except FileExistsError:
+        pass
+    bpy.ops.wm.open_mainfile(filepath=src)
+    bpy.ops.panda_engine.export_bam(filepath=dst, copy_images=False, skip_up_to_date=False)
+    results[src] = {
+        'deps': collect_dependencies(),
+        'time': time.perf_counter() - stime,
+    }
+
+jobs['results'] = results
+with open(jobfile, 'w') as f:
+    json.dump(jobs, f)
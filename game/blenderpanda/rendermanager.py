@@ -1,9 +1,14 @@
+import os
+import sys
+
 try:
-    from importlib.machinery import SourceFileLoader
-    HAS_SFL = True
+    import importlib.util
+    HAS_IMPORTLIB = hasattr(importlib.util, 'module_from_spec')
 except ImportError:
+    HAS_IMPORTLIB = False
+
+if not HAS_IMPORTLIB:
     import imp
-    HAS_SFL = False
 
 try:
     import pman
@@ -22,6 +27,77 @@ class BasicRenderManager:
         self.base.render.set_shader_auto()
 
 
+# Opt-in with render_manager = precompiled. The permutations don't cover
+# fog, shadows or more than MAX_LIGHTS lights the way the auto shader does
+class PrecompiledRenderManager(BasicRenderManager):
+    def __init__(self, base, config):
+        import panda3d.core as p3d
+        try:
+            from . import shaders
+        except ImportError:
+            import blenderpanda.shaders as shaders
+
+        # The auto shader stays on render for anything the cache missed
+        super().__init__(base)
+
+        self.shaders = {}
+        self.models = {}
+
+        dstdir = pman.get_abs_path(config, config.get('build', 'export_dir'))
+        cache = shaders.load_cache(os.path.join(dstdir, shaders.CACHE_NAME))
+        if cache is None:
+            print("RenderManager: No shader cache in {}, using auto shaders".format(dstdir))
+            return
+
+        for name, permutation in cache['permutations'].items():
+            self.shaders[name] = p3d.Shader.make(
+                p3d.Shader.SL_GLSL,
+                permutation['vertex'],
+                permutation['fragment']
+            )
+
+        # Shaders go on the pooled models, so every copy handed out by the
+        # loader already has them
+        for model, names in cache['models'].items():
+            root = p3d.ModelPool.load_model(p3d.Filename.from_os_specific(os.path.join(dstdir, model)))
+            if root is None:
+                continue
+            root = p3d.NodePath(root)
+            for geomnp in root.find_all_matches('**/+GeomNode'):
+                if geomnp.node().get_num_geoms() == 0:
+                    continue
+                name = shaders.permutation_name(shaders.node_features(geomnp))
+                if name in self.shaders:
+                    geomnp.set_shader(self.shaders[name])
+            self.models[model] = root
+
+        self.prepare()
+
+    def prepare(self):
+        gsg = self.base.win.get_gsg() if self.base.win is not None else None
+        if gsg is None:
+            return
+
+        prepared_objects = gsg.get_prepared_objects()
+        for shader in self.shaders.values():
+            shader.prepare_now(prepared_objects, gsg)
+
+
+def _load_plugin(path):
+    if 'render_plugin' in sys.modules:
+        return sys.modules['render_plugin']
+
+    if HAS_IMPORTLIB:
+        spec = importlib.util.spec_from_file_location("render_plugin", path)
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        sys.modules['render_plugin'] = mod
+    else:
+        mod = imp.load_source("render_plugin", path)
+
+    return mod
+
+
 def create_render_manager(base, config=None):
     if config is None:
         try:
@@ -30,17 +106,14 @@ def create_render_manager(base, config=None):
             print("RenderManager: Could not find pman config, falling back to basic plugin")
             config = None
 
+    manager = config.get('general', 'render_manager') if config else 'basic'
     renderplugin = config.get('general', 'render_plugin') if config else ''
 
-    if not renderplugin:
+    if manager == 'precompiled':
+        return PrecompiledRenderManager(base, config)
+
+    if manager == 'basic' or not renderplugin:
         return BasicRenderManager(base)
 
     path = pman.get_abs_path(config, renderplugin)
-
-    if HAS_SFL:
-        mod = SourceFileLoader("render_plugin", path).load_module()
-    else:
-        mod = imp.load_source("render_plugin", path)
-
-    return mod.get_plugin()(base)
-
+    return _load_plugin(path).get_plugin()(base)
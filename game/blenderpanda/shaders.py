@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# Shader permutations for the precompiled render manager. Also a pman build
+# hook: run as a script it scans the exported models and writes the cache,
+# when the project has render_manager = precompiled.
+import hashlib
+import json
+import os
+import sys
+
+import panda3d.core as p3d
+
+
+CACHE_NAME = 'shaders.cache'
+CACHE_VERSION = 2
+MAX_LIGHTS = 4
+
+
+VERTEX_TEMPLATE = """
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelViewMatrix;
+uniform mat3 p3d_NormalMatrix;
+
+attribute vec4 p3d_Vertex;
+attribute vec3 p3d_Normal;
+varying vec3 view_position;
+varying vec3 view_normal;
+
+#ifdef HAS_TEXTURE
+attribute vec2 p3d_MultiTexCoord0;
+varying vec2 texcoord;
+#endif
+
+#ifdef HAS_NORMAL_MAP
+attribute vec3 p3d_Tangent;
+attribute vec3 p3d_Binormal;
+varying vec3 view_tangent;
+varying vec3 view_binormal;
+#endif
+
+#ifdef HAS_VERTEX_COLOR
+attribute vec4 p3d_Color;
+varying vec4 vertex_color;
+#endif
+
+void main() {
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+    view_position = (p3d_ModelViewMatrix * p3d_Vertex).xyz;
+    view_normal = normalize(p3d_NormalMatrix * p3d_Normal);
+
+#ifdef HAS_TEXTURE
+    texcoord = p3d_MultiTexCoord0;
+#endif
+
+#ifdef HAS_NORMAL_MAP
+    view_tangent = normalize(p3d_NormalMatrix * p3d_Tangent);
+    view_binormal = normalize(p3d_NormalMatrix * p3d_Binormal);
+#endif
+
+#ifdef HAS_VERTEX_COLOR
+    vertex_color = p3d_Color;
+#endif
+}
+"""
+
+
+FRAGMENT_TEMPLATE = """
+uniform vec4 p3d_ColorScale;
+
+uniform struct {
+    vec4 ambient;
+    vec4 diffuse;
+    vec4 emission;
+    vec3 specular;
+    float shininess;
+} p3d_Material;
+
+varying vec3 view_position;
+varying vec3 view_normal;
+
+#ifdef HAS_LIGHTING
+uniform struct {
+    vec4 ambient;
+} p3d_LightModel;
+
+uniform struct {
+    vec4 color;
+    vec4 position;
+    vec3 spotDirection;
+    float spotCosCutoff;
+    float spotExponent;
+    vec3 attenuation;
+} p3d_LightSource[MAX_LIGHTS];
+#endif
+
+#ifdef HAS_TEXTURE
+uniform sampler2D p3d_Texture0;
+varying vec2 texcoord;
+#endif
+
+#ifdef HAS_NORMAL_MAP
+uniform sampler2D p3d_Texture1;
+varying vec3 view_tangent;
+varying vec3 view_binormal;
+#endif
+
+#ifdef HAS_VERTEX_COLOR
+varying vec4 vertex_color;
+#endif
+
+void main() {
+    vec4 base_color = p3d_Material.diffuse * p3d_ColorScale;
+#ifdef HAS_TEXTURE
+    base_color *= texture2D(p3d_Texture0, texcoord);
+#endif
+#ifdef HAS_VERTEX_COLOR
+    base_color *= vertex_color;
+#endif
+
+#ifdef HAS_LIGHTING
+    vec3 normal = normalize(view_normal);
+#ifdef HAS_NORMAL_MAP
+    vec3 mapped = texture2D(p3d_Texture1, texcoord).xyz * 2.0 - 1.0;
+    normal = normalize(view_tangent * mapped.x + view_binormal * mapped.y + normal * mapped.z);
+#endif
+
+    vec3 eye = normalize(-view_position);
+    vec3 color = p3d_LightModel.ambient.rgb * p3d_Material.ambient.rgb * base_color.rgb + p3d_Material.emission.rgb;
+    for (int i = 0; i < MAX_LIGHTS; ++i) {
+        vec3 to_light = p3d_LightSource[i].position.xyz - view_position * p3d_LightSource[i].position.w;
+        float dist = length(to_light);
+        to_light /= max(dist, 0.0001);
+
+        vec3 attenuation = p3d_LightSource[i].attenuation;
+        float falloff = 1.0 / max(attenuation.x + attenuation.y * dist + attenuation.z * dist * dist, 0.0001);
+        float spot = dot(normalize(p3d_LightSource[i].spotDirection), -to_light);
+        if (p3d_LightSource[i].spotCosCutoff > -1.0) {
+            falloff *= spot < p3d_LightSource[i].spotCosCutoff ? 0.0 : pow(spot, p3d_LightSource[i].spotExponent);
+        }
+
+        float diffuse = max(dot(normal, to_light), 0.0);
+        float specular = diffuse > 0.0 ? pow(max(dot(normal, normalize(to_light + eye)), 0.0), max(p3d_Material.shininess, 1.0)) : 0.0;
+        color += p3d_LightSource[i].color.rgb * falloff * (base_color.rgb * diffuse + p3d_Material.specular * specular);
+    }
+    gl_FragColor = vec4(color, base_color.a);
+#else
+    gl_FragColor = base_color;
+#endif
+}
+"""
+
+
+def template_hash():
+    data = (VERTEX_TEMPLATE + FRAGMENT_TEMPLATE + str(MAX_LIGHTS)).encode('utf8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def permutation_name(features):
+    return '+'.join(sorted(features)) if features else 'unlit'
+
+
+def generate_source(features):
+    defines = ['#version 120', '#define MAX_LIGHTS {}'.format(MAX_LIGHTS)]
+    defines.extend('#define HAS_{}'.format(feature.upper()) for feature in sorted(features))
+    header = '\n'.join(defines) + '\n'
+    return header + VERTEX_TEMPLATE, header + FRAGMENT_TEMPLATE
+
+
+def geom_features(geom, state):
+    # Scene lights are only applied once a model is placed at runtime, so
+    # every permutation is lit. With no lights on, Panda hands the shader a
+    # white ambient light and black light sources, which gives the unlit colors
+    features = {'lighting'}
+    fmt = geom.get_vertex_data().get_format()
+
+    texattrib = state.get_attrib(p3d.TextureAttrib)
+    num_textures = texattrib.get_num_on_stages() if texattrib is not None else 0
+    if num_textures > 0 and fmt.has_column(p3d.InternalName.get_texcoord()):
+        features.add('texture')
+        if num_textures > 1 and fmt.has_column(p3d.InternalName.get_tangent()):
+            features.add('normal_map')
+
+    colorattrib = state.get_attrib(p3d.ColorAttrib)
+    if fmt.has_column(p3d.InternalName.get_color()) and (
+        colorattrib is None or colorattrib.get_color_type() == p3d.ColorAttrib.T_vertex
+    ):
+        features.add('vertex_color')
+
+    return frozenset(features)
+
+
+def node_features(geomnp):
+    # All geoms of a node share one shader, so the node gets the union of their features
+    node = geomnp.node()
+    net_state = geomnp.get_net_state()
+
+    features = set()
+    for idx in range(node.get_num_geoms()):
+        state = net_state.compose(node.get_geom_state(idx))
+        features |= geom_features(node.get_geom(idx), state)
+    return frozenset(features)
+
+
+def enumerate_permutations(nodepath):
+    return {
+        node_features(geomnp)
+        for geomnp in nodepath.find_all_matches('**/+GeomNode')
+        if geomnp.node().get_num_geoms() > 0
+    }
+
+
+def load_cache(path):
+    # Read through the VFS, so the cache can come from a mounted pack
+    vfs = p3d.VirtualFileSystem.get_global_ptr()
+    filename = p3d.Filename.from_os_specific(path)
+    if not vfs.exists(filename):
+        return None
+    try:
+        cache = json.loads(vfs.read_file(filename, True).decode('utf8'))
+    except ValueError:
+        return None
+
+    if cache.get('version') != CACHE_VERSION or cache.get('template') != template_hash():
+        return None
+    return cache
+
+
+def build_cache(dstdir):
+    cache_path = os.path.join(dstdir, CACHE_NAME)
+    models = []
+    for root, dirs, files in os.walk(dstdir):
+        models.extend(os.path.join(root, i) for i in files if i.endswith('.bam'))
+
+    cache = load_cache(cache_path)
+    if cache is not None and all(
+        os.stat(model).st_mtime <= os.stat(cache_path).st_mtime for model in models
+    ) and len(cache['models']) == len(models):
+        return cache
+
+    loader = p3d.Loader.get_global_ptr()
+    permutations = {}
+    model_permutations = {}
+    for model in sorted(models):
+        node = loader.load_sync(p3d.Filename.from_os_specific(model))
+        if node is None:
+            continue
+
+        names = []
+        for features in enumerate_permutations(p3d.NodePath(node)):
+            name = permutation_name(features)
+            if name not in permutations:
+                vertex, fragment = generate_source(features)
+                permutations[name] = {
+                    'features': sorted(features),
+                    'vertex': vertex,
+                    'fragment': fragment,
+                }
+            names.append(name)
+        model_permutations[os.path.relpath(model, dstdir).replace(os.sep, '/')] = sorted(names)
+
+    cache = {
+        'version': CACHE_VERSION,
+        'template': template_hash(),
+        'permutations': permutations,
+        'models': model_permutations,
+    }
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+
+    print('Cached {} shader permutations for {} models'.format(len(permutations), len(model_permutations)))
+    return cache
+
+
+def main(args):
+    srcdir, dstdir = args[-2:]
+
+    # Only the precompiled render manager reads the cache, and it is opt-in
+    import pman
+    manager = pman.get_config(srcdir).get('general', 'render_manager')
+    if manager != 'precompiled':
+        cache_path = os.path.join(dstdir, CACHE_NAME)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        print('Skipping shader permutations for render_manager = {}'.format(manager))
+        return
+    build_cache(dstdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
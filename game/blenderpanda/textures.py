@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Texture stage for pman.build: converts images from the asset directory into
+# .txo files with their mipmaps already generated, then points exported models
+# at them. Run as a script with the source and export directories.
+import concurrent.futures
+import hashlib
+import os
+import shutil
+import sys
+
+import panda3d.core as p3d
+
+
+STAGE_VERSION = 1
+TXO_SUFFIX = '.txo'
+
+# (largest dimension, compression) per preset, a size of 0 keeps the source size
+PRESETS = {
+    'desktop': (0, None),
+    'compressed': (0, 'dxt'),
+    'low': (512, 'dxt'),
+}
+
+# Panda resizes textures to match its runtime config when reading them, so the
+# stage has to read them the way the game will
+p3d.load_prc_file_data('textures', 'textures-power-2 none')
+
+
+def _compression(name, num_components):
+    if name is None:
+        return p3d.Texture.CM_off
+    if name == 'dxt':
+        return p3d.Texture.CM_dxt5 if num_components == 4 else p3d.Texture.CM_dxt1
+    return p3d.Texture.CM_default
+
+
+def content_hash(src, preset):
+    digest = hashlib.sha1()
+    digest.update('{}:{}:{}'.format(STAGE_VERSION, preset, PRESETS[preset]).encode('utf8'))
+    with open(src, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def convert_texture(src, dst, preset='desktop'):
+    max_size, compression = PRESETS[preset]
+
+    tex = p3d.Texture(os.path.basename(src))
+    if not tex.read(p3d.Filename.from_os_specific(src)):
+        raise IOError('Could not read texture {}'.format(src))
+
+    # Already compressed images (DDS) are kept as they are
+    if tex.get_ram_image_compression() == p3d.Texture.CM_off:
+        if max_size and max(tex.get_x_size(), tex.get_y_size()) > max_size:
+            scale = max_size / max(tex.get_x_size(), tex.get_y_size())
+            image = p3d.PNMImage()
+            tex.store(image)
+            scaled = p3d.PNMImage(
+                max(int(image.get_x_size() * scale), 1),
+                max(int(image.get_y_size() * scale), 1),
+                image.get_num_channels(),
+                image.get_maxval()
+            )
+            scaled.gaussian_filter_from(1.0, image)
+            tex.load(scaled)
+
+        tex.set_minfilter(p3d.SamplerState.FT_linear_mipmap_linear)
+        tex.generate_ram_mipmap_images()
+
+        mode = _compression(compression, tex.get_num_components())
+        if mode != p3d.Texture.CM_off and not tex.compress_ram_image(mode):
+            print('Could not compress {}, keeping it uncompressed'.format(src))
+
+    tex.set_filename(p3d.Filename(os.path.basename(dst)))
+    if not tex.write(p3d.Filename.from_os_specific(dst)):
+        raise IOError('Could not write texture {}'.format(dst))
+
+
+def _convert_job(src, dst, preset, cachedir):
+    key = content_hash(src, preset)
+    cached = os.path.join(cachedir, key + TXO_SUFFIX)
+    if os.path.exists(cached):
+        shutil.copyfile(cached, dst)
+        return src, 'cached'
+
+    # Images Panda can't read keep only their raw copy
+    try:
+        convert_texture(src, dst, preset)
+    except IOError as e:
+        print('Skipping texture: {}'.format(e))
+        return src, 'skipped'
+
+    shutil.copyfile(dst, cached + '.tmp')
+    os.replace(cached + '.tmp', cached)
+    return src, 'converted'
+
+
+def build_textures(jobs, cachedir, preset='desktop', workers=None):
+    # jobs is a list of (source image, destination .txo)
+    results = {'converted': 0, 'cached': 0, 'skipped': 0}
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(_convert_job, src, dst, preset, cachedir) for src, dst in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            src, result = future.result()
+            results[result] += 1
+            if result == 'converted':
+                print('Converted texture {}'.format(src))
+    return results
+
+
+def remap_model_textures(dstdir, since=0):
+    # Models are exported pointing at the raw images, swap in the .txo next to them
+    for root, dirs, files in os.walk(dstdir):
+        for asset in files:
+            path = os.path.join(root, asset)
+            if not asset.endswith('.bam') or os.stat(path).st_mtime <= since:
+                continue
+
+            node = p3d.Loader.get_global_ptr().load_sync(p3d.Filename.from_os_specific(path))
+            if node is None:
+                continue
+
+            model = p3d.NodePath(node)
+            changed = False
+            for tex in model.find_all_textures():
+                filename = tex.get_fullpath()
+                if filename.get_extension() == TXO_SUFFIX[1:]:
+                    continue
+                txo = p3d.Filename(filename)
+                txo.set_extension(TXO_SUFFIX[1:])
+                if not os.path.exists(txo.to_os_specific()):
+                    continue
+
+                new_tex = p3d.TexturePool.load_texture(txo)
+                if new_tex is not None:
+                    # Keep the exported sampler, but make use of the stored mipmaps
+                    sampler = p3d.SamplerState(tex.get_default_sampler())
+                    if not p3d.SamplerState.is_mipmap(sampler.get_effective_minfilter()):
+                        sampler.set_minfilter(p3d.SamplerState.FT_linear_mipmap_linear)
+                    new_tex.set_default_sampler(sampler)
+                    model.replace_texture(tex, new_tex)
+                    changed = True
+
+            if changed:
+                model.write_bam_file(p3d.Filename.from_os_specific(path))
+                print('Pointed {} at .txo textures'.format(asset))
+
+
+def main(args):
+    srcdir, dstdir, cachedir, preset = args[:4]
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    jobs = [(src, os.path.splitext(src.replace(srcdir, dstdir))[0] + TXO_SUFFIX) for src in args[4:]]
+    if jobs:
+        results = build_textures(jobs, cachedir, preset)
+        print('Built {} textures ({} from cache, {} skipped)'.format(
+            results['converted'] + results['cached'],
+            results['cached'],
+            results['skipped']
+        ))
+
+    # Only models exported since the last run can still point at raw images
+    stamp = os.path.join(cachedir, 'remap.stamp')
+    since = os.stat(stamp).st_mtime if os.path.exists(stamp) else 0
+    remap_model_textures(dstdir, since)
+    with open(stamp, 'w'):
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,236 @@
+import collections
+
+from direct.showbase.DirectObject import DirectObject
+from panda3d import core as p3d
+
+
+ActionFrame = collections.namedtuple('ActionFrame', [
+    'move_x',
+    'move_y',
+    'pressed',
+    'held',
+])
+
+
+class ActionMapError(Exception):
+    pass
+
+
+_KINDS = [
+    'axis',
+    'button',
+    'chord',
+    'gamepad-axis',
+    'gamepad-button',
+]
+
+
+def parse_bindings(lines, path='<bindings>'):
+    bindings = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+
+        lhs, sep, rhs = line.partition('=')
+        lhs = lhs.split()
+        if not sep or len(lhs) != 2 or lhs[0] not in _KINDS or not rhs.split():
+            raise ActionMapError('{}:{}: expected "<{}> <name> = <inputs>"'.format(path, lineno, '|'.join(_KINDS)))
+
+        kind, name = lhs
+        if kind == 'chord':
+            sources = [i.strip() for i in rhs.split('+')]
+        else:
+            sources = rhs.split()
+        bindings.append((kind, name, sources))
+
+    return bindings
+
+
+def load_bindings(path):
+    with open(path) as f:
+        return parse_bindings(f, path)
+
+
+class ActionMap(DirectObject):
+    def __init__(self, bindings, dead_zone=0.15):
+        self.dead_zone = dead_zone
+        self.axes = []
+        self.buttons = []
+        self.event_time = None
+
+        self._inputs = {}
+        self._axis_deltas = collections.defaultdict(list)
+        self._button_masks = collections.defaultdict(int)
+        self._chords = []
+        self._gamepad_axes = []
+        self._gamepad_buttons = {}
+        self._gamepads = []
+
+        self._compile(bindings)
+
+        self._digital = [0.0] * len(self.axes)
+        self._down = 0
+        self._pressed = 0
+        self._pad_down = {}
+
+        # One handler per input event, looked up in the precompiled table
+        self.table = {}
+        for name, bit in self._inputs.items():
+            entry = (tuple(self._axis_deltas[name]), self._button_masks[name], bit)
+            self.table[name] = entry
+            if not name.startswith('gamepad:'):
+                self.accept(name, self.press, [entry])
+                self.accept(name + '-up', self.release, [entry])
+
+        if hasattr(p3d, 'InputDevice') and self._uses_gamepad():
+            self.accept('connect-device', self._connect_device)
+            self.accept('disconnect-device', self._disconnect_device)
+            for device in base.devices.get_devices(p3d.InputDevice.DeviceClass.gamepad):
+                self._connect_device(device)
+
+    @classmethod
+    def from_file(cls, path, dead_zone=0.15):
+        return cls(load_bindings(path), dead_zone)
+
+    def _input_bit(self, name):
+        if name not in self._inputs:
+            self._inputs[name] = 1 << len(self._inputs)
+        return self._inputs[name]
+
+    def _axis_index(self, name):
+        if name not in self.axes:
+            self.axes.append(name)
+        return self.axes.index(name)
+
+    def _button_bit(self, name):
+        if name not in self.buttons:
+            self.buttons.append(name)
+        return 1 << self.buttons.index(name)
+
+    def _compile(self, bindings):
+        for kind, name, sources in bindings:
+            if kind == 'axis':
+                index = self._axis_index(name)
+                for source in sources:
+                    sign = -1.0 if source.startswith('-') else 1.0
+                    source = source.lstrip('+-')
+                    self._input_bit(source)
+                    self._axis_deltas[source].append((index, sign))
+            elif kind == 'button':
+                bit = self._button_bit(name)
+                for source in sources:
+                    self._input_bit(source)
+                    self._button_masks[source] |= bit
+            elif kind == 'chord':
+                mask = 0
+                for source in sources:
+                    mask |= self._input_bit(source)
+                self._chords.append((mask, self._button_bit(name)))
+            elif kind == 'gamepad-axis':
+                index = self._axis_index(name)
+                for source in sources:
+                    sign = -1.0 if source.startswith('-') else 1.0
+                    self._gamepad_axes.append((index, sign, source.lstrip('+-')))
+            elif kind == 'gamepad-button':
+                bit = self._button_bit(name)
+                for source in sources:
+                    key = 'gamepad:' + source
+                    self._input_bit(key)
+                    self._button_masks[key] |= bit
+                    self._gamepad_buttons[key] = source
+
+        if len(self.buttons) > 32:
+            raise ActionMapError('At most 32 buttons and chords fit in an action mask')
+
+    def _uses_gamepad(self):
+        return bool(self._gamepad_axes or self._gamepad_buttons)
+
+    def _connect_device(self, device):
+        if device.device_class == p3d.InputDevice.DeviceClass.gamepad and device not in self._gamepads:
+            self._gamepads.append(device)
+
+    def _disconnect_device(self, device):
+        if device in self._gamepads:
+            self._gamepads.remove(device)
+
+    def bit(self, name):
+        return 1 << self.buttons.index(name)
+
+    def press(self, entry):
+        axis_deltas, button_mask, bit = entry
+        if self._down & bit:
+            return
+        if self.event_time is None:
+            self.event_time = p3d.ClockObject.get_global_clock().get_real_time()
+
+        for index, value in axis_deltas:
+            self._digital[index] += value
+        self._pressed |= button_mask
+
+        # A chord triggers on the press that completes it
+        down = self._down | bit
+        for mask, chord_bit in self._chords:
+            if mask & bit and down & mask == mask:
+                self._pressed |= chord_bit
+        self._down = down
+
+    def release(self, entry):
+        axis_deltas, _, bit = entry
+        if not self._down & bit:
+            return
+        if self.event_time is None:
+            self.event_time = p3d.ClockObject.get_global_clock().get_real_time()
+
+        for index, value in axis_deltas:
+            self._digital[index] -= value
+        self._down &= ~bit
+
+    def _poll_gamepads(self, values):
+        pad_down = {}
+        for device in self._gamepads:
+            device.poll()
+            for index, sign, axis in self._gamepad_axes:
+                state = device.find_axis(getattr(p3d.InputDevice.Axis, axis))
+                if state is not None and abs(state.value) > self.dead_zone:
+                    values[index] += state.value * sign
+            for key, button in self._gamepad_buttons.items():
+                state = device.find_button(getattr(p3d.GamepadButton, button)())
+                if state is not None and state.pressed:
+                    pad_down[key] = True
+
+        # Gamepad buttons go through the same table as keyboard events
+        for key in self._gamepad_buttons:
+            if pad_down.get(key, False) != self._pad_down.get(key, False):
+                if key in pad_down:
+                    self.press(self.table[key])
+                else:
+                    self.release(self.table[key])
+        self._pad_down = pad_down
+
+    def held(self):
+        held = 0
+        for name, bit in self._inputs.items():
+            if self._down & bit:
+                held |= self._button_masks[name]
+        for mask, chord_bit in self._chords:
+            if self._down & mask == mask:
+                held |= chord_bit
+        return held
+
+    def axis(self, name, values=None):
+        values = values if values is not None else self._digital
+        value = values[self.axes.index(name)]
+        return max(min(value, 1.0), -1.0)
+
+    def sample(self):
+        values = list(self._digital)
+        if self._gamepads:
+            self._poll_gamepads(values)
+
+        move_x = self.axis('move-x', values) if 'move-x' in self.axes else 0.0
+        move_y = self.axis('move-y', values) if 'move-y' in self.axes else 0.0
+
+        frame = ActionFrame(move_x, move_y, self._pressed, self.held())
+        self._pressed = 0
+        return frame
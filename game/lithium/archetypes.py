@@ -0,0 +1,132 @@
+from bamboo import ecs
+
+
+class Join:
+    __slots__ = [
+        'typeids',
+    ]
+
+    def __init__(self, typeids):
+        self.typeids = tuple(typeids)
+
+    def select(self, components):
+        # Rows of one component per typeid, looked up through the entity of
+        # the first one every time they are asked for
+        first, rest = self.typeids[0], self.typeids[1:]
+        return [
+            (component,) + tuple(component.entity.get_component(typeid) for typeid in rest)
+            for component in components.get(first, [])
+        ]
+
+
+class Query:
+    __slots__ = [
+        'typeids',
+        'rows',
+        '_members',
+    ]
+
+    def __init__(self, typeids):
+        self.typeids = tuple(typeids)
+        self.rows = []
+        self._members = set()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def select(self, components):
+        # Always the whole table. Code that runs a system over only some
+        # components, like NetClient re-simulating the player, builds that
+        # system without an index so it joins over exactly what it is given
+        return self.rows
+
+    def _add(self, entity, entity_components):
+        if entity in self._members or any(typeid not in entity_components for typeid in self.typeids):
+            return
+        self._members.add(entity)
+        self.rows.append(tuple(entity_components[typeid] for typeid in self.typeids))
+
+    def _clear(self):
+        self.rows = []
+        self._members.clear()
+
+
+class ArchetypeIndex(ecs.System):
+    __slots__ = [
+        'component_types',
+        'queries',
+        'rebuilds',
+        '_entities',
+        '_counts',
+    ]
+
+    def __init__(self):
+        super().__init__()
+
+        # Filled in as systems ask for queries, so the manager hands this
+        # system every component type any of them joins over
+        self.component_types = []
+        self.queries = {}
+        self.rebuilds = 0
+        self._entities = {}
+        self._counts = {}
+
+    def query(self, *typeids):
+        # Systems asking for the same components share one table
+        query = self.queries.get(typeids)
+        if query is None:
+            query = Query(typeids)
+            self.queries[typeids] = query
+            for typeid in typeids:
+                if typeid not in self._counts:
+                    self.component_types.append(typeid)
+                    self._counts[typeid] = 0
+            for entity, entity_components in self._entities.items():
+                query._add(entity, entity_components)
+        return query
+
+    def init_components(self, dt, components):
+        # New components extend the tables in place
+        touched = {}
+        for typeid, added in components.items():
+            self._counts[typeid] = self._counts.get(typeid, 0) + len(added)
+            for component in added:
+                entity_components = self._entities.setdefault(component.entity, {})
+                entity_components[typeid] = component
+                touched[component.entity] = entity_components
+
+        for entity, entity_components in touched.items():
+            for query in self.queries.values():
+                query._add(entity, entity_components)
+
+    def update(self, dt, components):
+        # Removed components only show up as a shorter list, and only the
+        # tables joining over their type get rebuilt
+        changed = {
+            typeid for typeid in self.component_types
+            if len(components.get(typeid, [])) != self._counts[typeid]
+        }
+        if changed:
+            self._rebuild(components, changed)
+
+    def _rebuild(self, components, changed):
+        self.rebuilds += 1
+        self._entities = {}
+        for typeid in self.component_types:
+            self._counts[typeid] = len(components.get(typeid, []))
+            for component in components.get(typeid, []):
+                self._entities.setdefault(component.entity, {})[typeid] = component
+
+        for query in self.queries.values():
+            if changed.isdisjoint(query.typeids):
+                continue
+            query._clear()
+            for entity, entity_components in self._entities.items():
+                query._add(entity, entity_components)
+
+
+def query(index, *typeids):
+    # Systems built without an index fall back to joining every frame
+    if index is None:
+        return Join(typeids)
+    return index.query(*typeids)
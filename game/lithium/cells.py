@@ -0,0 +1,124 @@
+import collections
+
+import numpy as np
+
+from panda3d import core as p3d
+
+
+CellStats = collections.namedtuple('CellStats', [
+    'cells',
+    'visible_cells',
+    'occluded_cells',
+    'draw_calls',
+    'vertices',
+])
+
+
+def _count_geometry(nodepath):
+    draw_calls = 0
+    vertices = 0
+    for geomnp in nodepath.find_all_matches('**/+GeomNode'):
+        for geom in geomnp.node().get_geoms():
+            draw_calls += 1
+            vertices += geom.get_vertex_data().get_num_rows()
+    return draw_calls, vertices
+
+
+def _box_corners(lower, upper):
+    return np.array([
+        (x, y, z)
+        for x in (lower.x, upper.x)
+        for y in (lower.y, upper.y)
+        for z in (lower.z, upper.z)
+    ])
+
+
+def _quad_hides(eye, corners, quad):
+    # Every corner of the box has to be behind the quad as seen from the eye
+    normal = np.cross(quad[1] - quad[0], quad[2] - quad[0])
+    rays = corners - eye
+    facing = rays @ normal
+    if np.any(np.abs(facing) < 1e-9):
+        return False
+    t = ((quad[0] - eye) @ normal) / facing
+    if np.any((t <= 0) | (t >= 1)):
+        return False
+
+    hits = eye + rays * t[:, None]
+    for idx in range(4):
+        edge = quad[(idx + 1) % 4] - quad[idx]
+        side = np.cross(edge, hits - quad[idx]) @ normal
+        if np.any(side < 0):
+            return False
+    return True
+
+
+class LevelCells:
+    __slots__ = [
+        'level',
+        'cells',
+        'occluders',
+        '_levels',
+        '_corners',
+        '_quads',
+    ]
+
+    def __init__(self, level, render=None):
+        # Levels built by levelbuild.py keep their batched geometry as one
+        # LODNode per cell, which Panda switches by distance on its own
+        self.level = level
+        self.cells = list(level.find_all_matches('**/cells/+LODNode'))
+        self.occluders = list(level.find_all_matches('**/+OccluderNode'))
+        if render is not None:
+            for occluder in self.occluders:
+                render.set_occluder(occluder)
+
+        self._levels = [
+            [_count_geometry(cellnp.get_child(idx)) for idx in range(cellnp.get_num_children())]
+            for cellnp in self.cells
+        ]
+        self._corners = [_box_corners(*cellnp.get_tight_bounds(level)) for cellnp in self.cells]
+        self._quads = []
+        for occluder in self.occluders:
+            node = occluder.node()
+            mat = occluder.get_mat(level)
+            self._quads.append(np.array([tuple(mat.xform_point(node.get_vertex(idx))) for idx in range(4)]))
+
+    @property
+    def enabled(self):
+        return bool(self.cells)
+
+    def set_lod_scale(self, scale):
+        for cellnp in self.cells:
+            cellnp.node().set_lod_scale(scale)
+
+    def stats(self, camera, lens=None):
+        # Mirrors what the cull traverser will draw for this camera, so draw
+        # calls and vertices can be reported without a window
+        eye = np.array(tuple(camera.get_pos(self.level)))
+        frustum = None
+        if lens is not None:
+            frustum = lens.make_bounds()
+            frustum.xform(camera.get_mat(self.level))
+
+        visible = occluded = draw_calls = vertices = 0
+        for cellnp, levels, corners in zip(self.cells, self._levels, self._corners):
+            lower = p3d.LPoint3(*corners[0])
+            upper = p3d.LPoint3(*corners[-1])
+            if frustum is not None and not frustum.contains(p3d.BoundingBox(lower, upper)):
+                continue
+            if any(_quad_hides(eye, corners, quad) for quad in self._quads):
+                occluded += 1
+                continue
+
+            lod = cellnp.node()
+            center = np.array(tuple(lod.get_center()))
+            distance = np.linalg.norm(eye - center) / lod.get_lod_scale()
+            for idx, level_counts in enumerate(levels):
+                if lod.get_out(idx) <= distance < lod.get_in(idx):
+                    visible += 1
+                    draw_calls += level_counts[0]
+                    vertices += level_counts[1]
+                    break
+
+        return CellStats(len(self.cells), visible, occluded, draw_calls, vertices)
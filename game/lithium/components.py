@@ -1,5 +1,8 @@
+import collections
 import math
+import time
 
+from . import archetypes
 from . import pytweening as tween
 
 from panda3d import core as p3d
@@ -7,11 +10,15 @@ from panda3d import bullet
 from bamboo import ecs
 
 
+KINEMATIC_MASK = p3d.BitMask32.bit(1)
+
+
 class TemplateFactory:
-    def __init__(self, ecsmanager):
+    def __init__(self, ecsmanager, physics_system=None):
         self.ecsmanager = ecsmanager
+        self.physics_system = physics_system
 
-    def make_character(self, modelpath, parent=None, initial_position=None):
+    def make_character(self, modelpath, parent=None, initial_position=None, kinematic=False):
         if parent is None:
             parent = self.ecsmanager.space.get_component('NODEPATH').nodepath
         entity = self.ecsmanager.create_entity()
@@ -24,11 +31,73 @@ class TemplateFactory:
         char_component = CharacterComponent()
         entity.add_component(char_component)
 
-        phy_char = PhysicsCharacterComponent()
+        if kinematic:
+            phy_char = KinematicCharacterComponent()
+        else:
+            phy_char = PhysicsCharacterComponent()
         entity.add_component(phy_char)
 
         return entity
 
+    def make_crowd_agent(self, modelpath, goal, parent=None, initial_position=None, kinematic=False):
+        entity = self.make_character(modelpath, parent, initial_position, kinematic)
+
+        agent_component = CrowdAgentComponent(goal)
+        entity.add_component(agent_component)
+
+        return entity
+
+    def make_characters(self, modelpath, positions, parent=None, kinematic=False):
+        # Loads the model once for the whole wave and builds each physics node
+        # above its model right away, so PhysicsSystem only has to attach them
+        if parent is None:
+            parent = self.ecsmanager.space.get_component('NODEPATH').nodepath
+        template = base.loader.loadModel(modelpath).find('**/Character')
+
+        entities = []
+        for position in positions:
+            entity = self.ecsmanager.create_entity()
+
+            if kinematic:
+                phy_char = KinematicCharacterComponent()
+            else:
+                phy_char = PhysicsCharacterComponent()
+            phynp = parent.attach_new_node(phy_char.physics_node)
+            phynp.set_pos(template.get_pos() if position is None else position)
+            np = template.copy_to(phynp)
+            np.set_pos(0, 0, 0)
+
+            entity.add_component(NodePathComponent(modelpath, nodepath=np))
+            entity.add_component(CharacterComponent())
+            entity.add_component(phy_char)
+            entities.append(entity)
+
+        return entities
+
+    def make_crowd_agents(self, modelpath, goals, parent=None, positions=None, kinematic=False):
+        if positions is None:
+            positions = [None] * len(goals)
+        entities = self.make_characters(modelpath, positions, parent, kinematic)
+        for entity, goal in zip(entities, goals):
+            entity.add_component(CrowdAgentComponent(goal))
+
+        return entities
+
+    def remove_entity(self, entity):
+        # Take characters out of the physics world, then let go of the scene
+        # graph now instead of whenever the collector gets around to the
+        # entity and its components referencing each other
+        if entity.has_component('PHY_CHARACTER'):
+            character = entity.get_component('PHY_CHARACTER')
+            if self.physics_system is not None:
+                self.physics_system.remove_character(character)
+            # The physics node sits above the model, see PhysicsSystem.spawn_characters
+            p3d.NodePath.any_path(character.physics_node).remove_node()
+        if entity.has_component('NODEPATH'):
+            entity.get_component('NODEPATH').destroy()
+        self.ecsmanager.remove_entity(entity)
+
+
 class NodePathComponent(ecs.Component):
     __slots__ = [
         'nodepath',
@@ -37,10 +106,12 @@ class NodePathComponent(ecs.Component):
 
     typeid = 'NODEPATH'
 
-    def __init__(self, modelpath=None, parent=None, filter=None):
+    def __init__(self, modelpath=None, parent=None, filter=None, nodepath=None):
         super().__init__()
         self._modelpath = modelpath if modelpath else ''
-        if modelpath is not None:
+        if nodepath is not None:
+            self.nodepath = nodepath
+        elif modelpath is not None:
             np = base.loader.loadModel(modelpath)
             if filter is not None:
                 np = np.find(filter)
@@ -52,8 +123,7 @@ class NodePathComponent(ecs.Component):
         if parent is not None:
             self.nodepath.reparent_to(parent)
 
-    def __del__(self):
-        super().__del__()
+    def destroy(self):
         self.nodepath.remove_node()
 
 
@@ -75,6 +145,44 @@ class CharacterComponent(ecs.Component):
         self.jump = False
 
 
+class CrowdAgentComponent(ecs.Component):
+    __slots__ = [
+        'goal',
+        'velocity',
+        'max_speed',
+        'simulated',
+    ]
+
+    typeid = 'CROWD_AGENT'
+
+    def __init__(self, goal):
+        super().__init__()
+        self.goal = p3d.LVector3(goal)
+        self.velocity = p3d.LVector3(0, 0, 0)
+        self.max_speed = 4
+        self.simulated = None
+
+
+class NavAgentComponent(ecs.Component):
+    __slots__ = [
+        'goal',
+        'path',
+        'waypoint',
+        'pending',
+        'arrive_radius',
+    ]
+
+    typeid = 'NAV_AGENT'
+
+    def __init__(self, goal, arrive_radius=0.5):
+        super().__init__()
+        self.goal = p3d.LPoint3(goal)
+        self.path = None
+        self.waypoint = 0
+        self.pending = False
+        self.arrive_radius = arrive_radius
+
+
 class Camera3PComponent(ecs.Component):
     __slots__ = [
         'target',
@@ -108,14 +216,34 @@ class CharacterSystem(ecs.System):
     component_types = [
         'CHARACTER',
     ]
+    reads = [
+        'NODEPATH',
+    ]
+    writes = [
+        'CHARACTER',
+        'PHY_CHARACTER',
+        'TRANSFORM',
+    ]
+
+    def __init__(self, index=None):
+        super().__init__()
+
+        self.characters = archetypes.query(index, 'CHARACTER', 'NODEPATH', 'PHY_CHARACTER')
 
     def update(self, dt, components):
-        for char in components['CHARACTER']:
-            np = char.entity.get_component('NODEPATH').nodepath
-            phys = char.entity.get_component('PHY_CHARACTER')
+        for char, npcomp, phys in self.characters.select(components):
+            np = npcomp.nodepath
 
-            # Position
-            move_vec = char.movement.normalized() * char.move_speed
+            # Position. Movement shorter than a unit vector walks slower, so
+            # analog deflection travels with it, over the network too
+            if char.movement.length_squared() > 1:
+                move_vec = char.movement.normalized() * char.move_speed
+            else:
+                move_vec = char.movement * char.move_speed
+            if phys.sleeping:
+                if move_vec.length_squared() < 0.01 and not char.jump:
+                    continue
+                phys.wake()
             phys.set_linear_movement(move_vec)
 
             # Face character toward direction of travel
@@ -133,6 +261,12 @@ class Camera3PSystem(ecs.System):
     component_types = [
         'CAMERA3P',
     ]
+    reads = [
+        'TRANSFORM',
+    ]
+    writes = [
+        'CAMERA3P',
+    ]
 
     def update(self, dt, components):
         for camcomp in components['CAMERA3P']:
@@ -185,29 +319,40 @@ class PhysicsStaticMeshComponent(ecs.Component):
 class PhysicsCharacterComponent(ecs.Component):
     __slots__ = [
         'physics_node',
+        'shape',
         'height',
+        'radius',
+        'step_height',
         'air_control',
         'airborne',
+        'sleeping',
+        'idle_time',
     ]
 
     typeid = 'PHY_CHARACTER'
+    kinematic = False
 
     def __init__(self):
         super().__init__()
 
         self.height = 1.75
+        self.radius = 0.4
+        self.step_height = 0.8
         self.air_control = 0.8
         self.airborne = False
+        self.sleeping = False
+        self.idle_time = 0
 
-        radius = 0.4
-        step_height = 0.8
+        self.shape = bullet.BulletCapsuleShape(self.radius, self.height - 2 * self.radius, bullet.ZUp)
+        self.physics_node = self.create_physics_node()
 
-        shape = bullet.BulletCapsuleShape(radius, self.height - 2 * radius, bullet.ZUp)
-        self.physics_node = bullet.BulletRigidBodyNode('Character')
-        self.physics_node.add_shape(shape)
-        self.physics_node.set_angular_factor(0)
-        self.physics_node.set_mass(80.0)
-        self.physics_node.set_deactivation_enabled(False)
+    def create_physics_node(self):
+        node = bullet.BulletRigidBodyNode('Character')
+        node.add_shape(self.shape)
+        node.set_angular_factor(0)
+        node.set_mass(80.0)
+        node.set_deactivation_enabled(False)
+        return node
 
     def set_linear_movement(self, vec):
         if self.airborne:
@@ -219,22 +364,116 @@ class PhysicsCharacterComponent(ecs.Component):
         if not self.airborne:
             self.physics_node.set_linear_velocity(p3d.LVector3(0, 0, 5))
 
+    def is_resting(self):
+        return self.physics_node.get_linear_velocity().length_squared() < 0.01
+
+    def sleep(self):
+        # Let Bullet take the body out of the simulation until something bumps into it
+        self.sleeping = True
+        self.physics_node.set_deactivation_enabled(True)
+        self.physics_node.set_active(False, True)
+
+    def wake(self):
+        self.sleeping = False
+        self.idle_time = 0
+        self.physics_node.set_deactivation_enabled(False)
+
+
+class KinematicCharacterComponent(PhysicsCharacterComponent):
+    __slots__ = [
+        'velocity',
+        'max_slope',
+    ]
+
+    kinematic = True
+
+    def __init__(self):
+        super().__init__()
+
+        self.step_height = 0.35
+        self.max_slope = 50
+        self.velocity = p3d.LVector3(0, 0, 0)
+
+    def create_physics_node(self):
+        # A ghost keeps the capsule visible to queries without handing it to the solver
+        node = bullet.BulletGhostNode('Character')
+        node.add_shape(self.shape)
+        node.set_into_collide_mask(KINEMATIC_MASK)
+        return node
+
+    def set_linear_movement(self, vec):
+        if self.airborne:
+            vec *= self.air_control
+        self.velocity.x = vec.x
+        self.velocity.y = vec.y
+
+    def do_jump(self):
+        if not self.airborne:
+            self.velocity.z = 5
+            self.airborne = True
+
+    def is_resting(self):
+        return self.velocity.length_squared() < 0.01
+
+    def sleep(self):
+        self.sleeping = True
+
+    def wake(self):
+        self.sleeping = False
+        self.idle_time = 0
+
 
 class PhysicsSystem(ecs.System):
     __slots__ = [
         'physics_world',
+        'spatial_index',
+        'sleep_delay',
+        'wake_radius',
         'enable_debug',
+        'characters',
+        'spawn_budget',
         '_debugnp',
+        '_spawning',
+        '_detached',
+        '_wave',
+        '_attached',
+        '_settled_step',
+        '_spawn_step_cost',
     ]
 
     component_types = [
         'PHY_STATICMESH',
         'PHY_CHARACTER',
     ]
+    reads = [
+        'NODEPATH',
+        'SPATIAL',
+    ]
+    writes = [
+        'PHY_STATICMESH',
+        'PHY_CHARACTER',
+        'TRANSFORM',
+        'PHYSICS',
+    ]
 
-    def __init__(self):
+    def __init__(self, spatial_index=None, index=None):
         super().__init__()
 
+        self.spatial_index = spatial_index
+        self.characters = archetypes.query(index, 'PHY_CHARACTER', 'NODEPATH')
+        self.sleep_delay = 1.0
+        self.wake_radius = 2.0
+        # Seconds per frame spent attaching new characters, None attaches a wave at once
+        self.spawn_budget = None
+        self._spawning = collections.OrderedDict()
+        self._detached = set()
+        self._wave = None
+        self._attached = 0
+        self._settled_step = None
+        # Extra seconds of physics step per character attached that frame,
+        # measured as waves go in
+        self._spawn_step_cost = 0.00005
+
         self.physics_world = bullet.BulletWorld()
         self.physics_world.set_gravity(p3d.LVector3(0, 0, -9.8))
         phydebug = bullet.BulletDebugNode('Physics Debug')
@@ -253,26 +492,254 @@ class PhysicsSystem(ecs.System):
 
     def init_components(self, dt, components):
         for static_mesh in components.get('PHY_STATICMESH', []):
-            self.physics_world.attach(static_mesh.physics_node)
+            self.attach_static_mesh(static_mesh)
 
-        for character in components.get('PHY_CHARACTER', []):
-            np = character.entity.get_component('NODEPATH').nodepath
-            phynp = np.get_parent().attach_new_node(character.physics_node)
-            phynp.set_pos(np.get_pos())
-            np.reparent_to(phynp)
-            np.set_pos(p3d.LVector3(0, 0, 0))
-            self.physics_world.attach(character.physics_node)
+        characters = components.get('PHY_CHARACTER', [])
+        if characters:
+            self.spawn_characters(characters)
 
-    def update(self, dt, components):
+    def spawn_characters(self, characters):
+        # The whole wave is put under its physics nodes in one go and queued,
+        # then attached to the world under spawn_budget
+        stime = time.perf_counter()
+        for character in characters:
+            np = character.entity.get_component('NODEPATH').nodepath
+            parent = np.get_parent()
+            # TemplateFactory.make_characters already built the hierarchy
+            if parent.node() != character.physics_node:
+                phynp = parent.attach_new_node(character.physics_node)
+                phynp.set_pos(np.get_pos())
+                np.reparent_to(phynp)
+                np.set_pos(p3d.LVector3(0, 0, 0))
+            self._spawning[character] = None
+
+        if self._wave is None:
+            self._wave = [0, 0.0, 0, 0]
+        self._wave[1] += time.perf_counter() - stime
+        self.attach_spawning()
+
+    def attach_spawning(self):
+        if not self._spawning:
+            return
+
+        # Most of what a new character costs is the first step it is in, more
+        # so when it spawns overlapping something, so the budget covers the
+        # attach calls plus the step time they are expected to add
+        stime = time.perf_counter()
+        deadline = None if self.spawn_budget is None else stime + self.spawn_budget
+        attached = 0
+        # At least one goes in every frame so a wave always finishes
+        while self._spawning and (
+            deadline is None or attached == 0 or
+            time.perf_counter() + attached * self._spawn_step_cost < deadline
+        ):
+            character, _ = self._spawning.popitem(last=False)
+            self.attach_character(character)
+            attached += 1
+
+        self._attached += attached
+        self._wave[0] += attached
+        self._wave[1] += time.perf_counter() - stime
+        self._wave[2] += 1
+        if not self._spawning:
+            self._finish_wave()
+
+    def _finish_wave(self):
+        count, elapsed, frames, dropped = self._wave
+        self._wave = None
+        if count > 1:
+            print("Spawned {} characters over {} frame(s), {:.1f} entities/ms{}".format(
+                count, frames, count / max(elapsed * 1000, 1e-6),
+                ", {} removed before attaching".format(dropped) if dropped else ''
+            ))
+
+    def attach_static_mesh(self, static_mesh):
+        self.physics_world.attach(static_mesh.physics_node)
+
+    def attach_character(self, character):
+        self._spawning.pop(character, None)
+        self._detached.discard(character)
+        self.world_for(character).attach(character.physics_node)
+
+    def detach_character(self, character):
+        # Characters still waiting to be attached just leave the queue
+        if character in self._spawning:
+            del self._spawning[character]
+            self._wave[3] += 1
+            if not self._spawning:
+                self._finish_wave()
+            return
+        if character in self._detached:
+            return
+        self.world_for(character).remove(character.physics_node)
+        self._detached.add(character)
+
+    def remove_character(self, character):
+        # For characters leaving the game, where detach_character expects them back
+        self.detach_character(character)
+        self._detached.discard(character)
+
+    def world_for(self, character):
+        return self.physics_world
+
+    def num_bodies(self):
+        world = self.physics_world
+        return world.get_num_rigid_bodies() + world.get_num_ghosts()
+
+    def step(self, dt):
         self.physics_world.do_physics(dt, 10, 1.0/180.0)
 
-        for character in components.get('PHY_CHARACTER', []):
+    def _time_step(self, elapsed):
+        # Steps with nothing new in them set what a body costs once settled,
+        # and whatever a step with new characters takes past that is put
+        # down to them
+        bodies = self.num_bodies()
+        if not self._attached:
+            self._settled_step = elapsed / max(bodies, 1)
+            return
+        if self._settled_step is not None:
+            settled = self._settled_step * (bodies - self._attached)
+            cost = max(elapsed - settled, 0.0) / self._attached
+            self._spawn_step_cost = (self._spawn_step_cost + cost) / 2
+        self._attached = 0
+
+    def update(self, dt, components):
+        self.attach_spawning()
+        stime = time.perf_counter()
+        self.step(dt)
+        self._time_step(time.perf_counter() - stime)
+
+        movers = []
+        spawning = self._spawning
+        for character, npcomp in self.characters.select(components):
+            if spawning and character in spawning:
+                continue
             phynode = character.physics_node
-            np = character.entity.get_component('NODEPATH').nodepath
 
-            # Air Check
-            frompt = np.get_pos(base.render) - p3d.LVector3(0, 0, character.height / 2.1)
-            topt = frompt + p3d.LVector3(0, 0, -0.25)
-            result = self.physics_world.ray_test_closest(frompt, topt)
-            #print(frompt, topt, result.has_hit(), result.get_node())
-            character.airborne = not result.has_hit()
+            if character.sleeping:
+                # Bullet reactivates sleeping bodies when something collides with them
+                if character.kinematic or not phynode.is_active():
+                    continue
+                character.wake()
+
+            np = npcomp.nodepath
+
+            if character.kinematic:
+                self._move_kinematic(character, np.get_parent(), dt)
+            else:
+                # Air Check
+                frompt = np.get_pos(base.render) - p3d.LVector3(0, 0, character.height / 2.1)
+                topt = frompt + p3d.LVector3(0, 0, -0.25)
+                result = self.world_for(character).ray_test_closest(frompt, topt)
+                #print(frompt, topt, result.has_hit(), result.get_node())
+                character.airborne = not result.has_hit()
+
+            # Characters that stand still on the ground for a while go to sleep
+            if character.airborne or not character.is_resting():
+                character.idle_time = 0
+                movers.append(np)
+            else:
+                character.idle_time += dt
+                if character.idle_time >= self.sleep_delay:
+                    character.sleep()
+
+        # Wake sleepers that moving characters are about to run into
+        if self.spatial_index is not None:
+            for np in movers:
+                for entity in self.spatial_index.query_radius(np.get_pos(base.render), self.wake_radius):
+                    neighbor = entity.get_component('PHY_CHARACTER')
+                    if neighbor.sleeping:
+                        neighbor.wake()
+
+    def _sweep(self, character, frompt, topt):
+        # Kinematic characters are left out of the mask so they never block themselves
+        return self.world_for(character).sweep_test_closest(
+            character.shape,
+            p3d.TransformState.make_pos(frompt),
+            p3d.TransformState.make_pos(topt),
+            ~KINEMATIC_MASK
+        )
+
+    def _has_ground(self, character, pos, min_normal_z):
+        # The capsule may be resting on a ledge with its rounded bottom, so
+        # also look for walkable ground directly below its center
+        topt = pos - p3d.LVector3(0, 0, character.height / 2 + 0.1)
+        result = self.world_for(character).ray_test_closest(pos, topt, ~KINEMATIC_MASK)
+        return result.has_hit() and result.get_hit_normal().z >= min_normal_z
+
+    def _move_kinematic(self, character, phynp, dt):
+        skin = 0.01
+        pos = phynp.get_pos(base.render)
+        velocity = character.velocity
+        min_normal_z = math.cos(math.radians(character.max_slope))
+
+        # Step up so low obstacles don't block horizontal movement
+        step_up = 0 if character.airborne else character.step_height
+        if step_up > 0:
+            result = self._sweep(character, pos, pos + p3d.LVector3(0, 0, step_up))
+            if result.has_hit():
+                step_up = max(step_up * result.get_hit_fraction() - skin, 0)
+            pos.z += step_up
+
+        # Slide along whatever the horizontal move runs into
+        motion = p3d.LVector3(velocity.x, velocity.y, 0) * dt
+        for _ in range(3):
+            distance = motion.length()
+            if distance < 1e-4:
+                break
+
+            result = self._sweep(character, pos, pos + motion)
+            if not result.has_hit():
+                pos += motion
+                break
+
+            fraction = max(result.get_hit_fraction() - skin / distance, 0)
+            pos += motion * fraction
+            motion *= 1 - fraction
+
+            # Treat slopes that are too steep to climb as walls
+            normal = p3d.LVector3(result.get_hit_normal())
+            if normal.z < min_normal_z:
+                normal.z = 0
+                normal.normalize()
+            motion -= normal * motion.dot(normal)
+
+        # Undo the step and apply vertical velocity, reaching further down
+        # when grounded so the character stays snapped to slopes and stairs
+        drop = step_up - velocity.z * dt
+        snap = 0 if character.airborne or velocity.z > 0 else character.step_height
+        reach = drop + snap
+        result = None
+        if abs(reach) > 1e-4:
+            result = self._sweep(character, pos, pos - p3d.LVector3(0, 0, reach))
+
+        if result is None or not result.has_hit():
+            pos.z -= drop
+            character.airborne = True
+        else:
+            fraction = max(result.get_hit_fraction() - skin / abs(reach), 0)
+            pos.z -= reach * fraction
+            normal = p3d.LVector3(result.get_hit_normal())
+
+            if reach < 0:
+                # Bumped into a ceiling
+                velocity.z = 0
+                character.airborne = True
+            elif normal.z >= min_normal_z or self._has_ground(character, pos, min_normal_z):
+                velocity.z = 0
+                character.airborne = False
+            else:
+                # Slide down slopes that are too steep to stand on
+                character.airborne = True
+                slide = p3d.LVector3(0, 0, -reach * (1 - fraction))
+                slide -= normal * slide.dot(normal)
+                if slide.length_squared() > 1e-8:
+                    result = self._sweep(character, pos, pos + slide)
+                    if result.has_hit():
+                        slide *= max(result.get_hit_fraction() - skin / slide.length(), 0)
+                    pos += slide
+
+        if character.airborne:
+            velocity.z += self.world_for(character).get_gravity().z * dt
+
+        phynp.set_pos(base.render, pos)
@@ -0,0 +1,168 @@
+import numpy as np
+
+from panda3d import core as p3d
+from bamboo import ecs
+
+from . import archetypes
+from .components import KINEMATIC_MASK
+from .spatial import UniformGrid
+
+
+def steer(positions, velocities, goals, max_speeds, dt,
+          neighbor_radius=1.5, separation=1.5, passing=0.6, arrive_radius=2.0, acceleration=8.0):
+    count = len(positions)
+
+    # Seek the goal, slowing down on arrival
+    to_goal = goals - positions
+    goal_dist = np.sqrt(np.einsum('ij,ij->i', to_goal, to_goal))
+    speed = max_speeds * np.minimum(goal_dist / arrive_radius, 1.0)
+    desired = to_goal * (speed / np.maximum(goal_dist, 1e-6))[:, None]
+
+    # Push away from neighbors, harder the closer they are, and veer right so
+    # agents walking head-on pass each other instead of deadlocking
+    grid = UniformGrid(neighbor_radius)
+    grid.rebuild(positions)
+    pair_i, _, delta, dist_sq = grid.query_pairs(neighbor_radius)
+    if len(pair_i):
+        dist = np.maximum(np.sqrt(dist_sq), 1e-3)
+        weight = (neighbor_radius - dist) / (neighbor_radius * dist)
+        push = delta * weight[:, None]
+        push += push[:, ::-1] * (passing, -passing)
+        repulse = np.empty_like(positions)
+        repulse[:, 0] = np.bincount(pair_i, weights=push[:, 0], minlength=count)
+        repulse[:, 1] = np.bincount(pair_i, weights=push[:, 1], minlength=count)
+        desired += repulse * (separation * max_speeds)[:, None]
+
+    # Blend toward the desired velocity with limited acceleration
+    velocities = velocities + (desired - velocities) * min(acceleration * dt, 1.0)
+    speed = np.sqrt(np.einsum('ij,ij->i', velocities, velocities))
+    clamp = np.minimum(max_speeds / np.maximum(speed, 1e-6), 1.0)
+    return velocities * clamp[:, None]
+
+
+class CrowdSystem(ecs.System):
+    __slots__ = [
+        'physics_system',
+        'focus',
+        'kinematic_distance',
+        'neighbor_radius',
+        'agents',
+    ]
+
+    component_types = [
+        'CROWD_AGENT',
+    ]
+    reads = [
+        'NODEPATH',
+        'PHY_CHARACTER',
+    ]
+    writes = [
+        'CROWD_AGENT',
+        'CHARACTER',
+        'TRANSFORM',
+        'PHYSICS',
+    ]
+
+    def __init__(self, physics_system=None, focus=None, kinematic_distance=40.0, index=None):
+        super().__init__()
+
+        self.physics_system = physics_system
+        self.focus = focus
+        self.kinematic_distance = kinematic_distance
+        self.neighbor_radius = 1.5
+        self.agents = archetypes.query(index, 'CROWD_AGENT', 'NODEPATH', 'CHARACTER', 'PHY_CHARACTER')
+
+    def init_components(self, dt, components):
+        # Physics bodies may not be attached yet, so wait a frame before
+        # switching new agents between simulated and kinematic movement
+        for agent in components.get('CROWD_AGENT', []):
+            agent.simulated = None
+
+    def update(self, dt, components):
+        rows = self.agents.select(components)
+        if not rows or dt <= 0:
+            return
+
+        count = len(rows)
+        positions = np.empty((count, 2))
+        velocities = np.empty((count, 2))
+        goals = np.empty((count, 2))
+        max_speeds = np.empty(count)
+        nodepaths = []
+
+        for idx, (agent, npcomp, char, phys) in enumerate(rows):
+            nodepath = npcomp.nodepath
+            pos = nodepath.get_pos(base.render)
+            nodepaths.append(nodepath)
+            positions[idx] = pos.x, pos.y
+            velocities[idx] = agent.velocity.x, agent.velocity.y
+            goals[idx] = agent.goal.x, agent.goal.y
+            max_speeds[idx] = agent.max_speed
+
+        velocities = steer(positions, velocities, goals, max_speeds, dt, self.neighbor_radius)
+
+        if self.physics_system is not None and self.focus is not None:
+            focus = self.focus.get_pos(base.render)
+            offset = positions - (focus.x, focus.y)
+            far = np.einsum('ij,ij->i', offset, offset) > self.kinematic_distance ** 2
+        else:
+            far = np.zeros(count, dtype=bool)
+
+        for idx, (agent, npcomp, char, phys) in enumerate(rows):
+            vel_x, vel_y = velocities[idx]
+            agent.velocity.set(vel_x, vel_y, 0)
+
+            # Full deflection toward the velocity, at its speed
+            speed = agent.velocity.length()
+            char.movement = agent.velocity / speed if speed > 0 else p3d.LVector3(0, 0, 0)
+            char.move_speed = speed
+
+            # Kinematic controllers are already cheap, so only rigid bodies get swapped out
+            if agent.simulated is None:
+                agent.simulated = True
+            elif agent.simulated == far[idx] and not phys.kinematic:
+                self._set_simulated(agent, not far[idx])
+
+            if not agent.simulated:
+                # Far away agents skip the rigid body solver and slide along the ground
+                self._slide(phys, nodepaths[idx].get_parent(), agent.velocity * dt)
+
+    def _slide(self, phys, phynp, motion):
+        # Without a body the level doesn't stop the agent, so a ray along the
+        # move keeps it out of walls and one down keeps it on the ground.
+        # Moves that leave no ground within a step are not taken, which keeps
+        # agents from walking off ledges and floating until they are attached
+        world = self.physics_system.world_for(phys)
+        pos = phynp.get_pos(base.render)
+
+        if motion.length_squared() > 1e-8:
+            reach = motion + motion.normalized() * phys.radius
+            result = world.ray_test_closest(pos, pos + reach, ~KINEMATIC_MASK)
+            if result.has_hit():
+                normal = p3d.LVector3(result.get_hit_normal())
+                normal.z = 0
+                if normal.normalize():
+                    motion = motion - normal * motion.dot(normal)
+                    result = world.ray_test_closest(pos, pos + motion + motion.normalized() * phys.radius, ~KINEMATIC_MASK)
+                if result.has_hit():
+                    return
+
+        target = pos + motion
+        feet = target.z - phys.height / 2
+        result = world.ray_test_closest(
+            p3d.LPoint3(target.x, target.y, feet + phys.step_height),
+            p3d.LPoint3(target.x, target.y, feet - phys.step_height),
+            ~KINEMATIC_MASK
+        )
+        if not result.has_hit():
+            return
+        target.z = result.get_hit_pos().z + phys.height / 2
+        phynp.set_pos(base.render, target)
+
+    def _set_simulated(self, agent, simulated):
+        phys = agent.entity.get_component('PHY_CHARACTER')
+        if simulated:
+            self.physics_system.attach_character(phys)
+        else:
+            self.physics_system.detach_character(phys)
+        agent.simulated = simulated
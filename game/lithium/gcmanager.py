@@ -0,0 +1,109 @@
+import collections
+import gc
+import time
+
+from panda3d import core as p3d
+
+
+class GCManager:
+    __slots__ = [
+        'budget',
+        'max_deferred',
+        'pauses',
+        'full_collections',
+        'forced_collections',
+        '_collector',
+        '_full_collector',
+        '_threshold',
+        '_start',
+        '_generation',
+        '_frame_pause',
+        '_full_cost',
+        '_enabled',
+        '_deferring',
+    ]
+
+    def __init__(self, budget=0.002, max_deferred=10, history_frames=600):
+        # Seconds of spare frame time a deferred full collection may take, and
+        # how many times past the interpreter's own point it may be put off
+        self.budget = budget
+        self.max_deferred = max_deferred
+        self.pauses = collections.deque(maxlen=history_frames)
+        self.full_collections = 0
+        self.forced_collections = 0
+
+        self._collector = p3d.PStatCollector('App:GC')
+        self._full_collector = p3d.PStatCollector('App:GC:Full')
+        self._threshold = gc.get_threshold()
+        self._start = None
+        self._generation = 0
+        self._frame_pause = 0.0
+        self._full_cost = 0.0
+        self._enabled = False
+        self._deferring = False
+
+    def enable(self, defer=True):
+        # The young generations still collect on their own since they are
+        # cheap, the oldest one only goes when end_frame or collect say so.
+        # Without defer, pauses are measured but the collector is left alone
+        if self._enabled:
+            return
+        if defer:
+            young, middle, _ = self._threshold
+            gc.set_threshold(young, middle, 1 << 30)
+        gc.callbacks.append(self._on_gc)
+        self._enabled = True
+        self._deferring = defer
+
+    def disable(self):
+        if not self._enabled:
+            return
+        gc.set_threshold(*self._threshold)
+        gc.callbacks.remove(self._on_gc)
+        self._enabled = False
+        self._deferring = False
+
+    def _on_gc(self, phase, info):
+        if phase == 'start':
+            self._generation = info['generation']
+            (self._full_collector if self._generation == 2 else self._collector).start()
+            self._start = time.perf_counter()
+            return
+
+        elapsed = time.perf_counter() - self._start
+        (self._full_collector if self._generation == 2 else self._collector).stop()
+        self._frame_pause += elapsed
+        if self._generation == 2:
+            self.full_collections += 1
+            self._full_cost = elapsed
+
+    def freeze(self):
+        # Everything alive once a level is loaded lives as long as the level,
+        # so move it out of the generations the collector walks
+        self.collect()
+        gc.freeze()
+
+        # This runs before enable hooks up timing, so a full collection of
+        # what is left is timed here to give the first deferred one a cost
+        stime = time.perf_counter()
+        gc.collect()
+        self._full_cost = time.perf_counter() - stime
+        return gc.get_freeze_count()
+
+    def collect(self):
+        # For loading screens and other places a full pause won't be seen
+        gc.collect()
+
+    def end_frame(self, spare):
+        # Full collections wait for a frame with room for one, going by how
+        # long the last one took, unless they have waited too long already
+        deferred = gc.get_count()[2]
+        if self._deferring and deferred >= self._threshold[2]:
+            if self._full_cost <= min(spare, self.budget):
+                gc.collect()
+            elif deferred >= self._threshold[2] * self.max_deferred:
+                self.forced_collections += 1
+                gc.collect()
+
+        self.pauses.append(self._frame_pause)
+        self._frame_pause = 0.0
@@ -0,0 +1,136 @@
+from panda3d import core as p3d
+from panda3d import bullet
+
+from .components import PhysicsSystem
+
+
+def grid_regions(lower, upper, columns, rows):
+    width = (upper.x - lower.x) / columns
+    depth = (upper.y - lower.y) / rows
+
+    regions = []
+    for row in range(rows):
+        for column in range(columns):
+            region_lower = p3d.LPoint3(lower.x + column * width, lower.y + row * depth, lower.z)
+            region_upper = p3d.LPoint3(region_lower.x + width, region_lower.y + depth, upper.z)
+            regions.append((region_lower, region_upper))
+
+    return regions
+
+
+class IslandPhysicsSystem(PhysicsSystem):
+    __slots__ = [
+        'regions',
+        'worlds',
+        'margin',
+        '_islands',
+    ]
+
+    def __init__(self, spatial_index=None, index=None):
+        super().__init__(spatial_index, index)
+
+        self.regions = []
+        self.worlds = [self.physics_world]
+        self.margin = 2.0
+        self._islands = {}
+
+    def set_regions(self, regions):
+        # Regions have to be set up before any physics components get initialized
+        self.regions = list(regions)
+        self.worlds = [self.physics_world]
+        for _ in self.regions[1:]:
+            world = bullet.BulletWorld()
+            world.set_gravity(self.physics_world.get_gravity())
+            self.worlds.append(world)
+
+    def _contains(self, index, pos, margin):
+        lower, upper = self.regions[index]
+        return (
+            lower.x - margin <= pos.x <= upper.x + margin and
+            lower.y - margin <= pos.y <= upper.y + margin
+        )
+
+    def region_of(self, pos, current=None):
+        # Stay in the current island until the character is clearly outside of
+        # it so walking along a border doesn't bounce it between worlds
+        if current is not None and self._contains(current, pos, self.margin):
+            return current
+
+        for index in range(len(self.regions)):
+            if self._contains(index, pos, 0):
+                return index
+
+        return current if current is not None else 0
+
+    def attach_static_mesh(self, static_mesh):
+        if len(self.worlds) == 1:
+            super().attach_static_mesh(static_mesh)
+            return
+
+        node = static_mesh.physics_node
+        transform = p3d.NodePath.any_path(node).get_net_transform()
+        bounds = node.get_shape_bounds()
+        center = transform.get_mat().xform_point(bounds.get_center())
+        radius = bounds.get_radius() * max(transform.get_scale())
+
+        # A body can only live in one world, so every other island overlapping
+        # the mesh gets a copy that shares its collision shapes
+        islands = [
+            index for index in range(len(self.regions))
+            if self._contains(index, center, radius + self.margin + 2)
+        ] or [0]
+
+        self.worlds[islands[0]].attach(node)
+        for index in islands[1:]:
+            copy = bullet.BulletRigidBodyNode(node.get_name())
+            for shape_idx in range(node.get_num_shapes()):
+                copy.add_shape(node.get_shape(shape_idx), node.get_shape_transform(shape_idx))
+            copy.set_transform(transform)
+            self.worlds[index].attach(copy)
+
+    def attach_character(self, character):
+        if character not in self._islands:
+            nodepath = character.entity.get_component('NODEPATH').nodepath
+            self._islands[character] = self.region_of(nodepath.get_pos(base.render))
+        super().attach_character(character)
+
+    def remove_character(self, character):
+        super().remove_character(character)
+        self._islands.pop(character, None)
+
+    def world_for(self, character):
+        return self.worlds[self._islands.get(character, 0)]
+
+    def num_bodies(self):
+        return sum(world.get_num_rigid_bodies() + world.get_num_ghosts() for world in self.worlds)
+
+    def step(self, dt):
+        if len(self.worlds) == 1:
+            super().step(dt)
+            return
+
+        # Panda's Bullet wrapper holds a global lock for all of do_physics, so
+        # the islands step one after another. What they buy is smaller worlds
+        # for the broadphase and solver, not parallelism
+        for world in self.worlds:
+            world.do_physics(dt, 10, 1.0/180.0)
+
+    def update(self, dt, components):
+        super().update(dt, components)
+
+        if len(self.worlds) == 1:
+            return
+
+        # Move characters that walked out of their island into the one they are in now
+        for character, npcomp in self.characters.select(components):
+            current = self._islands.get(character)
+            if current is None or character.sleeping:
+                continue
+
+            nodepath = npcomp.nodepath
+            index = self.region_of(nodepath.get_pos(base.render), current)
+            if index != current:
+                if character not in self._detached:
+                    self.worlds[current].remove(character.physics_node)
+                    self.worlds[index].attach(character.physics_node)
+                self._islands[character] = index
@@ -0,0 +1,221 @@
+import concurrent.futures
+import heapq
+import inspect
+import itertools
+import time
+
+
+class Offload:
+    __slots__ = [
+        'future',
+    ]
+
+    def __init__(self, future):
+        self.future = future
+
+    def __await__(self):
+        return (yield self)
+
+
+class Job:
+    __slots__ = [
+        'name',
+        'priority',
+        'done',
+        'cancelled',
+        'result',
+        'error',
+        '_routine',
+        '_future',
+    ]
+
+    def __init__(self, routine, priority, name):
+        self.name = name
+        self.priority = priority
+        self.done = False
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self._routine = routine
+        self._future = None
+
+    def cancel(self):
+        # The routine is closed by the queue the next time it comes up, since
+        # a job may cancel itself while it is running
+        if not self.done:
+            self.cancelled = True
+            self.done = True
+
+
+def _call(func):
+    return func()
+    yield
+
+
+class JobQueue:
+    __slots__ = [
+        'budget',
+        'workers',
+        'jobs_done',
+        'jobs_failed',
+        'frames',
+        'overruns',
+        'worst_overrun',
+        'max_depth',
+        '_depth_total',
+        '_overrun_total',
+        '_ready',
+        '_waiting',
+        '_sequence',
+        '_threads',
+        '_processes',
+    ]
+
+    def __init__(self, budget=0.002, workers=None):
+        # Seconds per frame spent resuming jobs
+        self.budget = budget
+        self.workers = workers
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.frames = 0
+        self.overruns = 0
+        self.worst_overrun = 0.0
+        self.max_depth = 0
+        self._depth_total = 0
+        self._overrun_total = 0.0
+        self._ready = []
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._threads = None
+        self._processes = None
+
+    def __len__(self):
+        return len(self._ready) + len(self._waiting)
+
+    def add(self, routine, priority=0, name=None):
+        # Jobs are generators or coroutines, resumed one slice at a time;
+        # plain callables run as a single slice. Generator and coroutine
+        # functions are called here rather than run as plain callables
+        if inspect.isgeneratorfunction(routine) or inspect.iscoroutinefunction(routine):
+            routine = routine()
+        if not hasattr(routine, 'send'):
+            name = name or getattr(routine, '__name__', None)
+            routine = _call(routine)
+        job = Job(routine, priority, name or getattr(routine, '__name__', 'job'))
+        self._push(job)
+        return job
+
+    def _push(self, job):
+        # Higher priorities go first, and jobs of the same priority take turns
+        heapq.heappush(self._ready, (-job.priority, next(self._sequence), job))
+
+    def offload(self, func, *args, process=False):
+        # Yield (or await) the result so the job sleeps until the pool is done
+        # with it. Process pools need func and args to pickle
+        if process:
+            if self._processes is None:
+                self._processes = concurrent.futures.ProcessPoolExecutor(self.workers)
+            executor = self._processes
+        else:
+            if self._threads is None:
+                self._threads = concurrent.futures.ThreadPoolExecutor(self.workers, 'jobs')
+            executor = self._threads
+        return Offload(executor.submit(func, *args))
+
+    def run(self, budget=None):
+        budget = self.budget if budget is None else budget
+        stime = time.perf_counter()
+        deadline = stime + budget
+
+        # Jobs whose offloaded work has finished get back in line
+        if self._waiting:
+            waiting = []
+            for job in self._waiting:
+                if job.cancelled:
+                    job._routine.close()
+                elif job._future.done():
+                    self._push(job)
+                else:
+                    waiting.append(job)
+            self._waiting = waiting
+
+        # At least one slice runs every frame so a small budget still makes progress
+        resumed = 0
+        while self._ready and (resumed == 0 or time.perf_counter() < deadline):
+            _, _, job = heapq.heappop(self._ready)
+            if job.cancelled:
+                job._routine.close()
+                continue
+            self._resume(job)
+            resumed += 1
+
+        elapsed = time.perf_counter() - stime
+        depth = len(self)
+        self.frames += 1
+        self._depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+        # The slice that crosses the deadline always finishes, so small
+        # overruns are expected and big ones point at slices that are too long
+        if elapsed > budget:
+            self.overruns += 1
+            self._overrun_total += elapsed - budget
+            self.worst_overrun = max(self.worst_overrun, elapsed - budget)
+        return resumed
+
+    def _resume(self, job):
+        future = job._future
+        job._future = None
+        try:
+            if future is None:
+                yielded = job._routine.send(None)
+            elif future.exception() is not None:
+                yielded = job._routine.throw(future.exception())
+            else:
+                yielded = job._routine.send(future.result())
+        except StopIteration as stop:
+            job.done = True
+            job.result = stop.value
+            self.jobs_done += 1
+            return
+        except Exception as error:
+            job.done = True
+            job.error = error
+            self.jobs_failed += 1
+            print("Job {} failed: {!r}".format(job.name, error))
+            return
+
+        if job.cancelled:
+            job._routine.close()
+            return
+        if isinstance(yielded, Offload):
+            job._future = yielded.future
+            self._waiting.append(job)
+        else:
+            self._push(job)
+
+    def attach(self, taskmgr, sort=40):
+        # Between the simulation and igLoop, so jobs get what is left before rendering
+        def run_jobs(task):
+            self.run()
+            return task.cont
+        return taskmgr.add(run_jobs, 'Jobs', sort=sort)
+
+    def close(self):
+        for executor in (self._threads, self._processes):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self._threads = None
+        self._processes = None
+
+    def summary(self):
+        return 'Jobs: {} done, {} failed, {} queued, depth mean {:.1f} max {}, {}/{} frames over budget by {:.2f} ms mean, {:.2f} ms worst'.format(
+            self.jobs_done,
+            self.jobs_failed,
+            len(self),
+            self._depth_total / max(self.frames, 1),
+            self.max_depth,
+            self.overruns,
+            self.frames,
+            self._overrun_total / max(self.overruns, 1) * 1000,
+            self.worst_overrun * 1000
+        )
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# pman build hook, run as a script with the asset source and export directories.
+# Kept free of lithium imports since it runs outside of the game.
+import os
+import sys
+import time
+
+import numpy as np
+
+from panda3d import core as p3d
+
+
+CELL_SIZE = 16.0
+CELLS_SUFFIX = '.cells.bam'
+OCCLUDER_PREFIX = 'Occluder'
+
+# (switch in distance, switch out distance, vertex clustering size) per level,
+# a clustering size of None keeps the full resolution mesh
+LOD_LEVELS = [
+    (40.0, 0.0, None),
+    (100.0, 40.0, 0.25),
+    (1000.0, 100.0, 1.0),
+]
+
+_INDEX_TYPES = {
+    p3d.Geom.NT_uint8: np.uint8,
+    p3d.Geom.NT_uint16: np.uint16,
+    p3d.Geom.NT_uint32: np.uint32,
+}
+
+
+def _array_rows(vdata, index):
+    stride = vdata.get_format().get_array(index).get_stride()
+    raw = np.frombuffer(memoryview(vdata.get_array(index)).cast('B'), np.uint8)
+    return raw.reshape(-1, stride)
+
+
+def _positions(vdata):
+    column = vdata.get_format().get_column(p3d.InternalName.get_vertex())
+    if column.get_numeric_type() == p3d.Geom.NT_float32 and column.get_num_components() >= 3:
+        rows = _array_rows(vdata, vdata.get_format().get_array_with(p3d.InternalName.get_vertex()))
+        start = column.get_start()
+        return np.ascontiguousarray(rows[:, start:start + 12]).view(np.float32).reshape(-1, 3)
+
+    reader = p3d.GeomVertexReader(vdata, p3d.InternalName.get_vertex())
+    return np.array([tuple(reader.get_data3()) for _ in range(vdata.get_num_rows())], np.float32)
+
+
+def _triangles(geom):
+    indices = []
+    for prim_idx in range(geom.get_num_primitives()):
+        prim = geom.get_primitive(prim_idx)
+        if not isinstance(prim, (p3d.GeomTriangles, p3d.GeomTristrips, p3d.GeomTrifans)):
+            continue
+        tris = prim.decompose()
+        if not tris.is_indexed():
+            tris = tris.make_copy()
+            tris.make_indexed()
+        dtype = _INDEX_TYPES[tris.get_index_type()]
+        indices.append(np.frombuffer(memoryview(tris.get_vertices()).cast('B'), dtype).astype(np.int64))
+
+    if not indices:
+        return np.empty((0, 3), np.int64)
+    return np.concatenate(indices).reshape(-1, 3)
+
+
+def decimate_geom(geom, cluster_size):
+    # Vertex clustering: every vertex snaps to the first vertex sharing its grid
+    # cell, triangles that collapse are dropped and unused vertices compacted away
+    vdata = geom.get_vertex_data()
+    tris = _triangles(geom)
+    if len(tris) == 0:
+        return None
+
+    positions = _positions(vdata)
+    cells = np.floor(positions / cluster_size).astype(np.int64)
+    _, first, inverse = np.unique(cells, axis=0, return_index=True, return_inverse=True)
+    tris = first[inverse.reshape(-1)][tris]
+    tris = tris[(tris[:, 0] != tris[:, 1]) & (tris[:, 1] != tris[:, 2]) & (tris[:, 0] != tris[:, 2])]
+    if len(tris) == 0:
+        return None
+
+    used, remap = np.unique(tris, return_inverse=True)
+    new_vdata = p3d.GeomVertexData(vdata)
+    new_vdata.set_num_rows(len(used))
+    for array_idx in range(vdata.get_num_arrays()):
+        rows = _array_rows(vdata, array_idx)[used]
+        new_vdata.modify_array_handle(array_idx).copy_data_from(rows.tobytes())
+
+    index_type = p3d.Geom.NT_uint16 if len(used) < 0xffff else p3d.Geom.NT_uint32
+    new_tris = p3d.GeomTriangles(p3d.Geom.UH_static)
+    new_tris.set_index_type(index_type)
+    indices = remap.reshape(-1).astype(_INDEX_TYPES[index_type])
+    new_tris.modify_vertices(len(indices)).modify_handle().copy_data_from(indices.tobytes())
+
+    new_geom = p3d.Geom(new_vdata)
+    new_geom.add_primitive(new_tris)
+    return new_geom
+
+
+def decimate(nodepath, cluster_size):
+    for geomnp in nodepath.find_all_matches('**/+GeomNode'):
+        node = geomnp.node()
+        for geom_idx in reversed(range(node.get_num_geoms())):
+            geom = decimate_geom(node.get_geom(geom_idx), cluster_size)
+            if geom is None:
+                node.remove_geom(geom_idx)
+            else:
+                node.set_geom(geom_idx, geom)
+
+
+def _make_occluder(geomnp, root):
+    points = []
+    for geom in geomnp.node().get_geoms():
+        points.extend(_positions(geom.get_vertex_data()))
+    if len(points) < 4:
+        return None
+
+    # The occluder is the quad spanned by the mesh, which should be a flat plane
+    mat = geomnp.get_mat(root)
+    points = np.array([tuple(mat.xform_point(p3d.LPoint3(*i))) for i in points])
+    center = points.mean(axis=0)
+    _, _, axes = np.linalg.svd(points - center)
+    extent_u = np.abs((points - center) @ axes[0]).max()
+    extent_v = np.abs((points - center) @ axes[1]).max()
+    corners = [
+        center + axes[0] * extent_u * sign_u + axes[1] * extent_v * sign_v
+        for sign_u, sign_v in ((-1, -1), (1, -1), (1, 1), (-1, 1))
+    ]
+
+    occluder = p3d.OccluderNode(geomnp.get_name())
+    occluder.set_vertices(*(p3d.LPoint3(*corner) for corner in corners))
+    occluder.set_double_sided(True)
+    return occluder
+
+
+def build_cells(level, cell_size=CELL_SIZE, lod_levels=LOD_LEVELS):
+    # Static meshes are pulled out of the level hierarchy into one batched
+    # node per grid cell. The original nodes (and any physics under them)
+    # stay where they are, just without geometry.
+    cells = {}
+    for geomnp in level.find_all_matches('**/+GeomNode'):
+        if geomnp.is_hidden() or geomnp.node().get_num_geoms() == 0:
+            continue
+
+        if geomnp.get_name().startswith(OCCLUDER_PREFIX):
+            occluder = _make_occluder(geomnp, level)
+            if occluder is not None:
+                level.attach_new_node(occluder)
+            geomnp.node().remove_all_geoms()
+            continue
+
+        lower, upper = geomnp.get_tight_bounds(level)
+        center = (lower + upper) / 2
+        key = (int(np.floor(center.x / cell_size)), int(np.floor(center.y / cell_size)))
+        if key not in cells:
+            cells[key] = p3d.NodePath('cell_{}_{}'.format(*key))
+
+        copy = p3d.NodePath(geomnp.node().make_copy())
+        copy.reparent_to(cells[key])
+        copy.set_transform(geomnp.get_transform(level))
+        copy.set_state(geomnp.get_net_state())
+        geomnp.node().remove_all_geoms()
+
+    cellsnp = level.attach_new_node('cells')
+    for _, cellnp in sorted(cells.items()):
+        cellnp.flatten_strong()
+
+        lower, upper = cellnp.get_tight_bounds()
+        lod = p3d.LODNode(cellnp.get_name())
+        lodnp = cellsnp.attach_new_node(lod)
+        lod.set_center((lower + upper) / 2)
+        for switch_in, switch_out, cluster_size in lod_levels:
+            levelnp = cellnp.copy_to(lodnp)
+            if cluster_size is not None:
+                decimate(levelnp, cluster_size)
+            lod.add_switch(switch_in, switch_out)
+
+    level.set_tag('lithium-cells', str(cell_size))
+    return cellsnp
+
+
+def build_file(src, dst, cell_size=CELL_SIZE):
+    node = p3d.Loader.get_global_ptr().load_sync(p3d.Filename.from_os_specific(src))
+    if node is None:
+        raise IOError('Could not load {}'.format(src))
+
+    # Only levels get split into cells, which are recognized by their player start
+    level = p3d.NodePath(node)
+    if level.find('**/PlayerStart').is_empty():
+        return None
+
+    cellsnp = build_cells(level, cell_size)
+    level.write_bam_file(p3d.Filename.from_os_specific(dst))
+    return cellsnp.get_num_children()
+
+
+def main(args):
+    srcdir, dstdir = args[-2:]
+
+    for root, dirs, files in os.walk(dstdir):
+        for asset in files:
+            if not asset.endswith('.bam') or asset.endswith(CELLS_SUFFIX):
+                continue
+
+            src = os.path.join(root, asset)
+            dst = src[:-len('.bam')] + CELLS_SUFFIX
+            if os.path.exists(dst) and os.stat(src).st_mtime <= os.stat(dst).st_mtime:
+                continue
+
+            stime = time.perf_counter()
+            num_cells = build_file(src, dst)
+            if num_cells is not None:
+                print('Built {} cells for {} in {:.2f}s'.format(num_cells, asset, time.perf_counter() - stime))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+# pman build hook, run as a script with the asset source and export directories.
+# Kept free of lithium imports since it runs outside of the game.
+import heapq
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+from panda3d import core as p3d
+from panda3d import bullet
+
+
+NAV_SUFFIX = '.nav'
+NAV_VERSION = 3
+CELL_SIZE = 0.25
+# Largest side of a navmesh region in cells, smaller regions give straighter paths
+MAX_REGION_CELLS = 32
+# Side of a cluster of the hierarchical graph in cells, regions never cross one
+CLUSTER_CELLS = 64
+# Runs of crossings between two clusters longer than this get two transitions
+LONG_TRANSITION = 4.0
+
+# The capsule of PhysicsCharacterComponent, and the step and slope limits of
+# the kinematic controller, the only one that steps up ledges
+AGENT_RADIUS = 0.4
+AGENT_HEIGHT = 1.75
+STEP_HEIGHT = 0.35
+MAX_SLOPE = 50.0
+
+_CELL_BITS = 21
+_CELL_OFFSET = 1 << (_CELL_BITS - 1)
+
+# (dx, dy) for the east, north, west and south neighbors
+DIRECTIONS = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+
+
+def cell_keys(cx, cy):
+    return ((np.asarray(cx, np.int64) + _CELL_OFFSET) << _CELL_BITS) | (np.asarray(cy, np.int64) + _CELL_OFFSET)
+
+
+def make_world(level):
+    world = bullet.BulletWorld()
+    for bodynp in level.find_all_matches('**/+BulletBodyNode'):
+        if not bodynp.is_hidden():
+            world.attach(bodynp.node())
+    return world
+
+
+def level_bounds(level):
+    bounds = level.get_tight_bounds()
+    if bounds is not None:
+        return bounds
+
+    # Without any geometry, fall back to the collision shapes
+    lower = p3d.LPoint3(math.inf)
+    upper = p3d.LPoint3(-math.inf)
+    for bodynp in level.find_all_matches('**/+BulletBodyNode'):
+        shape_bounds = bodynp.node().get_shape_bounds()
+        center = bodynp.get_mat(level).xform_point(shape_bounds.get_center())
+        radius = shape_bounds.get_radius() * max(bodynp.get_scale(level))
+        lower = lower.fmin(center - radius)
+        upper = upper.fmax(center + radius)
+    return lower, upper
+
+
+def sample_surfaces(world, lower, upper, cell_size=CELL_SIZE, max_slope=MAX_SLOPE):
+    # One ray down every column of the grid, keeping each hit that is flat
+    # enough to stand on. Stacked floors give one surface each.
+    min_normal_z = math.cos(math.radians(max_slope))
+    num_x = int(math.ceil((upper.x - lower.x) / cell_size))
+    num_y = int(math.ceil((upper.y - lower.y) / cell_size))
+    top = upper.z + 1.0
+    bottom = lower.z - 1.0
+
+    cx, cy, heights = [], [], []
+    for iy in range(num_y):
+        y = lower.y + (iy + 0.5) * cell_size
+        for ix in range(num_x):
+            x = lower.x + (ix + 0.5) * cell_size
+            hits = world.ray_test_all(p3d.LPoint3(x, y, top), p3d.LPoint3(x, y, bottom)).get_hits()
+            last = None
+            for z, normal_z in sorted(((hit.get_hit_pos().z, hit.get_hit_normal().z) for hit in hits), reverse=True):
+                if normal_z < min_normal_z or (last is not None and last - z < 0.05):
+                    continue
+                cx.append(ix)
+                cy.append(iy)
+                heights.append(z)
+                last = z
+
+    return np.array(cx, np.int32), np.array(cy, np.int32), np.array(heights, np.float32)
+
+
+def filter_clearance(world, origin, cx, cy, heights, cell_size=CELL_SIZE,
+                     radius=AGENT_RADIUS, height=AGENT_HEIGHT, step_height=STEP_HEIGHT):
+    # A capsule from step height up to the top of the character has to fit,
+    # which keeps surfaces a radius away from walls and out from under low ceilings
+    probe_height = max(height - step_height, 2 * radius + 0.01)
+    probe = bullet.BulletGhostNode('NavProbe')
+    probe.add_shape(bullet.BulletCapsuleShape(radius, probe_height - 2 * radius, bullet.ZUp))
+    probenp = p3d.NodePath(probe)
+    world.attach(probe)
+
+    keep = np.zeros(len(heights), bool)
+    for idx in range(len(heights)):
+        probenp.set_pos(
+            origin.x + (cx[idx] + 0.5) * cell_size,
+            origin.y + (cy[idx] + 0.5) * cell_size,
+            heights[idx] + step_height + probe_height / 2
+        )
+        keep[idx] = world.contact_test(probe).get_num_contacts() == 0
+
+    world.remove(probe)
+    return keep
+
+
+def find_neighbors(cx, cy, heights, step_height=STEP_HEIGHT):
+    # For every surface and direction, the surface in the neighboring column
+    # closest in height, if it is within a step
+    order = np.lexsort((heights, cell_keys(cx, cy)))
+    sorted_keys = cell_keys(cx, cy)[order]
+    neighbors = np.full((len(DIRECTIONS), len(heights)), -1, np.int64)
+
+    for dir_idx, (dx, dy) in enumerate(DIRECTIONS):
+        keys = cell_keys(cx + dx, cy + dy)
+        start = np.searchsorted(sorted_keys, keys, 'left')
+        end = np.searchsorted(sorted_keys, keys, 'right')
+        best_dz = np.full(len(heights), np.inf)
+        for layer in range(int((end - start).max()) if len(heights) else 0):
+            candidate = start + layer
+            valid = candidate < end
+            other = order[np.minimum(candidate, len(order) - 1)]
+            dz = np.where(valid, np.abs(heights[other] - heights), np.inf)
+            better = (dz < best_dz) & (dz <= step_height)
+            neighbors[dir_idx][better] = other[better]
+            best_dz = np.where(better, dz, best_dz)
+
+    return neighbors
+
+
+def build_regions(cx, cy, neighbors, max_cells=MAX_REGION_CELLS, cluster_cells=CLUSTER_CELLS):
+    # Greedy rectangles of connected surfaces, grown east and then north
+    # without crossing into another cluster
+    east, north = neighbors[0], neighbors[1]
+    regions = np.full(len(cx), -1, np.int64)
+    rects = []
+    for idx in np.lexsort((cx, cy)):
+        if regions[idx] >= 0:
+            continue
+
+        cluster_x = cx[idx] // cluster_cells
+        cluster_y = cy[idx] // cluster_cells
+        row = [idx]
+        while (
+            len(row) < max_cells and east[row[-1]] >= 0 and regions[east[row[-1]]] < 0 and
+            cx[east[row[-1]]] // cluster_cells == cluster_x
+        ):
+            row.append(east[row[-1]])
+        rows = [row]
+        while len(rows) < max_cells:
+            above = [north[i] for i in rows[-1]]
+            if any(i < 0 or regions[i] >= 0 for i in above) or cy[above[0]] // cluster_cells != cluster_y:
+                break
+            if any(east[above[i]] != above[i + 1] for i in range(len(above) - 1)):
+                break
+            rows.append(above)
+
+        region = len(rects)
+        for cells in rows:
+            regions[cells] = region
+        rects.append((cx[row[0]], cy[row[0]], cx[row[-1]], cy[rows[-1][0]]))
+
+    return regions, np.array(rects, np.int32).reshape(-1, 4)
+
+
+def build_portals(cx, cy, heights, regions, neighbors, origin, cell_size=CELL_SIZE):
+    # Edges between cells of different regions, merged into one portal segment
+    # per pair of regions
+    pair_a, pair_b, segments = [], [], []
+    for dir_idx, (dx, dy) in enumerate(DIRECTIONS):
+        other = neighbors[dir_idx]
+        crossing = (other >= 0) & (regions != regions[np.maximum(other, 0)])
+        idx = np.nonzero(crossing)[0]
+        # The shared edge of the two cells, in world space
+        edge_x = origin.x + (cx[idx] + (dx > 0)) * cell_size if dx else origin.x + cx[idx] * cell_size
+        edge_y = origin.y + (cy[idx] + (dy > 0)) * cell_size if dy else origin.y + cy[idx] * cell_size
+        seg = np.empty((len(idx), 5), np.float64)
+        seg[:, 0] = edge_x
+        seg[:, 1] = edge_y
+        seg[:, 2] = edge_x + (cell_size if dy else 0)
+        seg[:, 3] = edge_y + (cell_size if dx else 0)
+        seg[:, 4] = (heights[idx] + heights[other[idx]]) / 2
+        pair_a.append(regions[idx])
+        pair_b.append(regions[other[idx]])
+        segments.append(seg)
+
+    pair_a = np.concatenate(pair_a)
+    pair_b = np.concatenate(pair_b)
+    segments = np.concatenate(segments)
+
+    pairs, inverse = np.unique(np.stack([pair_a, pair_b], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    portals = np.empty((len(pairs), 5), np.float64)
+    portals[:, 0:2] = np.inf
+    portals[:, 2:4] = -np.inf
+    np.minimum.at(portals[:, 0], inverse, segments[:, 0])
+    np.minimum.at(portals[:, 1], inverse, segments[:, 1])
+    np.maximum.at(portals[:, 2], inverse, segments[:, 2])
+    np.maximum.at(portals[:, 3], inverse, segments[:, 3])
+    portals[:, 4] = np.bincount(inverse, segments[:, 4]) / np.bincount(inverse)
+
+    # Adjacency as offsets into a flat target list, sorted by source region
+    num_regions = int(regions.max()) + 1 if len(regions) else 0
+    offsets = np.searchsorted(pairs[:, 0], np.arange(num_regions + 1))
+    return offsets, pairs[:, 1], portals
+
+
+def region_centers(rects, cell_regions, heights, origin, cell_size=CELL_SIZE):
+    rects = rects.astype(np.float64)
+    center_x = origin[0] + (rects[:, 0] + rects[:, 2] + 1) / 2 * cell_size
+    center_y = origin[1] + (rects[:, 1] + rects[:, 3] + 1) / 2 * cell_size
+    counts = np.maximum(np.bincount(cell_regions, minlength=len(rects)), 1)
+    center_z = np.bincount(cell_regions, heights, minlength=len(rects)) / counts
+    return list(zip(center_x.tolist(), center_y.tolist(), center_z.tolist()))
+
+
+def cluster_distances(source, edges, centers, region_clusters, blocked=()):
+    # Dijkstra from a region to every region of its cluster it can reach
+    # without leaving the cluster. edges holds the neighbors of every region
+    cluster = region_clusters[source]
+    costs = {source: 0.0}
+    frontier = [(0.0, source)]
+    while frontier:
+        cost, current = heapq.heappop(frontier)
+        if cost > costs[current]:
+            continue
+        for target in edges[current]:
+            if region_clusters[target] != cluster or target in blocked:
+                continue
+            new_cost = cost + math.dist(centers[current], centers[target])
+            if new_cost < costs.get(target, math.inf):
+                costs[target] = new_cost
+                heapq.heappush(frontier, (new_cost, target))
+    return costs
+
+
+def find_transitions(regions, edges, centers, region_clusters, blocked=()):
+    # Crossings from the given regions into other clusters, grouped into runs
+    # of neighboring crossings along each border. One pair of regions stands
+    # in for each run in the hierarchical graph, keyed by the pair of clusters
+    crossings = {}
+    for region in regions:
+        if region in blocked:
+            continue
+        for target in edges[region]:
+            if target in blocked or region_clusters[target] == region_clusters[region]:
+                continue
+            pair = (region, target) if region_clusters[region] < region_clusters[target] else (target, region)
+            crossings.setdefault((region_clusters[pair[0]], region_clusters[pair[1]]), set()).add(pair)
+
+    transitions = {}
+    for key, pairs in crossings.items():
+        runs = []
+        for pair in sorted(pairs):
+            touching = [
+                run for run in runs
+                if any(
+                    pair[0] == other[0] or pair[1] == other[1] or
+                    pair[0] in edges[other[0]] or pair[1] in edges[other[1]]
+                    for other in run
+                )
+            ]
+            merged = [pair]
+            for run in touching:
+                runs.remove(run)
+                merged.extend(run)
+            runs.append(merged)
+
+        transitions[key] = []
+        for run in runs:
+            midpoints = [
+                [(a + b) / 2 for a, b in zip(centers[pair[0]], centers[pair[1]])]
+                for pair in run
+            ]
+            # Long runs get a transition at both ends, so paths along the
+            # border don't all detour through its middle
+            axis = 0 if max(i[0] for i in midpoints) - min(i[0] for i in midpoints) > max(i[1] for i in midpoints) - min(i[1] for i in midpoints) else 1
+            ends = sorted(range(len(run)), key=lambda idx: midpoints[idx][axis])
+            if midpoints[ends[-1]][axis] - midpoints[ends[0]][axis] > LONG_TRANSITION:
+                transitions[key].extend((run[ends[0]], run[ends[-1]]))
+            else:
+                transitions[key].append(run[ends[len(ends) // 2]])
+    return transitions
+
+
+def intra_cluster_edges(regions, nodes, edges, centers, region_clusters, blocked=()):
+    # Shortest distances between the transition regions of one cluster
+    entrances = [region for region in regions if region in nodes]
+    result = []
+    for source in entrances:
+        costs = cluster_distances(source, edges, centers, region_clusters, blocked)
+        result.extend((source, target, costs[target]) for target in entrances if target != source and target in costs)
+    return result
+
+
+def build_cluster_graph(rects, cell_regions, heights, offsets, targets, origin, cell_size=CELL_SIZE, cluster_cells=CLUSTER_CELLS):
+    cluster_keys = cell_keys(rects[:, 0] // cluster_cells, rects[:, 1] // cluster_cells)
+    _, region_clusters = np.unique(cluster_keys, return_inverse=True)
+    region_clusters = region_clusters.reshape(-1)
+
+    centers = region_centers(rects, cell_regions, heights, origin, cell_size)
+    edges = [targets[offsets[region]:offsets[region + 1]].tolist() for region in range(len(rects))]
+    cluster_list = region_clusters.tolist()
+    transitions = find_transitions(range(len(rects)), edges, centers, cluster_list)
+    transitions = [pair for pairs in transitions.values() for pair in pairs]
+    nodes = {region for pair in transitions for region in pair}
+
+    intra = []
+    for cluster in range(int(region_clusters.max()) + 1 if len(rects) else 0):
+        regions = np.nonzero(region_clusters == cluster)[0].tolist()
+        intra.extend(intra_cluster_edges(regions, nodes, edges, centers, cluster_list))
+
+    intra = np.array(intra, np.float64).reshape(-1, 3)
+    return (
+        region_clusters,
+        np.array(transitions, np.int32).reshape(-1, 2),
+        intra[:, :2].astype(np.int32),
+        intra[:, 2].astype(np.float32),
+    )
+
+
+def build_navmesh(level, cell_size=CELL_SIZE):
+    world = make_world(level)
+    lower, upper = level_bounds(level)
+
+    cx, cy, heights = sample_surfaces(world, lower, upper, cell_size)
+    keep = filter_clearance(world, lower, cx, cy, heights, cell_size)
+    cx, cy, heights = cx[keep], cy[keep], heights[keep]
+
+    neighbors = find_neighbors(cx, cy, heights)
+    regions, rects = build_regions(cx, cy, neighbors)
+    offsets, targets, portals = build_portals(cx, cy, heights, regions, neighbors, lower, cell_size)
+    region_clusters, transitions, intra_edges, intra_costs = build_cluster_graph(
+        rects, regions, heights, offsets, targets, (lower.x, lower.y), cell_size
+    )
+
+    return {
+        'version': np.array(NAV_VERSION),
+        'cell_size': np.array(cell_size),
+        'origin': np.array([lower.x, lower.y]),
+        'agent': np.array([AGENT_RADIUS, AGENT_HEIGHT, STEP_HEIGHT, MAX_SLOPE]),
+        'cells': np.stack([cx, cy], axis=1),
+        'heights': heights,
+        'cell_regions': regions.astype(np.int32),
+        'regions': rects,
+        'adjacency_offsets': offsets.astype(np.int32),
+        'adjacency_targets': targets.astype(np.int32),
+        'portals': portals.astype(np.float32),
+        'region_clusters': region_clusters.astype(np.int32),
+        'transitions': transitions,
+        'intra_edges': intra_edges,
+        'intra_costs': intra_costs,
+    }
+
+
+def build_file(src, dst, cell_size=CELL_SIZE):
+    node = p3d.Loader.get_global_ptr().load_sync(p3d.Filename.from_os_specific(src))
+    if node is None:
+        raise IOError('Could not load {}'.format(src))
+
+    # Only levels get a navmesh, which are recognized by their player start
+    level = p3d.NodePath(node)
+    if level.find('**/PlayerStart').is_empty() or level.find('**/+BulletBodyNode').is_empty():
+        return None
+
+    navmesh = build_navmesh(level, cell_size)
+    with open(dst, 'wb') as f:
+        np.savez(f, **navmesh)
+    return len(navmesh['regions'])
+
+
+def main(args):
+    srcdir, dstdir = args[-2:]
+
+    for root, dirs, files in os.walk(dstdir):
+        for asset in files:
+            # Cells hold the same level with its geometry batched, the original has the physics
+            if not asset.endswith('.bam') or asset.endswith('.cells.bam'):
+                continue
+
+            src = os.path.join(root, asset)
+            dst = src[:-len('.bam')] + NAV_SUFFIX
+            if os.path.exists(dst) and os.stat(src).st_mtime <= os.stat(dst).st_mtime:
+                with np.load(dst) as arrays:
+                    if int(arrays['version']) == NAV_VERSION:
+                        continue
+
+            stime = time.perf_counter()
+            num_regions = build_file(src, dst)
+            if num_regions is not None:
+                print('Built navmesh with {} regions for {} in {:.2f}s'.format(num_regions, asset, time.perf_counter() - stime))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
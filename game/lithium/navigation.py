@@ -0,0 +1,544 @@
+import collections
+import heapq
+import io
+import math
+import time
+
+import numpy as np
+
+from panda3d import core as p3d
+from bamboo import ecs
+
+from . import navbuild
+from .navbuild import cell_keys
+
+
+def _triarea2(apex, a, b):
+    # Positive when b is to the left of the line from apex through a
+    return (a[0] - apex[0]) * (b[1] - apex[1]) - (b[0] - apex[0]) * (a[1] - apex[1])
+
+
+def string_pull(start, goal, portals):
+    # Simple stupid funnel over (left, right) portal points, giving the corners
+    # of the shortest path through the corridor
+    portals = [(start, start)] + portals + [(goal, goal)]
+    path = [start]
+    apex = left = right = start
+    apex_idx = left_idx = right_idx = 0
+
+    idx = 1
+    while idx < len(portals):
+        portal_left, portal_right = portals[idx]
+
+        # Tighten the right side of the funnel
+        if _triarea2(apex, right, portal_right) >= 0:
+            if apex == right or _triarea2(apex, left, portal_right) < 0:
+                right = portal_right
+                right_idx = idx
+            else:
+                # Crossed over the left side, which becomes a corner
+                path.append(left)
+                apex = right = left
+                apex_idx = right_idx = left_idx
+                idx = apex_idx + 1
+                continue
+
+        # Tighten the left side of the funnel
+        if _triarea2(apex, left, portal_left) <= 0:
+            if apex == left or _triarea2(apex, right, portal_left) > 0:
+                left = portal_left
+                left_idx = idx
+            else:
+                path.append(right)
+                apex = left = right
+                apex_idx = left_idx = right_idx
+                idx = apex_idx + 1
+                continue
+
+        idx += 1
+
+    if path[-1] != goal:
+        path.append(goal)
+    return path
+
+
+class NavMesh:
+    __slots__ = [
+        'cell_size',
+        'origin',
+        'agent',
+        'heights',
+        'cell_regions',
+        'regions',
+        'region_clusters',
+        'blocked',
+        '_order',
+        '_sorted_keys',
+        '_centers',
+        '_edges',
+        '_portals',
+        '_midpoints',
+        '_cluster_regions',
+        '_transitions',
+        '_nodes',
+        '_abstract',
+        '_segments',
+        '_dirty_clusters',
+    ]
+
+    def __init__(self, data):
+        self.cell_size = float(data['cell_size'])
+        self.origin = tuple(float(i) for i in data['origin'])
+        self.agent = tuple(float(i) for i in data['agent'])
+        cells = data['cells']
+        self.heights = data['heights']
+        self.cell_regions = data['cell_regions']
+        self.regions = data['regions']
+
+        keys = cell_keys(cells[:, 0], cells[:, 1])
+        self._order = np.argsort(keys, kind='stable')
+        self._sorted_keys = keys[self._order]
+
+        # A* runs in plain Python, where lists are a lot faster to index than arrays
+        self._centers = navbuild.region_centers(self.regions, self.cell_regions, self.heights, self.origin, self.cell_size)
+        offsets = data['adjacency_offsets'].tolist()
+        targets = data['adjacency_targets'].tolist()
+        self._edges = [
+            dict((targets[edge], edge) for edge in range(offsets[region], offsets[region + 1]))
+            for region in range(len(self.regions))
+        ]
+        self._portals = data['portals'].tolist()
+        self._midpoints = [((x0 + x1) / 2, (y0 + y1) / 2, z) for x0, y0, x1, y1, z in self._portals]
+
+        # The hierarchical graph links pairs of regions on either side of each
+        # cluster border, and the ones in a cluster by their precomputed distance
+        self.region_clusters = data['region_clusters'].tolist()
+        self.blocked = set()
+        self._cluster_regions = collections.defaultdict(list)
+        for region, cluster in enumerate(self.region_clusters):
+            self._cluster_regions[cluster].append(region)
+        self._transitions = {}
+        for pair in data['transitions'].tolist():
+            key = (self.region_clusters[pair[0]], self.region_clusters[pair[1]])
+            self._transitions.setdefault(key, []).append(tuple(pair))
+        self._nodes = set()
+        self._abstract = {}
+        for (source, target), cost in zip(data['intra_edges'].tolist(), data['intra_costs'].tolist()):
+            self._abstract.setdefault(source, {})[target] = cost
+        self._link_transitions(self._transitions)
+        # Region corridors between the transitions of a cluster, found on first use
+        self._segments = {}
+        self._dirty_clusters = set()
+
+    @classmethod
+    def load(cls, path):
+        # Read through the VFS, so the navmesh can come from a mounted pack
+        vfs = p3d.VirtualFileSystem.get_global_ptr()
+        data = vfs.read_file(p3d.Filename(path), True)
+        with np.load(io.BytesIO(data)) as arrays:
+            if int(arrays['version']) != navbuild.NAV_VERSION:
+                raise IOError('{} was built by an older navbuild.py'.format(path))
+            return cls({key: arrays[key] for key in arrays.files})
+
+    def __len__(self):
+        return len(self.regions)
+
+    def find_cell(self, point, search=2):
+        # The surface below or closest in height to the point, looking a few
+        # cells around it for points that are off the eroded walkable area
+        cell_x = int(math.floor((point[0] - self.origin[0]) / self.cell_size))
+        cell_y = int(math.floor((point[1] - self.origin[1]) / self.cell_size))
+        for ring in range(search + 1):
+            best = -1
+            best_dist = math.inf
+            for offset_x in range(-ring, ring + 1):
+                for offset_y in range(-ring, ring + 1):
+                    if max(abs(offset_x), abs(offset_y)) != ring:
+                        continue
+                    key = int(cell_keys(cell_x + offset_x, cell_y + offset_y))
+                    start = np.searchsorted(self._sorted_keys, key, 'left')
+                    end = np.searchsorted(self._sorted_keys, key, 'right')
+                    for idx in self._order[start:end]:
+                        dist = abs(float(self.heights[idx]) - point[2]) + math.hypot(offset_x, offset_y) * self.cell_size
+                        if dist < best_dist:
+                            best = int(idx)
+                            best_dist = dist
+            if best >= 0:
+                return best
+        return -1
+
+    def find_region(self, point):
+        cell = self.find_cell(point)
+        return int(self.cell_regions[cell]) if cell >= 0 else -1
+
+    def regions_within(self, lower, upper):
+        # Regions overlapping an area of the level, such as a streamed chunk
+        rects = self.regions
+        min_x = self.origin[0] + rects[:, 0] * self.cell_size
+        min_y = self.origin[1] + rects[:, 1] * self.cell_size
+        max_x = self.origin[0] + (rects[:, 2] + 1) * self.cell_size
+        max_y = self.origin[1] + (rects[:, 3] + 1) * self.cell_size
+        overlap = (min_x < upper[0]) & (max_x > lower[0]) & (min_y < upper[1]) & (max_y > lower[1])
+        return np.nonzero(overlap)[0].tolist()
+
+    def set_blocked(self, regions, blocked=True):
+        # Only the clusters around the changed regions get their distances
+        # recomputed, on the next search
+        regions = set(regions)
+        if blocked:
+            self.blocked |= regions
+        else:
+            self.blocked -= regions
+        for region in regions:
+            self._dirty_clusters.add(self.region_clusters[region])
+            self._dirty_clusters.update(self.region_clusters[target] for target in self._edges[region])
+
+    def _link_transitions(self, transitions):
+        for pairs in transitions.values():
+            for region, target in pairs:
+                cost = math.dist(self._centers[region], self._centers[target])
+                self._abstract.setdefault(region, {})[target] = cost
+                self._abstract.setdefault(target, {})[region] = cost
+                self._nodes.update((region, target))
+
+    def _update_clusters(self):
+        # Transitions of the changed clusters are found again, which can add or
+        # remove nodes of the clusters next to them as well
+        dirty = self._dirty_clusters
+        regions = [region for cluster in dirty for region in self._cluster_regions[cluster]]
+        transitions = navbuild.find_transitions(regions, self._edges, self._centers, self.region_clusters, self.blocked)
+        affected = set(dirty)
+        for key in list(self._transitions):
+            if key[0] in dirty or key[1] in dirty:
+                affected.update(key)
+                del self._transitions[key]
+        for key in transitions:
+            affected.update(key)
+        self._transitions.update(transitions)
+
+        self._nodes = {region for pairs in self._transitions.values() for pair in pairs for region in pair}
+        for cluster in affected:
+            regions = self._cluster_regions[cluster]
+            for region in regions:
+                self._abstract.pop(region, None)
+            for source, target, cost in navbuild.intra_cluster_edges(regions, self._nodes, self._edges, self._centers, self.region_clusters, self.blocked):
+                self._abstract.setdefault(source, {})[target] = cost
+        self._link_transitions({
+            key: pairs for key, pairs in self._transitions.items()
+            if key[0] in affected or key[1] in affected
+        })
+        self._segments.clear()
+        dirty.clear()
+
+    def search(self, start, goal, cluster=None):
+        # A* over regions, optionally kept inside one cluster. Steps are measured
+        # between the portals a region is entered and left through, which follows
+        # the walkable area much closer than going from center to center
+        if start in self.blocked or goal in self.blocked:
+            return None
+
+        edges = self._edges
+        midpoints = self._midpoints
+        blocked = self.blocked
+        clusters = self.region_clusters
+        goal_center = self._centers[goal]
+        came_from = {start: None}
+        costs = {start: 0.0}
+        points = {start: self._centers[start]}
+        frontier = [(0.0, start)]
+        while frontier:
+            _, current = heapq.heappop(frontier)
+            if current == goal:
+                corridor = []
+                while current is not None:
+                    corridor.append(current)
+                    current = came_from[current]
+                corridor.reverse()
+                return corridor
+
+            current_cost = costs[current]
+            current_point = points[current]
+            for target, edge in edges[current].items():
+                if target in blocked or (cluster is not None and clusters[target] != cluster):
+                    continue
+                point = midpoints[edge]
+                cost = current_cost + math.dist(current_point, point)
+                if cost < costs.get(target, math.inf):
+                    costs[target] = cost
+                    came_from[target] = current
+                    points[target] = point
+                    heapq.heappush(frontier, (cost + math.dist(point, goal_center), target))
+
+        return None
+
+    def _entrance_costs(self, region):
+        costs = navbuild.cluster_distances(region, self._edges, self._centers, self.region_clusters, self.blocked)
+        return {
+            target: cost
+            for target, cost in costs.items()
+            if target != region and target in self._nodes
+        }
+
+    def _search_abstract(self, start, goal, start_links, goal_links):
+        # A* over the transitions, with the start and goal linked in
+        abstract = self._abstract
+        blocked = self.blocked
+        centers = self._centers
+        goal_center = centers[goal]
+        came_from = {start: None}
+        costs = {start: 0.0}
+        frontier = [(0.0, start)]
+        while frontier:
+            _, current = heapq.heappop(frontier)
+            if current == goal:
+                route = []
+                while current is not None:
+                    route.append(current)
+                    current = came_from[current]
+                route.reverse()
+                return route
+
+            links = abstract.get(current, {})
+            if current == start:
+                links = {**links, **start_links}
+            if current in goal_links:
+                links = dict(links)
+                links[goal] = goal_links[current]
+            current_cost = costs[current]
+            for target, step in links.items():
+                if target in blocked:
+                    continue
+                cost = current_cost + step
+                if cost < costs.get(target, math.inf):
+                    costs[target] = cost
+                    came_from[target] = current
+                    heapq.heappush(frontier, (cost + math.dist(centers[target], goal_center), target))
+
+        return None
+
+    def find_corridor(self, start, goal):
+        # Hierarchical A*: search the graph of cluster entrances, then refine
+        # each hop through a cluster with a search that stays inside it
+        if start in self.blocked or goal in self.blocked:
+            return None
+        if self._dirty_clusters:
+            self._update_clusters()
+
+        clusters = self.region_clusters
+        if clusters[start] == clusters[goal]:
+            corridor = self.search(start, goal, clusters[start])
+            if corridor is not None:
+                return corridor
+
+        # Start and goal join the graph through the entrances they can reach
+        start_links = self._entrance_costs(start)
+        goal_links = self._entrance_costs(goal)
+        route = self._search_abstract(start, goal, start_links, goal_links)
+        if route is None:
+            return None
+
+        corridor = [start]
+        for region, target in zip(route, route[1:]):
+            if clusters[region] != clusters[target]:
+                corridor.append(target)
+                continue
+            # Hops from the start or to the goal are only searched once
+            segment = self._segments.get((region, target))
+            if segment is None:
+                segment = self.search(region, target, clusters[region])
+                if segment is None:
+                    return None
+                if region in self._nodes and target in self._nodes:
+                    self._segments[(region, target)] = segment
+            corridor.extend(segment[1:])
+        return corridor
+
+    def corridor_portals(self, corridor):
+        portals = []
+        for region, target in zip(corridor, corridor[1:]):
+            x0, y0, x1, y1, z = self._portals[self._edges[region][target]]
+            center = self._centers[region]
+            direction = (self._centers[target][0] - center[0], self._centers[target][1] - center[1])
+            first = (x0, y0, z)
+            second = (x1, y1, z)
+            # Sort the ends by which side of the direction of travel they are on
+            if direction[0] * (y0 - center[1]) - direction[1] * (x0 - center[0]) > 0:
+                portals.append((first, second))
+            else:
+                portals.append((second, first))
+        return portals
+
+    def find_path(self, start, goal, corridor=None):
+        if corridor is None:
+            corridor = self.find_corridor(self.find_region(start), self.find_region(goal))
+            if corridor is None:
+                return None
+        start = (start[0], start[1], start[2])
+        goal = (goal[0], goal[1], goal[2])
+        return [p3d.LPoint3(*point) for point in string_pull(start, goal, self.corridor_portals(corridor))]
+
+
+class NavigationSystem(ecs.System):
+    __slots__ = [
+        'navmesh',
+        'hierarchical',
+        'budget',
+        'cache_size',
+        'cache_hits',
+        'cache_misses',
+        '_requests',
+        '_cache',
+        '_repath',
+        '_mismatches',
+    ]
+
+    component_types = [
+        'NAV_AGENT',
+        'CROWD_AGENT',
+    ]
+    reads = [
+        'NODEPATH',
+        'PHY_CHARACTER',
+        'TRANSFORM',
+    ]
+    writes = [
+        'NAV_AGENT',
+        'CROWD_AGENT',
+        'CHARACTER',
+    ]
+
+    def __init__(self, navmesh=None, budget=0.002, cache_size=512, hierarchical=True):
+        super().__init__()
+
+        self.navmesh = navmesh
+        self.hierarchical = hierarchical
+        self.budget = budget
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._requests = collections.deque()
+        self._cache = collections.OrderedDict()
+        self._repath = False
+        self._mismatches = set()
+
+    def set_navmesh(self, navmesh):
+        self.navmesh = navmesh
+        self._cache.clear()
+        self._mismatches.clear()
+
+    def check_agent(self, phys):
+        # Agents wider or taller than the build, or stepping lower, get paths
+        # they can't follow. Each size is reported once per navmesh
+        radius, height, step_height = self.navmesh.agent[:3]
+        size = (phys.radius, phys.height, phys.step_height)
+        if size in self._mismatches:
+            return
+        if phys.radius > radius or phys.height > height or phys.step_height < step_height:
+            self._mismatches.add(size)
+            print("Navmesh was built for radius {}, height {}, step {} but an agent has radius {}, height {}, step {}".format(
+                radius, height, step_height, *size
+            ))
+
+    def set_blocked(self, regions, blocked=True):
+        # For a streamed chunk going away or coming back, see NavMesh.regions_within.
+        # Cached corridors may run through the changed regions, so agents repath
+        self.navmesh.set_blocked(regions, blocked)
+        self._cache.clear()
+        self._repath = True
+
+    def request_path(self, agent, goal=None):
+        if goal is not None:
+            agent.goal = p3d.LPoint3(goal)
+        if not agent.pending:
+            agent.pending = True
+            self._requests.append(agent)
+
+    def find_corridor(self, start_region, goal_region):
+        # Corridors are cached rather than paths, agents starting and ending in
+        # the same regions share them and only redo the cheap string pulling
+        key = (start_region, goal_region)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return self._cache[key]
+
+        self.cache_misses += 1
+        if self.hierarchical:
+            corridor = self.navmesh.find_corridor(start_region, goal_region)
+        else:
+            corridor = self.navmesh.search(start_region, goal_region)
+        self._cache[key] = corridor
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return corridor
+
+    def find_path(self, start, goal):
+        start_region = self.navmesh.find_region(start)
+        goal_region = self.navmesh.find_region(goal)
+        if start_region < 0 or goal_region < 0:
+            return None
+        corridor = self.find_corridor(start_region, goal_region)
+        if corridor is None:
+            return None
+        return self.navmesh.find_path(start, goal, corridor)
+
+    def process_requests(self):
+        # Requests are spread over frames, but at least one goes through each
+        # frame. Without a budget every queued request goes through, so the
+        # paths agents get don't depend on how fast the machine is
+        deadline = None if self.budget is None else time.perf_counter() + self.budget
+        processed = 0
+        while self._requests and (deadline is None or processed == 0 or time.perf_counter() < deadline):
+            agent = self._requests.popleft()
+            agent.pending = False
+            start = agent.entity.get_component('NODEPATH').nodepath.get_pos(base.render)
+            agent.path = self.find_path(start, agent.goal)
+            agent.waypoint = 1
+            processed += 1
+        return processed
+
+    def init_components(self, dt, components):
+        for agent in components.get('NAV_AGENT', []):
+            if self.navmesh is not None:
+                self.check_agent(agent.entity.get_component('PHY_CHARACTER'))
+            self.request_path(agent)
+
+    def update(self, dt, components):
+        if self.navmesh is None:
+            return
+
+        if self._repath:
+            for agent in components.get('NAV_AGENT', []):
+                if agent.path is not None:
+                    self.request_path(agent)
+            self._repath = False
+        self.process_requests()
+
+        crowd_agents = {
+            agent.entity: agent
+            for agent in components.get('CROWD_AGENT', [])
+        }
+        for agent in components.get('NAV_AGENT', []):
+            if agent.path is None or agent.waypoint >= len(agent.path):
+                continue
+
+            # Move on to the next corner once close enough to the current one
+            pos = agent.entity.get_component('NODEPATH').nodepath.get_pos(base.render)
+            target = agent.path[agent.waypoint]
+            while agent.waypoint < len(agent.path) - 1 and (target.xy - pos.xy).length() < agent.arrive_radius:
+                agent.waypoint += 1
+                target = agent.path[agent.waypoint]
+
+            # Crowd agents steer toward the corner themselves, others walk straight at it
+            crowd_agent = crowd_agents.get(agent.entity)
+            if crowd_agent is not None:
+                crowd_agent.goal = p3d.LVector3(target)
+            else:
+                char = agent.entity.get_component('CHARACTER')
+                movement = p3d.LVector3(target.x - pos.x, target.y - pos.y, 0)
+                if agent.waypoint == len(agent.path) - 1 and movement.length() < agent.arrive_radius:
+                    movement = p3d.LVector3(0, 0, 0)
+                    agent.waypoint += 1
+                elif movement.length() > 0:
+                    movement.normalize()
+                char.movement = movement
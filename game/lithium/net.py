@@ -0,0 +1,565 @@
+import collections
+import heapq
+import random
+import socket
+import struct
+import time
+import zlib
+
+import numpy as np
+
+from panda3d import core as p3d
+from panda3d import bullet
+from bamboo import ecs
+
+from . import components
+from . import rewind
+from . import snapshot
+
+
+MAGIC = b'LTNP'
+VERSION = 1
+
+MSG_INPUT = 1
+MSG_SNAPSHOT = 2
+
+TICK_RATE = 60
+
+_NO_TICK = 0xFFFFFFFF
+
+_HEADER = struct.Struct('<4sBB')
+# ack tick, number of inputs that follow
+_INPUT_HEADER = struct.Struct('<IB')
+# seq, move_x, move_y, flags
+_INPUT = struct.Struct('<IffB')
+# tick, baseline tick, last processed input, player index, number of characters
+_SNAPSHOT_HEADER = struct.Struct('<IIIhH')
+
+_FLAG_JUMP = 1 << 0
+
+# Inputs are resent until acknowledged so a lost packet doesn't lose input
+MAX_REDUNDANT_INPUTS = 8
+HISTORY_SIZE = 64
+
+
+NetInput = collections.namedtuple('NetInput', [
+    'seq',
+    'move_x',
+    'move_y',
+    'jump',
+])
+
+
+class NetError(Exception):
+    pass
+
+
+def parse_address(address, default_port=7777):
+    # Resolved up front since packets are matched against the address they came from
+    host, _, port = address.rpartition(':')
+    if not host:
+        host, port = address, default_port
+    return socket.gethostbyname(host), int(port)
+
+
+class Channel:
+    __slots__ = [
+        'latency',
+        'jitter',
+        'loss',
+        'clock',
+        'bytes_sent',
+        'bytes_received',
+        'packets_sent',
+        'packets_received',
+        'packets_dropped',
+        '_socket',
+        '_pending',
+        '_sequence',
+        '_random',
+    ]
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0, loss=0.0, clock=time.monotonic, seed=None):
+        # Latency, jitter and loss are simulated on the sending side so two
+        # channels on loopback behave like a real link in both directions
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.clock = clock
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.packets_sent = 0
+        self.packets_received = 0
+        self.packets_dropped = 0
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._socket.bind(address)
+        self._pending = []
+        self._sequence = 0
+        self._random = random.Random(seed)
+
+    @property
+    def address(self):
+        return self._socket.getsockname()
+
+    def send(self, data, address):
+        self.bytes_sent += len(data)
+        self.packets_sent += 1
+        if self.loss and self._random.random() < self.loss:
+            self.packets_dropped += 1
+            return
+
+        if self.latency or self.jitter:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            heapq.heappush(self._pending, (self.clock() + delay, self._sequence, data, address))
+            self._sequence += 1
+        else:
+            self._socket.sendto(data, address)
+
+    def flush(self):
+        now = self.clock()
+        while self._pending and self._pending[0][0] <= now:
+            _, _, data, address = heapq.heappop(self._pending)
+            self._socket.sendto(data, address)
+
+    def receive(self):
+        self.flush()
+        packets = []
+        while True:
+            try:
+                data, address = self._socket.recvfrom(65535)
+            except (BlockingIOError, ConnectionResetError):
+                break
+            self.bytes_received += len(data)
+            self.packets_received += 1
+            packets.append((data, address))
+        return packets
+
+    def close(self):
+        self._socket.close()
+
+
+def _pack_header(msg_type):
+    return _HEADER.pack(MAGIC, VERSION, msg_type)
+
+
+def _unpack_header(data):
+    if len(data) < _HEADER.size:
+        raise NetError('Packet is too short')
+    magic, version, msg_type = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise NetError('Packet is not from a compatible peer')
+    return msg_type
+
+
+def pack_inputs(ack_tick, inputs):
+    parts = [_pack_header(MSG_INPUT), _INPUT_HEADER.pack(ack_tick, len(inputs))]
+    for netinput in inputs:
+        flags = _FLAG_JUMP if netinput.jump else 0
+        parts.append(_INPUT.pack(netinput.seq, netinput.move_x, netinput.move_y, flags))
+    return b''.join(parts)
+
+
+def unpack_inputs(data):
+    offset = _HEADER.size
+    ack_tick, count = _INPUT_HEADER.unpack_from(data, offset)
+    offset += _INPUT_HEADER.size
+    inputs = [
+        NetInput(seq, move_x, move_y, bool(flags & _FLAG_JUMP))
+        for seq, move_x, move_y, flags in _INPUT.iter_unpack(data[offset:offset + count * _INPUT.size])
+    ]
+    return ack_tick, inputs
+
+
+def pack_snapshot(tick, values, baseline_tick, baseline, last_input, player_index, num_characters):
+    # Unchanged fields turn into runs of zeros against the baseline, which zlib squeezes out
+    delta = values if baseline is None else values - baseline
+    return b''.join([
+        _pack_header(MSG_SNAPSHOT),
+        _SNAPSHOT_HEADER.pack(
+            tick,
+            baseline_tick if baseline is not None else _NO_TICK,
+            last_input,
+            player_index,
+            num_characters
+        ),
+        zlib.compress(delta.astype('<i4').tobytes(), 1),
+    ])
+
+
+def unpack_snapshot(data, baselines):
+    offset = _HEADER.size
+    tick, baseline_tick, last_input, player_index, num_characters = _SNAPSHOT_HEADER.unpack_from(data, offset)
+    values = np.frombuffer(zlib.decompress(data[offset + _SNAPSHOT_HEADER.size:]), '<i4').astype(np.int32)
+    if baseline_tick != _NO_TICK:
+        baseline = baselines.get(baseline_tick)
+        if baseline is None or len(baseline) != len(values):
+            raise NetError('Snapshot {} is based on unknown snapshot {}'.format(tick, baseline_tick))
+        values = values + baseline
+    return tick, values, last_input, player_index, num_characters
+
+
+def apply_input(char, netinput):
+    char.movement = p3d.LVector3(netinput.move_x, netinput.move_y, 0)
+    if netinput.jump:
+        char.jump = True
+
+
+class _ClientState:
+    __slots__ = [
+        'address',
+        'entity',
+        'inputs',
+        'last_input',
+        'last_movement',
+        'ack_tick',
+        'last_heard',
+    ]
+
+    def __init__(self, address, entity, now):
+        self.address = address
+        self.entity = entity
+        self.inputs = {}
+        self.last_input = 0
+        self.last_movement = (0.0, 0.0)
+        self.ack_tick = _NO_TICK
+        self.last_heard = now
+
+
+class NetServerSystem(ecs.System):
+    __slots__ = [
+        'channel',
+        'spawn',
+        'despawn',
+        'snapshot_interval',
+        'max_clients',
+        'timeout',
+        'clients',
+        'clients_rejected',
+        'tick',
+        '_history',
+    ]
+
+    component_types = [
+        'CHARACTER',
+    ]
+
+    def __init__(self, channel, spawn, snapshot_interval=2, max_clients=8, timeout=10.0, despawn=None):
+        super().__init__()
+
+        self.channel = channel
+        self.spawn = spawn
+        self.despawn = despawn
+        self.snapshot_interval = snapshot_interval
+        self.max_clients = max_clients
+        # Seconds without input before a client is dropped and its character removed
+        self.timeout = timeout
+        self.clients = {}
+        self.clients_rejected = 0
+        self.tick = 0
+        self._history = collections.OrderedDict()
+
+    def _receive(self):
+        now = self.channel.clock()
+        for data, address in self.channel.receive():
+            try:
+                if _unpack_header(data) != MSG_INPUT:
+                    continue
+                ack_tick, inputs = unpack_inputs(data)
+            except (NetError, struct.error):
+                continue
+
+            client = self.clients.get(address)
+            if client is None:
+                # Only a packet carrying input gets a character, and only while
+                # there is room, so stray packets can't fill the world
+                if not inputs or len(self.clients) >= self.max_clients:
+                    self.clients_rejected += 1
+                    continue
+                client = _ClientState(address, self.spawn(), now)
+                self.clients[address] = client
+                print("Client {}:{} connected".format(*address))
+            client.last_heard = now
+
+            if ack_tick != _NO_TICK and (client.ack_tick == _NO_TICK or ack_tick > client.ack_tick):
+                client.ack_tick = ack_tick
+            for netinput in inputs:
+                if netinput.seq > client.last_input:
+                    client.inputs[netinput.seq] = netinput
+
+    def _send_snapshots(self, characters):
+        values = rewind.quantize(snapshot.capture(characters, [], []))
+        self._history[self.tick] = values
+        while len(self._history) > HISTORY_SIZE:
+            self._history.popitem(last=False)
+
+        for client in self.clients.values():
+            try:
+                player_index = characters.index(client.entity.get_component('CHARACTER'))
+            except ValueError:
+                # The client's character hasn't been picked up by the ECS yet
+                player_index = -1
+
+            baseline = self._history.get(client.ack_tick)
+            if baseline is not None and len(baseline) != len(values):
+                baseline = None
+
+            self.channel.send(pack_snapshot(
+                self.tick,
+                values,
+                client.ack_tick,
+                baseline,
+                client.last_input,
+                player_index,
+                len(characters)
+            ), client.address)
+
+    def _drop_silent_clients(self):
+        now = self.channel.clock()
+        for client in [client for client in self.clients.values() if now - client.last_heard > self.timeout]:
+            del self.clients[client.address]
+            if self.despawn is not None:
+                self.despawn(client.entity)
+            print("Client {}:{} timed out".format(*client.address))
+
+    def update(self, dt, components):
+        characters = components.get('CHARACTER', [])
+
+        # The world state at the start of a tick is the result of every input
+        # processed so far, which is what clients reconcile against
+        if self.tick % self.snapshot_interval == 0:
+            self._send_snapshots(characters)
+        else:
+            self.channel.flush()
+
+        self._receive()
+        self._drop_silent_clients()
+
+        # Each client gets exactly one input per tick, just like its own prediction
+        for client in self.clients.values():
+            char = client.entity.get_component('CHARACTER')
+            netinput = client.inputs.pop(client.last_input + 1, None)
+            if netinput is None and client.inputs:
+                # Inputs that never arrived are skipped rather than waited for
+                seq = min(client.inputs)
+                netinput = client.inputs.pop(seq)
+            if netinput is None:
+                # Starved, keep going the way the client was last headed
+                char.movement = p3d.LVector3(*client.last_movement, 0)
+                continue
+
+            apply_input(char, netinput)
+            client.last_input = netinput.seq
+            client.last_movement = (netinput.move_x, netinput.move_y)
+
+        self.tick += 1
+
+
+class NetClient:
+    __slots__ = [
+        'channel',
+        'server_address',
+        'player',
+        'physics_system',
+        'spawn_proxy',
+        'dt',
+        'tolerance',
+        'timeout',
+        'timed_out',
+        'proxies',
+        'rtt',
+        'corrections',
+        'prediction_error',
+        'snapshots_received',
+        '_seq',
+        '_unacked',
+        '_predicted',
+        '_sent_times',
+        '_baselines',
+        '_last_tick',
+        '_last_heard',
+        '_prediction_characters',
+        '_prediction_physics',
+        '_prediction_statics',
+        '_prediction_copies',
+    ]
+
+    def __init__(self, channel, server_address, player, physics_system, spawn_proxy, dt=1/TICK_RATE, tolerance=0.05, timeout=5.0):
+        self.channel = channel
+        self.server_address = server_address
+        self.player = player
+        self.physics_system = physics_system
+        self.spawn_proxy = spawn_proxy
+        self.dt = dt
+        self.tolerance = tolerance
+        # Seconds without a snapshot before the server counts as gone
+        self.timeout = timeout
+        self.timed_out = False
+        self.proxies = []
+        self.rtt = None
+        self.corrections = 0
+        self.prediction_error = 0.0
+        self.snapshots_received = 0
+
+        self._seq = 0
+        self._unacked = collections.OrderedDict()
+        self._predicted = {}
+        self._sent_times = {}
+        self._baselines = collections.OrderedDict()
+        self._last_tick = _NO_TICK
+        self._last_heard = channel.clock()
+
+        # Replayed inputs only move the player, so they run in a world of
+        # their own holding the player and copies of the static level, and
+        # nothing else in the shared world gets stepped ahead of the server
+        self._prediction_characters = components.CharacterSystem()
+        self._prediction_physics = components.PhysicsSystem()
+        self._prediction_statics = []
+        self._prediction_copies = []
+
+    def _player_state(self):
+        char = self.player.get_component('CHARACTER')
+        return snapshot.capture([char], [], []).characters[0]
+
+    def _sync_prediction_world(self, home):
+        statics = [body for body in home.get_rigid_bodies() if body.is_static()]
+        if statics == self._prediction_statics:
+            return
+
+        # A body can only live in one world, so the level is copied sharing its shapes
+        world = self._prediction_physics.physics_world
+        world.set_gravity(home.get_gravity())
+        for copy in self._prediction_copies:
+            world.remove(copy)
+        self._prediction_copies = []
+        for node in statics:
+            copy = bullet.BulletRigidBodyNode(node.get_name())
+            for shape_idx in range(node.get_num_shapes()):
+                copy.add_shape(node.get_shape(shape_idx), node.get_shape_transform(shape_idx))
+            copy.set_transform(p3d.NodePath.any_path(node).get_net_transform())
+            copy.set_into_collide_mask(node.get_into_collide_mask())
+            world.attach(copy)
+            self._prediction_copies.append(copy)
+        self._prediction_statics = statics
+
+    def _simulate(self, netinput):
+        char = self.player.get_component('CHARACTER')
+        phys = self.player.get_component('PHY_CHARACTER')
+        apply_input(char, netinput)
+        self._prediction_characters.update(self.dt, {'CHARACTER': [char]})
+        self._prediction_physics.update(self.dt, {'PHY_CHARACTER': [phys]})
+
+    def _reconcile(self, record, last_input):
+        predicted = self._predicted.get(last_input)
+        for seq in [seq for seq in self._predicted if seq <= last_input]:
+            del self._predicted[seq]
+        for seq in [seq for seq in self._unacked if seq <= last_input]:
+            del self._unacked[seq]
+        if predicted is None:
+            return
+
+        error = float(np.abs(predicted['position'] - record['position']).max())
+        self.prediction_error = error
+        if error <= self.tolerance:
+            return
+
+        # Snap back to the server's state and replay every input it hasn't seen yet
+        self.corrections += 1
+        char = self.player.get_component('CHARACTER')
+        server_state = snapshot.Snapshot(
+            record[None],
+            np.zeros(0, snapshot.AGENT_DTYPE),
+            np.zeros(0, snapshot.CAMERA_DTYPE)
+        )
+        snapshot.restore(server_state, [char], [], [])
+
+        phynode = self.player.get_component('PHY_CHARACTER').physics_node
+        home = self.physics_system.world_for(self.player.get_component('PHY_CHARACTER'))
+        self._sync_prediction_world(home)
+        home.remove(phynode)
+        self._prediction_physics.physics_world.attach(phynode)
+        try:
+            for seq, netinput in self._unacked.items():
+                self._simulate(netinput)
+                self._predicted[seq] = self._player_state()
+        finally:
+            self._prediction_physics.physics_world.remove(phynode)
+            home.attach(phynode)
+
+    def _update_proxies(self, records, player_index):
+        while len(self.proxies) < len(records):
+            self.proxies.append(self.spawn_proxy())
+        while len(self.proxies) > len(records):
+            self.proxies.pop().remove_node()
+
+        for idx, (proxy, record) in enumerate(zip(self.proxies, records)):
+            if idx == player_index:
+                proxy.hide()
+                continue
+            proxy.show()
+            proxy.set_pos(base.render, p3d.LPoint3(*record['position']))
+            proxy.set_h(float(record['rotation']))
+
+    def _receive(self):
+        latest = None
+        for data, address in self.channel.receive():
+            try:
+                if address != self.server_address or _unpack_header(data) != MSG_SNAPSHOT:
+                    continue
+                tick, values, last_input, player_index, num_characters = unpack_snapshot(data, self._baselines)
+            except (NetError, struct.error, zlib.error):
+                continue
+
+            self.snapshots_received += 1
+            self._last_heard = self.channel.clock()
+            if self.timed_out:
+                self.timed_out = False
+                print("Server {}:{} is back".format(*self.server_address))
+            self._baselines[tick] = values
+            while len(self._baselines) > HISTORY_SIZE:
+                self._baselines.popitem(last=False)
+            if self._last_tick == _NO_TICK or tick > self._last_tick:
+                self._last_tick = tick
+                latest = (values, last_input, player_index, num_characters)
+
+        if latest is None:
+            return
+
+        values, last_input, player_index, num_characters = latest
+        sent = self._sent_times.pop(last_input, None)
+        if sent is not None:
+            self.rtt = self.channel.clock() - sent
+        for seq in [seq for seq in self._sent_times if seq < last_input]:
+            del self._sent_times[seq]
+
+        records = rewind.dequantize(values, num_characters, 0).characters
+        self._update_proxies(records, player_index)
+        if 0 <= player_index < num_characters:
+            self._reconcile(records[player_index], last_input)
+
+    def tick(self):
+        # The state reached by simulating the previous input is its prediction
+        if self._seq:
+            self._predicted[self._seq] = self._player_state()
+
+        self._receive()
+        if not self.timed_out and self.channel.clock() - self._last_heard > self.timeout:
+            # Keep sending input so the game picks up again if the server comes back
+            self.timed_out = True
+            self._update_proxies([], -1)
+            print("Lost connection to server {}:{}".format(*self.server_address))
+
+        # Send the input the way the server will see it so both simulate the same values
+        char = self.player.get_component('CHARACTER')
+        self._seq += 1
+        packed = _INPUT.unpack(_INPUT.pack(self._seq, char.movement.x, char.movement.y, 0))
+        netinput = NetInput(self._seq, packed[1], packed[2], char.jump)
+        self._unacked[self._seq] = netinput
+        while len(self._unacked) > HISTORY_SIZE:
+            self._unacked.popitem(last=False)
+        self._sent_times[self._seq] = self.channel.clock()
+
+        recent = list(self._unacked.values())[-MAX_REDUNDANT_INPUTS:]
+        self.channel.send(pack_inputs(self._last_tick, recent), self.server_address)
+        apply_input(char, netinput)
@@ -0,0 +1,129 @@
+import collections
+import struct
+import time
+
+from bamboo import ecs
+
+
+MAGIC = b'LTHI'
+VERSION = 2
+
+_HEADER = struct.Struct('<4sH')
+# Doubles keep replayed dt, analog movement and look deltas bit-identical to the live session
+_FRAME = struct.Struct('<dddBdd')
+
+_FLAG_JUMP = 1 << 0
+
+
+InputFrame = collections.namedtuple('InputFrame', [
+    'dt',
+    'move_x',
+    'move_y',
+    'jump',
+    'delta_yaw',
+    'delta_pitch',
+])
+
+
+class ReplayError(Exception):
+    pass
+
+
+class InputRecorder:
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION))
+        self.num_frames = 0
+
+    def record(self, frame):
+        flags = _FLAG_JUMP if frame.jump else 0
+        self._file.write(_FRAME.pack(
+            frame.dt,
+            frame.move_x,
+            frame.move_y,
+            flags,
+            frame.delta_yaw,
+            frame.delta_pitch
+        ))
+        self.num_frames += 1
+
+    def close(self):
+        self._file.close()
+
+
+class InputPlayer:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        if len(data) < _HEADER.size:
+            raise ReplayError('{} is too short to be an input recording'.format(path))
+        magic, version = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ReplayError('{} is not an input recording'.format(path))
+        if version != VERSION:
+            raise ReplayError('{} has unsupported version {}'.format(path, version))
+
+        body = memoryview(data)[_HEADER.size:]
+        usable = len(body) - len(body) % _FRAME.size
+        self._frames = [
+            InputFrame(dt, move_x, move_y, bool(flags & _FLAG_JUMP), delta_yaw, delta_pitch)
+            for dt, move_x, move_y, flags, delta_yaw, delta_pitch in _FRAME.iter_unpack(body[:usable])
+        ]
+        self._next = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def finished(self):
+        return self._next >= len(self._frames)
+
+    def next_frame(self):
+        if self.finished:
+            return None
+        frame = self._frames[self._next]
+        self._next += 1
+        return frame
+
+
+class TimedSystem(ecs.System):
+    __slots__ = [
+        'system',
+        'component_types',
+        'reads',
+        'writes',
+        'times',
+    ]
+
+    def __init__(self, system):
+        super().__init__()
+
+        self.system = system
+        self.component_types = system.component_types
+        self.reads = getattr(system, 'reads', [])
+        self.writes = getattr(system, 'writes', None)
+        self.times = []
+
+    def init_components(self, dt, components):
+        self.system.init_components(dt, components)
+
+    def update(self, dt, components):
+        stime = time.perf_counter()
+        self.system.update(dt, components)
+        self.times.append(time.perf_counter() - stime)
+
+
+def summarize(name, times):
+    if not times:
+        return '{:<24} no samples'.format(name)
+
+    ordered = sorted(times)
+    mean = sum(ordered) / len(ordered)
+    return '{:<24} mean {:7.3f} ms  p50 {:7.3f} ms  p95 {:7.3f} ms  max {:7.3f} ms'.format(
+        name,
+        mean * 1000,
+        ordered[len(ordered) // 2] * 1000,
+        ordered[int(len(ordered) * 0.95)] * 1000,
+        ordered[-1] * 1000
+    )
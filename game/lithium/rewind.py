@@ -0,0 +1,211 @@
+import numpy as np
+
+from bamboo import ecs
+
+from . import snapshot
+
+
+# Quantization steps: millimeters, millimeters per second and hundredths of a degree
+_CHARACTER_FIELDS = [
+    ('position', 0.001),
+    ('velocity', 0.001),
+    ('movement', 0.001),
+    ('rotation', 0.01),
+    ('move_speed', 0.001),
+]
+_CHARACTER_FLAGS = ['jump', 'airborne', 'sleeping', 'kinematic']
+_CAMERA_FIELDS = [
+    ('yaw', 0.01),
+    ('pitch', 0.01),
+    ('distance', 0.001),
+]
+
+_DELTA_MIN = np.iinfo(np.int16).min
+_DELTA_MAX = np.iinfo(np.int16).max
+
+
+def _field_width(dtype, name):
+    shape = dtype[name].shape
+    return shape[0] if shape else 1
+
+
+_CHARACTER_WIDTH = sum(_field_width(snapshot.CHARACTER_DTYPE, name) for name, _ in _CHARACTER_FIELDS) + 1
+_CAMERA_WIDTH = len(_CAMERA_FIELDS)
+
+
+def quantize(snap):
+    chars = snap.characters
+    columns = [
+        np.round(chars[name].reshape(len(chars), _field_width(chars.dtype, name)) / step)
+        for name, step in _CHARACTER_FIELDS
+    ]
+    flags = np.zeros(len(chars))
+    for bit, name in enumerate(_CHARACTER_FLAGS):
+        flags += chars[name].astype(np.int64) << bit
+    columns.append(flags[:, None])
+
+    cams = snap.cameras
+    cam_columns = [np.round(cams[name][:, None] / step) for name, step in _CAMERA_FIELDS]
+
+    return np.concatenate([
+        np.concatenate(columns, axis=1).ravel(),
+        np.concatenate(cam_columns, axis=1).ravel() if len(cams) else np.empty(0),
+    ]).astype(np.int32)
+
+
+def dequantize(values, num_characters, num_cameras):
+    chars = np.zeros(num_characters, snapshot.CHARACTER_DTYPE)
+    char_values = values[:num_characters * _CHARACTER_WIDTH].reshape(num_characters, _CHARACTER_WIDTH)
+    column = 0
+    for name, step in _CHARACTER_FIELDS:
+        width = _field_width(snapshot.CHARACTER_DTYPE, name)
+        field = char_values[:, column:column + width] * step
+        chars[name] = field if width > 1 else field[:, 0]
+        column += width
+    for bit, name in enumerate(_CHARACTER_FLAGS):
+        chars[name] = (char_values[:, column] >> bit) & 1
+
+    cams = np.zeros(num_cameras, snapshot.CAMERA_DTYPE)
+    cam_values = values[num_characters * _CHARACTER_WIDTH:].reshape(num_cameras, _CAMERA_WIDTH)
+    for column, (name, step) in enumerate(_CAMERA_FIELDS):
+        cams[name] = cam_values[:, column] * step
+
+    return snapshot.Snapshot(chars, np.zeros(0, snapshot.AGENT_DTYPE), cams)
+
+
+class RewindBuffer:
+    __slots__ = [
+        'num_characters',
+        'num_cameras',
+        'capacity',
+        'keyframe_interval',
+        'first_tick',
+        'last_tick',
+        '_deltas',
+        '_delta_keys',
+        '_keyframes',
+        '_keyframe_ticks',
+        '_next_keyframe',
+    ]
+
+    def __init__(self, num_characters, num_cameras, capacity, keyframe_interval=30):
+        self.num_characters = num_characters
+        self.num_cameras = num_cameras
+        self.capacity = capacity
+        self.keyframe_interval = keyframe_interval
+        self.first_tick = 0
+        self.last_tick = -1
+
+        # Every tick stores a small delta against the most recent full keyframe,
+        # so seeking anywhere costs one addition no matter how far back it is
+        width = num_characters * _CHARACTER_WIDTH + num_cameras * _CAMERA_WIDTH
+        num_keyframes = capacity // keyframe_interval + 2
+        self._deltas = np.zeros((capacity, width), np.int16)
+        self._delta_keys = np.zeros(capacity, np.int32)
+        self._keyframes = np.zeros((num_keyframes, width), np.int32)
+        self._keyframe_ticks = np.full(num_keyframes, -1, np.int64)
+        self._next_keyframe = 0
+
+    def __len__(self):
+        return max(self.last_tick - self.first_tick + 1, 0)
+
+    @property
+    def nbytes(self):
+        return (
+            self._deltas.nbytes +
+            self._delta_keys.nbytes +
+            self._keyframes.nbytes +
+            self._keyframe_ticks.nbytes
+        )
+
+    def _write_keyframe(self, tick, values):
+        slot = self._next_keyframe
+        self._keyframes[slot] = values
+        self._keyframe_ticks[slot] = tick
+        self._next_keyframe = (slot + 1) % len(self._keyframes)
+
+        # Ticks that were stored against the keyframe we just replaced are gone
+        following = self._keyframe_ticks[self._next_keyframe]
+        if following >= 0:
+            self.first_tick = max(self.first_tick, int(following))
+        return slot
+
+    def record(self, snap):
+        values = quantize(snap)
+        tick = self.last_tick + 1
+        slot = tick % self.capacity
+
+        key = self._next_keyframe - 1
+        delta = values - self._keyframes[key] if len(self) else None
+        if (
+            delta is None or
+            tick - self._keyframe_ticks[key] >= self.keyframe_interval or
+            delta.min() < _DELTA_MIN or delta.max() > _DELTA_MAX
+        ):
+            key = self._write_keyframe(tick, values)
+            delta = 0
+
+        self._deltas[slot] = delta
+        self._delta_keys[slot] = key
+        self.last_tick = tick
+        self.first_tick = max(self.first_tick, tick - self.capacity + 1)
+        return tick
+
+    def seek(self, tick):
+        if not self.first_tick <= tick <= self.last_tick:
+            raise IndexError('Tick {} is not in the rewind buffer ({}-{})'.format(tick, self.first_tick, self.last_tick))
+
+        slot = tick % self.capacity
+        values = self._keyframes[self._delta_keys[slot]] + self._deltas[slot]
+        return dequantize(values, self.num_characters, self.num_cameras)
+
+    def truncate(self, tick):
+        # Forget everything after tick so recording continues from there
+        if tick < self.first_tick:
+            self.first_tick = tick + 1
+            self._keyframe_ticks[:] = -1
+        self.last_tick = min(self.last_tick, tick)
+        while self._keyframe_ticks[self._next_keyframe - 1] > tick:
+            self._keyframe_ticks[self._next_keyframe - 1] = -1
+            self._next_keyframe = (self._next_keyframe - 1) % len(self._keyframes)
+
+
+class RewindSystem(ecs.System):
+    __slots__ = [
+        'buffer',
+        'seconds',
+        'rate',
+        '_rewind_ticks',
+    ]
+
+    component_types = [
+        'CHARACTER',
+        'CAMERA3P',
+    ]
+
+    def __init__(self, seconds=5, rate=60):
+        super().__init__()
+
+        self.buffer = None
+        self.seconds = seconds
+        self.rate = rate
+        self._rewind_ticks = 0
+
+    def rewind(self, seconds):
+        self._rewind_ticks += int(seconds * self.rate)
+
+    def update(self, dt, components):
+        characters = components.get('CHARACTER', [])
+        cameras = components.get('CAMERA3P', [])
+
+        # History only makes sense for a fixed set of entities
+        if self.buffer is None or (self.buffer.num_characters, self.buffer.num_cameras) != (len(characters), len(cameras)):
+            self.buffer = RewindBuffer(len(characters), len(cameras), self.seconds * self.rate)
+
+        if self._rewind_ticks and len(self.buffer):
+            tick = max(self.buffer.last_tick - self._rewind_ticks, self.buffer.first_tick)
+            snapshot.restore(self.buffer.seek(tick), characters, [], cameras)
+            self.buffer.truncate(tick - 1)
+        self._rewind_ticks = 0
+
+        self.buffer.record(snapshot.capture(characters, [], cameras))
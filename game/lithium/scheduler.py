@@ -0,0 +1,161 @@
+import collections
+import concurrent.futures
+import time
+
+from bamboo import ecs
+
+
+# Systems declare what they read and write as lists of component typeids,
+# plus TRANSFORM for entity nodepaths in the scene graph, PHYSICS for the
+# Bullet worlds and SPATIAL for the spatial index of characters
+
+
+FrameTrace = collections.namedtuple('FrameTrace', [
+    'wall',
+    'busy',
+    'spans',
+])
+
+
+def system_access(system):
+    # Systems that don't declare anything are assumed to touch everything
+    writes = getattr(system, 'writes', None)
+    if writes is None:
+        return None
+    return frozenset(getattr(system, 'reads', ())), frozenset(writes)
+
+
+def conflicts(first, second):
+    if first is None or second is None:
+        return True
+    reads_a, writes_a = first
+    reads_b, writes_b = second
+    return bool(writes_a & (reads_b | writes_b) or writes_b & reads_a)
+
+
+def build_dependencies(systems):
+    # A system waits on every earlier system it conflicts with, so the
+    # results are the same as running them in order
+    access = [system_access(system) for system in systems]
+    return [
+        {earlier for earlier in range(idx) if conflicts(access[earlier], access[idx])}
+        for idx in range(len(systems))
+    ]
+
+
+def system_name(system):
+    # See through the wrappers replays time systems with
+    return type(getattr(system, 'system', system)).__name__
+
+
+class SystemScheduler(ecs.System):
+    __slots__ = [
+        'systems',
+        'component_types',
+        'parallel',
+        'dependencies',
+        'trace',
+        '_exclusive',
+        '_dependents',
+        '_executor',
+    ]
+
+    def __init__(self, systems, parallel=True, workers=None, trace_frames=600):
+        super().__init__()
+
+        self.systems = list(systems)
+        self.component_types = []
+        for system in self.systems:
+            self.component_types.extend(i for i in system.component_types if i not in self.component_types)
+        self.parallel = parallel
+        self.dependencies = build_dependencies(self.systems)
+        self.trace = collections.deque(maxlen=trace_frames)
+
+        self._exclusive = [system_access(system) is None for system in self.systems]
+        self._dependents = [[] for _ in self.systems]
+        for idx, dependencies in enumerate(self.dependencies):
+            for dependency in dependencies:
+                self._dependents[dependency].append(idx)
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, 'systems') if parallel else None
+
+    def init_components(self, dt, components):
+        for system in self.systems:
+            system.init_components(dt, {
+                typeid: components[typeid]
+                for typeid in system.component_types
+                if typeid in components
+            })
+
+    def _run(self, idx, dt, components):
+        system = self.systems[idx]
+        start = time.perf_counter()
+        system.update(dt, {typeid: components.get(typeid, []) for typeid in system.component_types})
+        return idx, start, time.perf_counter()
+
+    def update(self, dt, components):
+        frame_start = time.perf_counter()
+        spans = [None] * len(self.systems)
+        waiting = [len(dependencies) for dependencies in self.dependencies]
+        ready = collections.deque(idx for idx, count in enumerate(waiting) if count == 0)
+        pending = set()
+
+        def finish(idx, start, end):
+            spans[idx] = (start - frame_start, end - frame_start)
+            for dependent in self._dependents[idx]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+
+        while ready or pending:
+            # Undeclared systems, and the last one ready, run right here
+            # instead of leaving this thread idle while the pool works
+            while ready:
+                idx = ready.popleft()
+                if not self.parallel or self._exclusive[idx] or not ready:
+                    finish(*self._run(idx, dt, components))
+                else:
+                    pending.add(self._executor.submit(self._run, idx, dt, components))
+
+            if pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    finish(*future.result())
+
+        wall = time.perf_counter() - frame_start
+        self.trace.append(FrameTrace(wall, sum(end - start for start, end in spans), spans))
+
+    def describe(self):
+        lines = []
+        for idx, system in enumerate(self.systems):
+            # Leave out what a system only waits on through another one
+            dependencies = self.dependencies[idx]
+            direct = [
+                system_name(self.systems[i]) for i in sorted(dependencies)
+                if not any(i in self.dependencies[j] for j in dependencies)
+            ]
+            lines.append('{:<24} {}{}'.format(
+                system_name(system),
+                'exclusive, ' if self._exclusive[idx] else '',
+                'after ' + ', '.join(direct) if direct else 'first',
+            ))
+        return '\n'.join(lines)
+
+    def summary(self):
+        # Parallelism is the time spent in systems over the time the frame
+        # took, so 1.0 means the systems ran one after another
+        if not self.trace:
+            return 'Scheduler: no frames'
+
+        wall = sum(frame.wall for frame in self.trace)
+        busy = sum(frame.busy for frame in self.trace)
+        peak = max(frame.busy / frame.wall for frame in self.trace if frame.wall > 0)
+        lines = ['Scheduler: {} frames, mean {:.3f} ms, parallelism {:.2f} (peak {:.2f})'.format(
+            len(self.trace), wall / len(self.trace) * 1000, busy / wall if wall > 0 else 0, peak
+        )]
+        for idx, system in enumerate(self.systems):
+            times = [frame.spans[idx][1] - frame.spans[idx][0] for frame in self.trace]
+            starts = [frame.spans[idx][0] for frame in self.trace]
+            lines.append('  {:<24} mean {:7.3f} ms, starts at {:7.3f} ms'.format(
+                system_name(system), sum(times) / len(times) * 1000, sum(starts) / len(starts) * 1000
+            ))
+        return '\n'.join(lines)
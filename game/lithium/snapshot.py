@@ -0,0 +1,273 @@
+import collections
+import concurrent.futures
+import os
+import struct
+import time
+
+import numpy as np
+
+from panda3d import core as p3d
+from bamboo import ecs
+
+
+MAGIC = b'LTSN'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHxxIII')
+
+CHARACTER_DTYPE = np.dtype([
+    ('position', '<f4', 3),
+    ('velocity', '<f4', 3),
+    ('movement', '<f4', 3),
+    ('rotation', '<f4'),
+    ('move_speed', '<f4'),
+    ('jump', 'u1'),
+    ('airborne', 'u1'),
+    ('sleeping', 'u1'),
+    ('kinematic', 'u1'),
+], align=True)
+
+AGENT_DTYPE = np.dtype([
+    ('goal', '<f4', 3),
+    ('velocity', '<f4', 3),
+    ('max_speed', '<f4'),
+], align=True)
+
+CAMERA_DTYPE = np.dtype([
+    ('yaw', '<f4'),
+    ('pitch', '<f4'),
+    ('distance', '<f4'),
+], align=True)
+
+
+Snapshot = collections.namedtuple('Snapshot', [
+    'characters',
+    'agents',
+    'cameras',
+])
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def capture(characters, agents, cameras):
+    chars = np.zeros(len(characters), CHARACTER_DTYPE)
+    for idx, char in enumerate(characters):
+        phys = char.entity.get_component('PHY_CHARACTER')
+        phynp = char.entity.get_component('NODEPATH').nodepath.get_parent()
+        if phys.kinematic:
+            velocity = phys.velocity
+        else:
+            velocity = phys.physics_node.get_linear_velocity()
+
+        chars[idx] = (
+            tuple(phynp.get_pos(base.render)),
+            tuple(velocity),
+            tuple(char.movement),
+            char.rotation,
+            char.move_speed,
+            char.jump,
+            phys.airborne,
+            phys.sleeping,
+            phys.kinematic,
+        )
+
+    agts = np.zeros(len(agents), AGENT_DTYPE)
+    for idx, agent in enumerate(agents):
+        agts[idx] = (tuple(agent.goal), tuple(agent.velocity), agent.max_speed)
+
+    cams = np.zeros(len(cameras), CAMERA_DTYPE)
+    for idx, camcomp in enumerate(cameras):
+        cams[idx] = (camcomp.yaw, camcomp.pitch, camcomp.distance)
+
+    return Snapshot(chars, agts, cams)
+
+
+def restore(snapshot, characters, agents, cameras):
+    # Records are matched to components by order, so the world has to be
+    # built the same way it was when the snapshot was taken. Everything is
+    # checked before anything changes so a bad snapshot leaves the world alone
+    counts = (len(snapshot.characters), len(snapshot.agents), len(snapshot.cameras))
+    if counts != (len(characters), len(agents), len(cameras)):
+        raise SnapshotError('Snapshot has {} characters, {} agents and {} cameras, world has {}, {} and {}'.format(
+            *counts, len(characters), len(agents), len(cameras)
+        ))
+    for char, record in zip(characters, snapshot.characters):
+        if bool(record['kinematic']) != char.entity.get_component('PHY_CHARACTER').kinematic:
+            raise SnapshotError('Snapshot character controller type does not match the world')
+
+    for char, record in zip(characters, snapshot.characters):
+        phys = char.entity.get_component('PHY_CHARACTER')
+        nodepath = char.entity.get_component('NODEPATH').nodepath
+        nodepath.get_parent().set_pos(base.render, p3d.LPoint3(*record['position']))
+        velocity = p3d.LVector3(*record['velocity'])
+        if phys.kinematic:
+            phys.velocity = velocity
+        else:
+            phys.physics_node.set_linear_velocity(velocity)
+
+        char.movement = p3d.LVector3(*record['movement'])
+        char.rotation = float(record['rotation'])
+        char.move_speed = float(record['move_speed'])
+        char.jump = bool(record['jump'])
+        nodepath.set_h(char.rotation)
+
+        phys.airborne = bool(record['airborne'])
+        if record['sleeping']:
+            phys.sleep()
+        else:
+            phys.wake()
+
+    # Distance LOD is left alone and recomputed from the restored positions
+    for agent, record in zip(agents, snapshot.agents):
+        agent.goal = p3d.LVector3(*record['goal'])
+        agent.velocity = p3d.LVector3(*record['velocity'])
+        agent.max_speed = float(record['max_speed'])
+
+    for camcomp, record in zip(cameras, snapshot.cameras):
+        camcomp.yaw = float(record['yaw'])
+        camcomp.pitch = float(record['pitch'])
+        camcomp.distance = float(record['distance'])
+
+
+def save(path, snapshot):
+    # Written next to the file and moved over it, so a load never sees half a snapshot
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(
+            MAGIC,
+            VERSION,
+            len(snapshot.characters),
+            len(snapshot.agents),
+            len(snapshot.cameras)
+        ))
+        f.write(snapshot.characters.tobytes())
+        f.write(snapshot.agents.tobytes())
+        f.write(snapshot.cameras.tobytes())
+    os.replace(tmp_path, path)
+
+
+def _save_after(previous, path, snapshot):
+    # Saves to the same file land in the order they were asked for
+    if previous is not None:
+        concurrent.futures.wait([previous])
+    save(path, snapshot)
+
+
+def _map_array(path, dtype, offset, count):
+    if count == 0:
+        return np.zeros(0, dtype)
+    return np.memmap(path, dtype, 'r', offset, (count,))
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        header = f.read(_HEADER.size)
+
+    if len(header) < _HEADER.size:
+        raise SnapshotError('{} is too short to be a snapshot'.format(path))
+    magic, version, num_chars, num_agents, num_cams = _HEADER.unpack(header)
+    if magic != MAGIC:
+        raise SnapshotError('{} is not a snapshot'.format(path))
+    if version != VERSION:
+        raise SnapshotError('{} has unsupported version {}'.format(path, version))
+
+    offset = _HEADER.size
+    chars = _map_array(path, CHARACTER_DTYPE, offset, num_chars)
+    offset += CHARACTER_DTYPE.itemsize * num_chars
+    agts = _map_array(path, AGENT_DTYPE, offset, num_agents)
+    offset += AGENT_DTYPE.itemsize * num_agents
+    cams = _map_array(path, CAMERA_DTYPE, offset, num_cams)
+
+    return Snapshot(chars, agts, cams)
+
+
+class SnapshotSystem(ecs.System):
+    __slots__ = [
+        'jobs',
+        '_save_path',
+        '_load_path',
+        '_ticks',
+        '_writes',
+        '_saving',
+    ]
+
+    component_types = [
+        'CHARACTER',
+        'CROWD_AGENT',
+        'CAMERA3P',
+    ]
+
+    def __init__(self, jobs=None):
+        super().__init__()
+
+        self.jobs = jobs
+        self._save_path = None
+        self._load_path = None
+        self._ticks = 0
+        self._writes = {}
+        self._saving = {}
+
+    def save(self, path):
+        self._save_path = path
+
+    def load(self, path):
+        self._load_path = path
+
+    def update(self, dt, components):
+        characters = components.get('CHARACTER', [])
+        agents = components.get('CROWD_AGENT', [])
+        cameras = components.get('CAMERA3P', [])
+
+        # Saves go first, so a load of the same file asked for right after waits for the write
+        if self._save_path is not None:
+            if self.jobs is not None:
+                writes = self._writes.setdefault(self._save_path, [])
+                writes[:] = [job for job in writes if not job.done]
+                writes.append(self.jobs.add(
+                    self._write(self._save_path, capture(characters, agents, cameras)),
+                    name='snapshot'
+                ))
+            else:
+                stime = time.perf_counter()
+                save(self._save_path, capture(characters, agents, cameras))
+                print("Saved snapshot {} in {:.2f}ms".format(self._save_path, (time.perf_counter() - stime) * 1000))
+            self._save_path = None
+
+        # Wait for a full tick so physics has set up every character before
+        # restoring, and for saves to the same file to finish writing it
+        if self._load_path is not None and self._ticks > 0:
+            writes = self._writes.get(self._load_path, [])
+            if all(job.done for job in writes):
+                self._writes.pop(self._load_path, None)
+                self._load(self._load_path, writes[-1] if writes else None, characters, agents, cameras)
+                self._load_path = None
+
+        self._ticks += 1
+
+    def _load(self, path, write, characters, agents, cameras):
+        # A missing or broken file is reported and the game carries on
+        if write is not None and (write.error is not None or write.cancelled):
+            print("Did not load snapshot {}, saving it failed: {!r}".format(path, write.error))
+            return
+
+        stime = time.perf_counter()
+        try:
+            restore(load(path), characters, agents, cameras)
+        except (OSError, ValueError, SnapshotError) as error:
+            print("Could not load snapshot {}: {}".format(path, error))
+            return
+        print("Loaded snapshot {} in {:.2f}ms".format(path, (time.perf_counter() - stime) * 1000))
+
+    def _write(self, path, snapshot):
+        # The capture has to be taken during the tick, writing it out doesn't
+        stime = time.perf_counter()
+        offload = self.jobs.offload(_save_after, self._saving.get(path), path, snapshot)
+        self._saving[path] = offload.future
+        try:
+            yield offload
+        finally:
+            if self._saving.get(path) is offload.future:
+                del self._saving[path]
+        print("Saved snapshot {} in {:.2f}ms".format(path, (time.perf_counter() - stime) * 1000))
@@ -0,0 +1,172 @@
+import math
+
+import numpy as np
+
+from bamboo import ecs
+
+from . import archetypes
+
+
+_CELL_BITS = 21
+_CELL_OFFSET = 1 << (_CELL_BITS - 1)
+
+
+def _cell_keys(cells):
+    return ((cells[..., 0] + _CELL_OFFSET) << _CELL_BITS) | (cells[..., 1] + _CELL_OFFSET)
+
+
+def _expand_ranges(start, end):
+    # Turn a set of [start, end) ranges into one flat array of indices
+    counts = end - start
+    total = counts.sum()
+    ramp = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(start, counts) + ramp, counts
+
+
+class UniformGrid:
+    __slots__ = [
+        'cell_size',
+        'positions',
+        '_extent',
+        '_cells',
+        '_order',
+        '_sorted_keys',
+    ]
+
+    def __init__(self, cell_size=4.0):
+        self.cell_size = cell_size
+        self.rebuild(np.empty((0, 3)))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def rebuild(self, positions):
+        # Positions are binned on the ground plane and sorted by cell, so each
+        # row of cells along y maps to one contiguous run of the sorted arrays
+        self.positions = np.asarray(positions, dtype=np.float64)
+        if len(self.positions):
+            self._extent = (self.positions.min(axis=0), self.positions.max(axis=0))
+        else:
+            self._extent = None
+        self._cells = np.floor(self.positions[:, :2] / self.cell_size).astype(np.int64)
+        keys = _cell_keys(self._cells)
+        self._order = np.argsort(keys, kind='stable')
+        self._sorted_keys = keys[self._order]
+
+    def _candidates(self, lower, upper):
+        cell_min_x, cell_min_y = (int(math.floor(i / self.cell_size)) for i in lower[:2])
+        cell_max_x, cell_max_y = (int(math.floor(i / self.cell_size)) for i in upper[:2])
+        columns = np.arange(cell_min_x, cell_max_x + 1, dtype=np.int64) + _CELL_OFFSET << _CELL_BITS
+        start = np.searchsorted(self._sorted_keys, columns | (cell_min_y + _CELL_OFFSET), 'left')
+        end = np.searchsorted(self._sorted_keys, columns | (cell_max_y + _CELL_OFFSET), 'right')
+        return self._order[_expand_ranges(start, end)[0]]
+
+    def query_radius(self, point, radius):
+        point = np.asarray(point, dtype=np.float64)
+        candidates = self._candidates(point - radius, point + radius)
+        delta = self.positions[candidates] - point
+        dist_sq = np.einsum('ij,ij->i', delta, delta)
+        return candidates[dist_sq <= radius * radius]
+
+    def query_box(self, lower, upper):
+        lower = np.asarray(lower, dtype=np.float64)
+        upper = np.asarray(upper, dtype=np.float64)
+        candidates = self._candidates(lower, upper)
+        found = self.positions[candidates]
+        inside = np.all((found >= lower) & (found <= upper), axis=1)
+        return candidates[inside]
+
+    def query_knn(self, point, k):
+        point = np.asarray(point, dtype=np.float64)
+        k = min(k, len(self.positions))
+        if k == 0:
+            return np.empty(0, dtype=np.int64)
+
+        # Grow the search radius until it holds k points that are provably the nearest
+        lower, upper = self._extent
+        extent = np.maximum(np.abs(upper - point), np.abs(point - lower)).max()
+        radius = self.cell_size
+        while True:
+            candidates = self._candidates(point - radius, point + radius)
+            delta = self.positions[candidates] - point
+            dist_sq = np.einsum('ij,ij->i', delta, delta)
+            if len(candidates) >= k:
+                nearest = np.argpartition(dist_sq, k - 1)[:k]
+                if dist_sq[nearest].max() <= radius * radius or radius > extent:
+                    return candidates[nearest[np.argsort(dist_sq[nearest])]]
+            radius *= 2
+
+    def query_pairs(self, radius):
+        count = len(self.positions)
+        if count == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, np.empty((0, self.positions.shape[1])), np.empty(0)
+
+        reach = int(math.ceil(radius / self.cell_size))
+        agents = np.arange(count)
+        pair_i = []
+        pair_j = []
+        for offset_x in range(-reach, reach + 1):
+            first = self._cells + (offset_x, -reach)
+            last = self._cells + (offset_x, reach)
+            start = np.searchsorted(self._sorted_keys, _cell_keys(first), 'left')
+            end = np.searchsorted(self._sorted_keys, _cell_keys(last), 'right')
+            indices, counts = _expand_ranges(start, end)
+            pair_i.append(np.repeat(agents, counts))
+            pair_j.append(self._order[indices])
+
+        pair_i = np.concatenate(pair_i)
+        pair_j = np.concatenate(pair_j)
+        delta = self.positions[pair_i] - self.positions[pair_j]
+        dist_sq = np.einsum('ij,ij->i', delta, delta)
+        mask = (pair_i != pair_j) & (dist_sq < radius * radius)
+
+        return pair_i[mask], pair_j[mask], delta[mask], dist_sq[mask]
+
+
+class SpatialIndexSystem(ecs.System):
+    __slots__ = [
+        'grid',
+        'entities',
+        'characters',
+    ]
+
+    component_types = [
+        'CHARACTER',
+    ]
+    reads = [
+        'CHARACTER',
+        'NODEPATH',
+        'TRANSFORM',
+    ]
+    writes = [
+        'SPATIAL',
+    ]
+
+    def __init__(self, cell_size=4.0, index=None):
+        super().__init__()
+
+        self.grid = UniformGrid(cell_size)
+        self.entities = []
+        self.characters = archetypes.query(index, 'CHARACTER', 'NODEPATH')
+
+    def update(self, dt, components):
+        characters = self.characters.select(components)
+        positions = np.empty((len(characters), 3))
+        self.entities = []
+
+        for idx, (char, npcomp) in enumerate(characters):
+            pos = npcomp.nodepath.get_pos(base.render)
+            positions[idx] = pos.x, pos.y, pos.z
+            self.entities.append(char.entity)
+
+        self.grid.rebuild(positions)
+
+    def query_radius(self, point, radius):
+        return [self.entities[i] for i in self.grid.query_radius(tuple(point), radius)]
+
+    def query_box(self, lower, upper):
+        return [self.entities[i] for i in self.grid.query_box(tuple(lower), tuple(upper))]
+
+    def query_knn(self, point, k):
+        return [self.entities[i] for i in self.grid.query_knn(tuple(point), k)]
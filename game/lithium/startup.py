@@ -0,0 +1,74 @@
+import contextlib
+import time
+
+
+# Only the standard library, so this can be imported before anything it times
+class StartupProfiler:
+    __slots__ = [
+        'start',
+        'phases',
+        'marks',
+        '_depth',
+    ]
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+        self.marks = []
+        self._depth = 0
+
+    def begin(self, name):
+        index = len(self.phases)
+        self.phases.append((name, self._depth, time.perf_counter() - self.start, None))
+        self._depth += 1
+        return index
+
+    def end(self, index):
+        name, depth, offset, _ = self.phases[index]
+        self._depth -= 1
+        self.phases[index] = (name, depth, offset, time.perf_counter() - self.start - offset)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        index = self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(index)
+
+    def mark(self, name):
+        elapsed = time.perf_counter() - self.start
+        self.marks.append((name, elapsed))
+        return elapsed
+
+    def get_mark(self, name):
+        for mark, elapsed in self.marks:
+            if mark == name:
+                return elapsed
+        return None
+
+    def summary(self, target=0.0):
+        lines = []
+        for name, depth, offset, duration in self.phases:
+            if duration is None:
+                continue
+            lines.append('{:<40} at {:8.1f} ms  took {:8.1f} ms'.format(
+                '  ' * depth + name,
+                offset * 1000,
+                duration * 1000
+            ))
+        for name, elapsed in self.marks:
+            lines.append('{:<40} at {:8.1f} ms'.format(name, elapsed * 1000))
+
+        window = self.get_mark('first frame')
+        if target > 0 and window is not None:
+            verdict = 'within' if window <= target else 'over'
+            lines.append('Time to window {:.1f} ms is {} the {:.1f} ms target'.format(
+                window * 1000,
+                verdict,
+                target * 1000
+            ))
+        return '\n'.join(lines)
+
+
+profiler = StartupProfiler()
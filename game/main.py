@@ -1,27 +1,79 @@
 #!/usr/bin/env python3
+import math
 import os
-import sys
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
-from direct.showbase.ShowBase import ShowBase
-from direct.showbase.DirectObject import DirectObject
-import panda3d.core as p3d
-import blenderpanda
-from bamboo.ecs import ECSManager, Entity
-from bamboo.inputmapper import InputMapper
-
-from lithium import components
+from lithium.startup import profiler
+
+with profiler.phase('import panda3d'):
+    from direct.showbase.ShowBase import ShowBase
+    from direct.showbase.DirectObject import DirectObject
+    import panda3d.core as p3d
+with profiler.phase('import blenderpanda'):
+    import blenderpanda
+with profiler.phase('import bamboo'):
+    from bamboo.ecs import ECSManager, Entity
+    from bamboo.inputmapper import InputMapper
+
+with profiler.phase('import lithium'):
+    from lithium import actions
+    from lithium import archetypes
+    from lithium import cells
+    from lithium import components
+    from lithium import gcmanager
+    from lithium import jobs
+    from lithium import replay
+    from lithium import rewind
+    from lithium import scheduler
+    from lithium import snapshot
+    from lithium import spatial
 
 
 # Load config files
-p3d.load_prc_file('config/game.prc')
-if os.path.exists('config/user.prc'):
-    print("Loading user.prc")
-    p3d.load_prc_file('config/user.prc')
-else:
-    print("Did not find a user config")
-
+with profiler.phase('load config'):
+    p3d.load_prc_file('config/game.prc')
+    if os.path.exists('config/user.prc'):
+        print("Loading user.prc")
+        p3d.load_prc_file('config/user.prc')
+    else:
+        print("Did not find a user config")
+
+kinematic_controller = p3d.ConfigVariableBool('lithium-kinematic-controller', False)
+physics_islands = p3d.ConfigVariableString('lithium-physics-islands', '')
+crowd_size = p3d.ConfigVariableInt('lithium-crowd-size', 0)
+crowd_radius = p3d.ConfigVariableDouble('lithium-crowd-radius', 20.0)
+spawn_budget = p3d.ConfigVariableDouble('lithium-spawn-budget', 2.0)
+gc_budget = p3d.ConfigVariableDouble('lithium-gc-budget', 2.0)
+target_frame_rate = p3d.ConfigVariableDouble('lithium-target-frame-rate', 60.0)
+job_budget = p3d.ConfigVariableDouble('lithium-job-budget', 2.0)
+navmesh_path = p3d.ConfigVariableFilename('lithium-navmesh', '')
+parallel_systems = p3d.ConfigVariableBool('lithium-parallel-systems', False)
+record_input = p3d.ConfigVariableFilename('lithium-record-input', '')
+replay_input = p3d.ConfigVariableFilename('lithium-replay-input', '')
+load_snapshot = p3d.ConfigVariableFilename('lithium-load-snapshot', '')
+quicksave_path = p3d.ConfigVariableFilename('lithium-quicksave', 'quicksave.snap')
+level_cells = p3d.ConfigVariableBool('lithium-level-cells', True)
+rewind_seconds = p3d.ConfigVariableInt('lithium-rewind-seconds', 0)
+net_mode = p3d.ConfigVariableString('lithium-net-mode', '')
+net_address = p3d.ConfigVariableString('lithium-net-address', '127.0.0.1:7777')
+net_latency = p3d.ConfigVariableDouble('lithium-net-latency', 0.0)
+net_loss = p3d.ConfigVariableDouble('lithium-net-loss', 0.0)
+startup_profile = p3d.ConfigVariableBool('lithium-startup-profile', False)
+startup_target = p3d.ConfigVariableDouble('lithium-startup-target', 0.0)
+record_prefetch = p3d.ConfigVariableBool('lithium-record-prefetch', False)
+
+# Replays run headless and as fast as possible
+if replay_input.get_value():
+    p3d.load_prc_file_data('replay', 'window-type none\naudio-library-name null')
+
+# Networked games simulate at a fixed rate, and the server has nobody to show anything to
+if net_mode.get_value():
+    with profiler.phase('import lithium.net'):
+        from lithium import net
+    p3d.load_prc_file_data('net', 'clock-mode limited\nclock-frame-rate {}'.format(net.TICK_RATE))
+if net_mode.get_value() == 'server':
+    p3d.load_prc_file_data('net', 'window-type none\naudio-library-name null')
 
 
 class GameState(DirectObject):
@@ -34,9 +86,31 @@ class GameState(DirectObject):
 
         # Load assets
         self.level_entity = base.ecsmanager.create_entity()
-        self.level = loader.load_model('cathedral.bam')
+        self.level = None
+        if level_cells.get_value():
+            # Batched cells with LODs, built by lithium/levelbuild.py as a pman build hook
+            self.level = loader.load_model('cathedral.cells.bam', okMissing=True)
+        if self.level is None:
+            self.level = loader.load_model('cathedral.bam')
         level_start = self.level.find('**/PlayerStart')
         self.level.reparent_to(spacenp)
+        self.level_cells = cells.LevelCells(self.level, base.render)
+
+        # Navmesh built by lithium/navbuild.py as a pman build hook
+        if base.navigation_system is not None:
+            from lithium import navigation
+            navmesh_file = navmesh_path.get_value()
+            if p3d.VirtualFileSystem.get_global_ptr().resolve_filename(navmesh_file, p3d.get_model_path().get_value()):
+                base.navigation_system.set_navmesh(navigation.NavMesh.load(navmesh_file))
+            else:
+                print("Did not find navmesh", navmesh_file)
+
+        # Split the level into a grid of independently simulated physics islands
+        if physics_islands.get_value():
+            from lithium import islands
+            columns, rows = (int(i) for i in physics_islands.get_value().split())
+            lower, upper = self.level.get_tight_bounds(base.render)
+            base.physics_system.set_regions(islands.grid_regions(lower, upper, columns, rows))
 
         for phynode in self.level.find_all_matches('**/+BulletBodyNode'):
             if not phynode.is_hidden():
@@ -44,61 +118,123 @@ class GameState(DirectObject):
             else:
                 print("Skipping hidden node", phynode)
 
-        self.player = base.template_factory.make_character('character.bam', self.level, level_start.get_pos())
+        # The server only simulates the characters of connected clients
+        if base.net_server is not None:
+            base.net_server.spawn = lambda: base.template_factory.make_character(
+                'character.bam',
+                self.level,
+                level_start.get_pos(),
+                kinematic_controller.get_value()
+            )
+            base.net_server.despawn = base.template_factory.remove_entity
+            return
+
+        self.player = base.template_factory.make_character(
+            'character.bam',
+            self.level,
+            level_start.get_pos(),
+            kinematic_controller.get_value()
+        )
 
         # Attach camera to player
         playernp = self.player.get_component('NODEPATH').nodepath
+        camera = base.camera if base.camera is not None else base.render.attach_new_node('camera')
         self.camera = base.ecsmanager.create_entity()
-        self.camera.add_component(components.Camera3PComponent(base.camera, playernp))
-
-        # Player movement
-        self.player_movement = p3d.LVector3(0, 0, 0)
-        def update_movement(direction, activate):
-            move_delta = p3d.LVector3(0, 0, 0)
-
-            if direction == 'forward':
-                move_delta.set_y(1)
-            elif direction == 'backward':
-                move_delta.set_y(-1)
-            elif direction == 'left':
-                move_delta.set_x(-1)
-            elif direction == 'right':
-                move_delta.set_x(1)
-
-            if not activate:
-                move_delta *= -1
-
-            self.player_movement += move_delta
-
-        self.accept('move-forward', update_movement, ['forward', True])
-        self.accept('move-forward-up', update_movement, ['forward', False])
-        self.accept('move-backward', update_movement, ['backward', True])
-        self.accept('move-backward-up', update_movement, ['backward', False])
-        self.accept('move-left', update_movement, ['left', True])
-        self.accept('move-left-up', update_movement, ['left', False])
-        self.accept('move-right', update_movement, ['right', True])
-        self.accept('move-right-up', update_movement, ['right', False])
-
-        def jump():
-            char = self.player.get_component('CHARACTER')
-            char.jump = True
-        self.accept('jump', jump)
-
+        self.camera.add_component(components.Camera3PComponent(camera, playernp))
+
+        # Spawn crowd agents on a ring around the player, each heading for the opposite side
+        if base.crowd_system is not None:
+            base.crowd_system.focus = playernp
+            center = level_start.get_pos()
+            offsets = []
+            for i in range(crowd_size.get_value()):
+                angle = 2 * math.pi * i / crowd_size.get_value()
+                offsets.append(p3d.LVector3(math.cos(angle), math.sin(angle), 0) * crowd_radius.get_value())
+            goals = [center - offset for offset in offsets]
+            agents = base.template_factory.make_crowd_agents(
+                'character.bam',
+                goals,
+                self.level,
+                [center + offset for offset in offsets],
+                kinematic_controller.get_value()
+            )
+            # With a navmesh, agents walk around walls instead of straight at their goal
+            if base.navigation_system is not None and base.navigation_system.navmesh is not None:
+                for agent, goal in zip(agents, goals):
+                    agent.add_component(components.NavAgentComponent(goal))
+
+        # Player movement and actions, dispatched through the table compiled from actions.conf
+        self.actions = actions.ActionMap.from_file('config/actions.conf')
+        self.jump_bit = self.actions.bit('jump')
+        self.input_event_time = None
+
+        self.accept('quick-save', base.snapshot_system.save, [quicksave_path.get_value().to_os_specific()])
+        self.accept('quick-load', base.snapshot_system.load, [quicksave_path.get_value().to_os_specific()])
+        if base.rewind_system is not None:
+            self.accept('rewind', base.rewind_system.rewind, [1.0])
+
+        # Movement only has to be turned into world space again when the input or the camera yaw change
+        self.movement_yaw = None
+        self.last_movement = None
+        self.world_movement = None
+
+        # Mouse look, using relative mode where the platform supports it so
+        # the pointer never has to be warped back to the center
+        self.window_center = None
+        self.relative_mouse = False
+        self.last_pointer = None
+        if base.win is not None:
+            props = p3d.WindowProperties()
+            props.set_cursor_hidden(True)
+            props.set_mouse_mode(p3d.WindowProperties.M_relative)
+            base.win.request_properties(props)
+            self.accept('window-event', self.update_window)
+            self.update_window(base.win)
+
+    def mark_input_event(self, event_time):
+        if self.input_event_time is None:
+            self.input_event_time = event_time
+
+    def update_window(self, window):
+        if window != base.win:
+            return
+
+        props = window.get_properties()
+        self.window_center = (props.get_x_size() // 2, props.get_y_size() // 2)
+        relative = props.get_mouse_mode() == p3d.WindowProperties.M_relative
+        if not relative and props.get_mouse_mode() != p3d.WindowProperties.M_confined:
+            # Relative mode isn't available here, so fall back to confining the pointer
+            fallback = p3d.WindowProperties()
+            fallback.set_mouse_mode(p3d.WindowProperties.M_confined)
+            window.request_properties(fallback)
+        if relative != self.relative_mouse:
+            self.last_pointer = None
+        self.relative_mouse = relative
+
+    def sample_input(self, dt):
+        delta_yaw = 0
+        delta_pitch = 0
 
         # Mouse look
-        props = p3d.WindowProperties()
-        props.set_cursor_hidden(True)
-        props.set_mouse_mode(p3d.WindowProperties.M_confined)
-        base.win.request_properties(props)
-
-    def update(self, dt):
-        # Mouse look
-        char = self.player.get_component('CHARACTER')
-        cam = self.camera.get_component('CAMERA3P')
+        pointer = base.win.get_pointer(0) if self.window_center is not None else None
+        if pointer is not None and pointer.get_in_window():
+            x = pointer.get_x()
+            y = pointer.get_y()
+            center_x, center_y = self.window_center
+            if self.relative_mouse:
+                last_x, last_y = self.last_pointer if self.last_pointer is not None else (x, y)
+                self.last_pointer = (x, y)
+                move_x = x - last_x
+                move_y = y - last_y
+            else:
+                move_x = x - center_x
+                move_y = y - center_y
+                if move_x or move_y:
+                    base.win.move_pointer(0, center_x, center_y)
 
-        if base.mouseWatcherNode.has_mouse():
-            delta_yaw = base.mouseWatcherNode.get_mouse_x() * dt * 2000
-            delta_pitch = base.mouseWatcherNode.get_mouse_y() * dt * 2000
+            # Scaled like mouse watcher coordinates, which run from -1 to 1 across the window
+            delta_yaw = move_x / max(center_x, 1) * dt * 2000
+            delta_pitch = -move_y / max(center_y, 1) * dt * 2000
 
             # Prevent camera from jumping if the mouse pointer has moved too far
             max_thresh = 10
@@ -107,52 +243,259 @@ class GameState(DirectObject):
             if delta_pitch > max_thresh or delta_pitch < -max_thresh:
                 delta_pitch = 0
 
-            cam.yaw -= delta_yaw
-            cam.pitch -= delta_pitch
+        action_frame = self.actions.sample()
+        if self.actions.event_time is not None:
+            self.mark_input_event(self.actions.event_time)
+            self.actions.event_time = None
+
+        return replay.InputFrame(
+            dt,
+            action_frame.move_x,
+            action_frame.move_y,
+            bool(action_frame.pressed & self.jump_bit),
+            delta_yaw,
+            delta_pitch
+        )
+
+    def apply_input(self, frame):
+        char = self.player.get_component('CHARACTER')
+        cam = self.camera.get_component('CAMERA3P')
 
-            # reset mouse to center
-            props = base.win.get_properties()
-            base.win.move_pointer(0, int(props.get_x_size() / 2), int(props.get_y_size() / 2))
+        cam.yaw -= frame.delta_yaw
+        cam.pitch -= frame.delta_pitch
 
-        # Set the player's movement relative to the camera
-        camera = self.camera.get_component('CAMERA3P').camera
-        char.movement = base.render.get_relative_vector(camera, self.player_movement)
-        char.movement.set_z(0)
+        if frame.jump:
+            char.jump = True
+
+        # Set the player's movement relative to the camera heading, which
+        # Camera3PSystem derives from yaw alone. Replays and restores bypass
+        # the key events, so their changes are picked up here as well
+        movement = p3d.LVector3(frame.move_x, frame.move_y, 0)
+        if (
+            cam.yaw != self.movement_yaw or
+            movement != self.last_movement or
+            char.movement is not self.world_movement
+        ):
+            heading = p3d.Mat3.rotate_mat(cam.yaw, p3d.LVector3(0, 0, 1))
+            self.world_movement = heading.xform(movement)
+            char.movement = self.world_movement
+            self.movement_yaw = cam.yaw
+            self.last_movement = movement
 
 class GameApp(ShowBase):
     def __init__(self):
-        ShowBase.__init__(self)
-        blenderpanda.init(self)
-        self.accept('escape', sys.exit)
+        with profiler.phase('ShowBase'):
+            ShowBase.__init__(self)
+        with profiler.phase('blenderpanda.init'):
+            blenderpanda.init(self)
+        self.accept('escape', self.userExit)
         self.disableMouse()
-        self.inputmapper = InputMapper('config/input.conf')
+        with profiler.phase('InputMapper'):
+            self.inputmapper = InputMapper('config/input.conf')
+
+        # Non-urgent work resumed a slice at a time each frame, see lithium/jobs.py
+        self.jobs = jobs.JobQueue(job_budget.get_value() / 1000)
+        self.jobs.attach(self.taskMgr)
 
         # Setup ECS
+        systems_phase = profiler.begin('systems')
         self.ecsmanager = ECSManager()
+        # Tables of the components systems join over, kept up to date as components come and go
+        self.archetypes = archetypes.ArchetypeIndex()
+        self.spatial_index = spatial.SpatialIndexSystem(index=self.archetypes)
+        if physics_islands.get_value():
+            from lithium import islands
+            self.physics_system = islands.IslandPhysicsSystem(self.spatial_index, index=self.archetypes)
+        else:
+            self.physics_system = components.PhysicsSystem(self.spatial_index, self.archetypes)
+        # Milliseconds per frame for attaching new characters, 0 attaches a wave at once.
+        # The budget goes by wall-clock time, so recorded and replayed runs do without
+        # it to have characters enter the world on the same tick every time
+        deterministic = bool(replay_input.get_value() or record_input.get_value())
+        if spawn_budget.get_value() > 0 and not deterministic:
+            self.physics_system.spawn_budget = spawn_budget.get_value() / 1000
+        self.snapshot_system = snapshot.SnapshotSystem(self.jobs)
+        self.character_system = components.CharacterSystem(self.archetypes)
         systems = [
-            components.CharacterSystem(),
+            self.snapshot_system,
+            self.character_system,
             components.Camera3PSystem(),
-            components.PhysicsSystem(),
+            self.physics_system,
+            self.spatial_index,
         ]
 
-        for system in systems:
+        self.crowd_system = None
+        if crowd_size.get_value() > 0:
+            from lithium import crowd
+            self.crowd_system = crowd.CrowdSystem(self.physics_system, index=self.archetypes)
+            systems.insert(1, self.crowd_system)
+
+        # Paths are followed by handing corners to the crowd as goals, so navigation runs first
+        self.navigation_system = None
+        if navmesh_path.get_value():
+            from lithium import navigation
+            # Path requests have a time budget too, which replays do without
+            self.navigation_system = navigation.NavigationSystem(budget=None if deterministic else 0.002)
+            systems.insert(1, self.navigation_system)
+
+        # Rewind restores at the start of a tick, before anything else simulates.
+        # It captures every character each tick, so it is opt-in
+        self.rewind_system = None
+        if rewind_seconds.get_value() > 0:
+            self.rewind_system = rewind.RewindSystem(rewind_seconds.get_value())
+            systems.insert(1, self.rewind_system)
+
+        # Inputs are applied before anything else simulates the tick
+        self.net_server = None
+        self.net_client = None
+        if net_mode.get_value() == 'server':
+            channel = net.Channel(net.parse_address(net_address.get_value()), net_latency.get_value(), 0, net_loss.get_value())
+            self.net_server = net.NetServerSystem(channel, None)
+            systems.insert(0, self.net_server)
+            print("Serving on {}:{}".format(*channel.address))
+
+        # The index has to see new and removed components before any system joins over them
+        systems.insert(0, self.archetypes)
+
+        self.input_player = None
+        self.input_recorder = None
+        self.frame_times = []
+        self.input_latencies = []
+        if replay_input.get_value():
+            self.input_player = replay.InputPlayer(replay_input.get_value().to_os_specific())
+            systems = [replay.TimedSystem(system) for system in systems]
+        if record_input.get_value():
+            self.input_recorder = replay.InputRecorder(record_input.get_value().to_os_specific())
+
+        # Systems that don't touch the same components run side by side; the
+        # index stays in front since it has to finish before anyone joins
+        self.scheduler = None
+        scheduled = systems
+        if parallel_systems.get_value():
+            self.scheduler = scheduler.SystemScheduler(systems[1:])
+            scheduled = systems[:1] + [self.scheduler]
+            print(self.scheduler.describe())
+
+        for system in scheduled:
             self.ecsmanager.add_system(system)
 
-        #systems[-1].set_debug(self.render, True)
-
-        self.template_factory = components.TemplateFactory(self.ecsmanager)
+        #self.physics_system.set_debug(self.render, True)
 
-        def run_ecs(task):
-            self.ecsmanager.update(globalClock.get_dt())
-            return task.cont
-        self.taskMgr.add(run_ecs, 'ECS')
+        self.template_factory = components.TemplateFactory(self.ecsmanager, self.physics_system)
+        profiler.end(systems_phase)
 
         # Setup initial game state
-        self.game_state = GameState()
-        def run_gamestate(task):
-            self.game_state.update(globalClock.get_dt())
+        with profiler.phase('GameState'):
+            self.game_state = GameState()
+            if load_snapshot.get_value():
+                self.snapshot_system.load(load_snapshot.get_value().to_os_specific())
+
+        if net_mode.get_value() == 'client':
+            def spawn_proxy():
+                proxy = loader.load_model('character.bam').find('**/Character')
+                proxy.reparent_to(self.game_state.level)
+                return proxy
+
+            self.net_client = net.NetClient(
+                net.Channel(latency=net_latency.get_value(), loss=net_loss.get_value()),
+                net.parse_address(net_address.get_value()),
+                self.game_state.player,
+                self.physics_system,
+                spawn_proxy
+            )
+
+        # Whatever loading the level left alive stays for the whole session,
+        # and full collections are held back for frames with time to spare
+        self.gc_manager = None
+        if gc_budget.get_value() > 0:
+            self.gc_manager = gcmanager.GCManager(gc_budget.get_value() / 1000)
+            with profiler.phase('gc freeze'):
+                print("Froze {} objects".format(self.gc_manager.freeze()))
+            self.gc_manager.enable()
+            frame_time = 1 / target_frame_rate.get_value()
+
+            # Runs after igLoop, so whatever is left of the frame time is spare
+            def collect_garbage(task):
+                self.gc_manager.end_frame(frame_time - (globalClock.get_real_time() - globalClock.get_frame_time()))
+                return task.cont
+            self.taskMgr.add(collect_garbage, 'CollectGarbage', sort=55)
+
+        # Input is sampled (or replayed) first so every tick sees it in the same order
+        def run_simulation(task):
+            if self.net_server is not None:
+                self.ecsmanager.update(1 / net.TICK_RATE)
+                return task.cont
+
+            if self.input_player is not None:
+                frame = self.input_player.next_frame()
+                if frame is None:
+                    self.finish_replay(systems)
+                    return task.done
+            else:
+                frame = self.game_state.sample_input(globalClock.get_dt())
+
+            if self.input_recorder is not None:
+                self.input_recorder.record(frame)
+
+            stime = globalClock.get_real_time()
+            self.game_state.apply_input(frame)
+            if self.net_client is not None:
+                self.net_client.tick()
+                self.ecsmanager.update(self.net_client.dt)
+            else:
+                self.ecsmanager.update(frame.dt)
+            self.frame_times.append(globalClock.get_real_time() - stime)
+
+            # CharacterSystem has handed the input to the character's velocity by now
+            if self.game_state.input_event_time is not None:
+                self.input_latencies.append(globalClock.get_real_time() - self.game_state.input_event_time)
+                self.game_state.input_event_time = None
             return task.cont
-        self.taskMgr.add(run_gamestate, 'GameState')
+        # Run after the event manager so input from this frame is simulated this frame
+        self.taskMgr.add(run_simulation, 'Simulation', sort=1)
+
+        # Startup ends once igLoop has rendered the first frame
+        def mark_first_frame(task):
+            profiler.mark('first frame')
+            if startup_profile.get_value():
+                print(profiler.summary(startup_target.get_value()))
+            return task.done
+        self.taskMgr.add(mark_first_frame, 'StartupProfile', sort=60)
+
+    def finish_replay(self, systems):
+        print("Replayed {} frames".format(len(self.input_player)))
+        print(replay.summarize('Frame', self.frame_times))
+        if self.game_state.level_cells.enabled:
+            stats = self.game_state.level_cells.stats(self.game_state.camera.get_component('CAMERA3P').camera, self.camLens)
+            print("Level cells: {}/{} visible, {} occluded, {} draw calls, {} vertices".format(
+                stats.visible_cells, stats.cells, stats.occluded_cells, stats.draw_calls, stats.vertices
+            ))
+        for system in systems:
+            print(replay.summarize(type(system.system).__name__, system.times))
+        self.userExit()
+
+    def userExit(self):
+        if self.input_latencies:
+            print(replay.summarize('Input latency', self.input_latencies))
+        if self.scheduler is not None:
+            print(self.scheduler.summary())
+        print(self.jobs.summary())
+        self.jobs.close()
+        if self.gc_manager is not None:
+            print(replay.summarize('GC pause', self.gc_manager.pauses))
+            print("GC: {} full collections, {} forced".format(
+                self.gc_manager.full_collections, self.gc_manager.forced_collections
+            ))
+        if self.input_recorder is not None:
+            self.input_recorder.close()
+            print("Recorded {} frames of input".format(self.input_recorder.num_frames))
+        if record_prefetch.get_value():
+            # Packed builds prefetch whatever this run loaded, see blenderpanda/pack.py
+            from blenderpanda import pack, pman
+            config = pman.get_config()
+            names = pack.write_prefetch_list(pman.get_abs_path(config, config.get('build', 'export_dir')))
+            print("Recorded {} assets to prefetch".format(len(names)))
+        ShowBase.userExit(self)
 
 
 
@@ -0,0 +1,84 @@
+import unittest
+
+from panda3d import core as p3d
+from bamboo import ecs
+
+from lithium import components
+
+
+class RecordingManager:
+    def __init__(self):
+        self.removed = []
+
+    def remove_entity(self, entity):
+        self.removed.append(entity)
+
+
+def make_character(parent, kinematic=False):
+    entity = ecs.Entity(None)
+    entity.add_component(components.NodePathComponent(None, parent))
+    entity.add_component(components.CharacterComponent())
+    if kinematic:
+        entity.add_component(components.KinematicCharacterComponent())
+    else:
+        entity.add_component(components.PhysicsCharacterComponent())
+    return entity
+
+
+class RemoveEntityTest(unittest.TestCase):
+    def setUp(self):
+        self.root = p3d.NodePath('render')
+        self.manager = RecordingManager()
+        self.physics = components.PhysicsSystem()
+        self.factory = components.TemplateFactory(self.manager, self.physics)
+
+    def spawn(self, kinematic=False):
+        entity = make_character(self.root, kinematic)
+        self.physics.init_components(0, {'PHY_CHARACTER': [entity.get_component('PHY_CHARACTER')]})
+        return entity
+
+    def test_removed_character_leaves_the_physics_world(self):
+        entity = self.spawn()
+        other = self.spawn(kinematic=True)
+        self.assertEqual(self.physics.num_bodies(), 2)
+
+        self.factory.remove_entity(entity)
+        self.assertEqual(self.physics.num_bodies(), 1)
+        self.assertEqual(self.manager.removed, [entity])
+
+        self.factory.remove_entity(other)
+        self.assertEqual(self.physics.num_bodies(), 0)
+
+    def test_removed_character_leaves_the_scene_graph(self):
+        entity = self.spawn()
+        self.assertEqual(self.root.get_num_children(), 1)
+
+        self.factory.remove_entity(entity)
+        self.assertEqual(self.root.get_num_children(), 0)
+        self.assertTrue(entity.get_component('NODEPATH').nodepath.is_empty())
+
+    def test_detached_character_is_not_removed_twice(self):
+        entity = self.spawn()
+        self.physics.detach_character(entity.get_component('PHY_CHARACTER'))
+        self.assertEqual(self.physics.num_bodies(), 0)
+
+        self.factory.remove_entity(entity)
+        self.assertEqual(self.physics.num_bodies(), 0)
+        self.assertFalse(self.physics._detached)
+
+    def test_queued_character_never_attaches(self):
+        self.physics.spawn_budget = 0.0
+        first = make_character(self.root)
+        second = make_character(self.root)
+        self.physics.init_components(0, {'PHY_CHARACTER': [
+            first.get_component('PHY_CHARACTER'),
+            second.get_component('PHY_CHARACTER'),
+        ]})
+
+        self.factory.remove_entity(second)
+        self.physics.attach_spawning()
+        self.assertEqual(self.physics.num_bodies(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+
+from panda3d import core as p3d
+from bamboo import ecs
+
+from lithium import components
+
+
+class CountedPhysicsSystem(components.PhysicsSystem):
+    __slots__ = [
+        'bodies',
+    ]
+
+    def num_bodies(self):
+        return self.bodies
+
+
+def make_characters(count):
+    root = p3d.NodePath('render')
+    characters = []
+    for i in range(count):
+        entity = ecs.Entity(None)
+        npcomp = components.NodePathComponent(None, root)
+        npcomp.nodepath.set_pos(i * 2, 0, 0.9)
+        entity.add_component(npcomp)
+        entity.add_component(components.CharacterComponent())
+        character = components.PhysicsCharacterComponent()
+        entity.add_component(character)
+        characters.append(character)
+    return characters
+
+
+class SpawnStepCostTest(unittest.TestCase):
+    def setUp(self):
+        self.physics = CountedPhysicsSystem()
+        self.physics.bodies = 100
+
+    def test_no_estimate_before_a_settled_step(self):
+        initial = self.physics._spawn_step_cost
+        self.physics._attached = 10
+        self.physics._time_step(0.005)
+        self.assertEqual(self.physics._spawn_step_cost, initial)
+        self.assertEqual(self.physics._attached, 0)
+
+    def test_settled_step_is_per_body(self):
+        self.physics._time_step(0.001)
+        self.assertAlmostEqual(self.physics._settled_step, 0.00001)
+
+    def test_new_characters_are_charged_the_extra_step_time(self):
+        initial = self.physics._spawn_step_cost
+        self.physics._time_step(0.001)
+
+        # 10 new bodies on top of 100 settled ones that cost 1 ms together
+        self.physics.bodies = 110
+        self.physics._attached = 10
+        self.physics._time_step(0.003)
+        self.assertAlmostEqual(self.physics._spawn_step_cost, (initial + 0.0002) / 2)
+        self.assertEqual(self.physics._attached, 0)
+
+    def test_faster_step_than_settled_does_not_go_negative(self):
+        self.physics._time_step(0.001)
+        self.physics.bodies = 110
+        self.physics._attached = 10
+        self.physics._spawn_step_cost = 0.0
+        self.physics._time_step(0.0005)
+        self.assertEqual(self.physics._spawn_step_cost, 0.0)
+
+
+class SpawnBudgetTest(unittest.TestCase):
+    def test_budget_counts_expected_step_cost(self):
+        physics = components.PhysicsSystem()
+        physics.spawn_budget = 0.002
+        # Each character is expected to add 1 ms to the next step, so only two fit
+        physics._spawn_step_cost = 0.001
+        characters = make_characters(5)
+        physics.spawn_characters(characters)
+        self.assertEqual(len(physics._spawning), 3)
+        self.assertEqual(physics._attached, 2)
+
+    def test_without_budget_a_wave_goes_in_at_once(self):
+        physics = components.PhysicsSystem()
+        physics.spawn_characters(make_characters(5))
+        self.assertEqual(len(physics._spawning), 0)
+        self.assertEqual(physics.num_bodies(), 5)
+
+    def test_detaching_a_queued_character_updates_the_wave(self):
+        physics = components.PhysicsSystem()
+        physics.spawn_budget = 0.0
+        characters = make_characters(3)
+        physics.spawn_characters(characters)
+        self.assertEqual(len(physics._spawning), 2)
+
+        physics.detach_character(characters[1])
+        self.assertEqual(physics._wave[3], 1)
+        physics.detach_character(characters[2])
+        self.assertIsNone(physics._wave)
+        self.assertEqual(physics.num_bodies(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()